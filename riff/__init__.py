@@ -7,16 +7,438 @@
 __author__ = 'Simon Drabble <python-devel@thebigmachine.org>'
 
 
+import array
+import fnmatch
+import hashlib
+import keyword
+import mmap
+import os
+import re
 import sys
 from StringIO import StringIO
 import struct
+import threading
+import time
+import types
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+class _StructMeta(type):
+  """Compiles the codec of each Struct class when the class is defined.
+
+  Each class gets _STRUCT, a struct.Struct for its _FORMAT (or None if it has
+  no valid _FORMAT), and _Assign and _Values, generated functions which set
+  and get all of its slots at once. A class defining _FIELDS also gets
+  generated _Unpack and _Pack methods, unless it defines its own.
+  """
+
+  def __init__(cls, name, bases, namespace):
+    type.__init__(cls, name, bases, namespace)
+    fmt = getattr(cls, '_FORMAT', None)
+    cls._STRUCT = None
+    if fmt is not None:
+      try:
+        cls._STRUCT = struct.Struct(fmt)
+      except struct.error:
+        pass
+
+    slots = getattr(cls, '__slots__', ())
+    if isinstance(slots, str):
+      slots = (slots,)
+    cls._typed_ = tuple([param for param in slots if param in cls._types_])
+    cls._Assign, cls._Values = _CompileAccessors(cls, tuple(slots))
+
+    fields = namespace.get('_FIELDS')
+    if fields is not None:
+      if len(fields) != len(slots):
+        raise TypeError('%s has %d _FIELDS for %d __slots__' %
+                        (name, len(fields), len(slots)))
+      unpack_from, pack = _CompileFields(tuple(slots), fields)
+      cls._UnpackFrom = staticmethod(unpack_from)
+      if '_Unpack' not in namespace:
+        cls._Unpack = _UnpackFields
+      if '_Pack' not in namespace:
+        cls._Pack = pack
+
+
+def _CompileAccessors(cls, slots):
+  """Generates functions to set and get a sequence of slots.
+
+  Where every slot is a member descriptor, assign sets the slots through the
+  descriptors, bypassing __setattr__ so that no cached length is invalidated.
+
+  Args:
+    cls: class, the class owning the slots.
+    slots: tuple of strs, the slot names.
+
+  Returns:
+    tuple of functions, (assign, values). assign(obj, seq) sets each slot from
+    the corresponding item of seq; values(obj) returns a tuple of the slots.
+  """
+  names = ''.join(['%s, ' % _SlotSource(slot) for slot in slots])
+  namespace = {'_getattr': getattr, '_setattr': setattr}
+  descriptors = [getattr(cls, slot, None) for slot in slots]
+  if not slots:
+    source = ('def assign(self, values):\n'
+              '  pass\n'
+              'def values(self):\n'
+              '  return ()\n')
+  elif [d for d in descriptors if type(d) is not types.MemberDescriptorType]:
+    if [slot for slot in slots if keyword.iskeyword(slot)]:
+      # A keyword cannot be the target of an assignment.
+      lines = ['def assign(self, values):']
+      for i, slot in enumerate(slots):
+        lines.append('  _setattr(self, %r, values[%d])' % (slot, i))
+    else:
+      lines = ['def assign(self, values):',
+               '  %s = values[:%d]' % (names, len(slots))]
+    lines.append('def values(self):')
+    lines.append('  return (%s)\n' % names)
+    source = '\n'.join(lines)
+  else:
+    lines = ['def assign(self, values):']
+    for i, descriptor in enumerate(descriptors):
+      namespace['set%d' % i] = descriptor.__set__
+      lines.append('  set%d(self, values[%d])' % (i, i))
+    lines.append('def values(self):')
+    lines.append('  return (%s)\n' % names)
+    source = '\n'.join(lines)
+  exec source in namespace
+  return namespace['assign'], namespace['values']
+
+
+def _SlotSource(slot):
+  """Returns the Python source which gets a slot of self.
+
+  Args:
+    slot: str, the slot name, which may be a Python keyword.
+
+  Returns:
+    str
+  """
+  if keyword.iskeyword(slot):
+    return '_getattr(self, %r)' % slot
+  return 'self.%s' % slot
+
+
+class Field(object):
+  """Describes how one slot of a Struct is packed; see Struct._FIELDS.
+
+  A field contributes lines of Python to the decoder and encoder generated
+  for the class. In the decoder, data is a str and offset the position of the
+  field within it, which the lines must advance. In the encoder, the lines
+  pass the packed value to append.
+  """
+
+  def _DecodeLines(self, compiler, target):
+    """Returns the lines which decode the field into the variable target."""
+    raise NotImplementedError
+
+  def _EncodeLines(self, compiler, value):
+    """Returns the lines which encode the expression value."""
+    raise NotImplementedError
+
+
+class Fixed(Field):
+  """A field of fixed size, packed with a single-value struct format."""
+
+  def __init__(self, fmt):
+    """Constructor.
+
+    Args:
+      fmt: str, a struct format giving one value, e.g. '<I' or '20s'.
+
+    Raises:
+      ValueError, if fmt gives more or fewer than one value.
+    """
+    if len(_ParseFormat(fmt)[1]) != 1:
+      raise ValueError('Fixed format %r does not give one value' % fmt)
+    self.fmt = fmt
+    self.codec = struct.Struct(fmt)
+    if fmt[:1] in '<>!=':
+      self.order = fmt[:1]
+    else:
+      # Native alignment depends on neighbouring fields, so never merge.
+      self.order = None
+
+  def _DecodeLines(self, compiler, target):
+    return ['%s, = %s(data, offset)' % (target,
+                                        compiler.Name(self.codec.unpack_from)),
+            'offset += %d' % self.codec.size]
+
+  def _EncodeLines(self, compiler, value):
+    return ['append(%s(%s))' % (compiler.Name(self.codec.pack), value)]
+
+
+class PrefixedString(Field):
+  """A string preceded by its length."""
+
+  def __init__(self, prefix='B'):
+    """Constructor.
+
+    Args:
+      prefix: str, the struct format of the length, e.g. 'B' or '<H'.
+    """
+    self.codec = struct.Struct(prefix)
+
+  def _DecodeLines(self, compiler, target):
+    size = compiler.Temp()
+    return ['%s, = %s(data, offset)' % (size,
+                                        compiler.Name(self.codec.unpack_from)),
+            'offset += %d' % self.codec.size,
+            '%s = data[offset:offset + %s]' % (target, size),
+            'offset += %s' % size]
+
+  def _EncodeLines(self, compiler, value):
+    return ['append(%s(len(%s)))' % (compiler.Name(self.codec.pack), value),
+            'append(%s)' % value]
+
+
+class ZeroString(Field):
+  """A zero-terminated string, or a string zero-padded to a fixed size."""
+
+  def __init__(self, size=None):
+    """Constructor.
+
+    Args:
+      size: int, the size of the padded field, or None if the string is
+            terminated by a single zero byte. A string without a terminator
+            runs to the end of the data.
+    """
+    self.size = size
+
+  def _DecodeLines(self, compiler, target):
+    end = compiler.Temp()
+    if self.size is not None:
+      return ['%s = data[offset:offset + %d]' % (target, self.size),
+              '%s = %s.find("\\0")' % (end, target),
+              'if %s >= 0:' % end,
+              '  %s = %s[:%s]' % (target, target, end),
+              'offset += %d' % self.size]
+    return ['%s = data.find("\\0", offset)' % end,
+            'if %s < 0:' % end,
+            '  %s = data[offset:]' % target,
+            '  offset = len(data)',
+            'else:',
+            '  %s = data[offset:%s]' % (target, end),
+            '  offset = %s + 1' % end]
+
+  def _EncodeLines(self, compiler, value):
+    if self.size is not None:
+      pack = compiler.Name(struct.Struct('%ds' % self.size).pack)
+      return ['append(%s(%s))' % (pack, value)]
+    return ['append(%s)' % value, 'append("\\0")']
+
+
+class Array(Field):
+  """A sequence of fields of one type, preceded by their count.
+
+  The decoded value is a list.
+  """
+
+  def __init__(self, item, count='<I'):
+    """Constructor.
+
+    Args:
+      item: Field, the type of each element.
+      count: str, the struct format of the count, e.g. 'B' or '<I'.
+    """
+    self.item = item
+    self.codec = struct.Struct(count)
+
+  def _ArrayFormat(self, compiler, count):
+    """Returns an expression for the struct format of a Fixed item array.
+
+    Args:
+      compiler: _FieldCompiler, holds the names of the generated code.
+      count: str, an expression for the number of items.
+
+    Returns:
+      str
+    """
+    item = self.item
+    body = item.fmt[1:]
+    if len(body) == 1 and body not in 'sp':
+      # A repeat count gives that many values, e.g. '<12I'.
+      return '%s %% %s' % (compiler.Name(item.order + '%d' + body), count)
+    # A repeat count would change the item itself, e.g. '<4s', so repeat
+    # the whole item instead.
+    return '%s + %s * %s' % (compiler.Name(item.order), compiler.Name(body),
+                             count)
+
+  def _DecodeLines(self, compiler, target):
+    count = compiler.Temp()
+    lines = ['%s, = %s(data, offset)' % (count,
+                                         compiler.Name(self.codec.unpack_from)),
+             'offset += %d' % self.codec.size]
+    item = self.item
+    if isinstance(item, Fixed) and item.order:
+      # The whole array is one struct format, e.g. '<12I' or '<4s4s4s'.
+      lines.extend(['%s = list(_unpack_from(%s, data, offset))' %
+                    (target, self._ArrayFormat(compiler, count)),
+                    'offset += %s * %d' % (count, item.codec.size)])
+      return lines
+    element = compiler.Temp()
+    lines.extend(['%s = []' % target,
+                  'for _ in xrange(%s):' % count])
+    lines.extend(['  ' + line
+                  for line in item._DecodeLines(compiler, element)])
+    lines.append('  %s.append(%s)' % (target, element))
+    return lines
+
+  def _EncodeLines(self, compiler, value):
+    lines = ['append(%s(len(%s)))' % (compiler.Name(self.codec.pack), value)]
+    item = self.item
+    if isinstance(item, Fixed) and item.order:
+      lines.append('append(_pack(%s, *%s))' % (
+          self._ArrayFormat(compiler, 'len(%s)' % value), value))
+      return lines
+    element = compiler.Temp()
+    lines.append('for %s in %s:' % (element, value))
+    lines.extend(['  ' + line
+                  for line in item._EncodeLines(compiler, element)])
+    return lines
+
+
+class Nested(Field):
+  """A Struct packed within another, without a chunk header."""
+
+  def __init__(self, struct_class):
+    """Constructor.
+
+    Args:
+      struct_class: class, a Struct subclass with a _FORMAT or _FIELDS.
+    """
+    self.struct_class = struct_class
+
+  def _DecodeLines(self, compiler, target):
+    struct_class = self.struct_class
+    values = compiler.Temp()
+    if getattr(struct_class, '_UnpackFrom', None) is not None:
+      lines = ['%s, offset = %s(data, offset)' %
+               (values, compiler.Name(struct_class._UnpackFrom))]
+    else:
+      codec = struct_class._STRUCT
+      lines = ['%s = %s(data, offset)' % (values,
+                                          compiler.Name(codec.unpack_from)),
+               'offset += %d' % codec.size]
+    lines.extend(['%s = _new(%s)' % (target, compiler.Name(struct_class)),
+                  '%s._Assign(%s, %s)' % (compiler.Name(struct_class), target,
+                                          values)])
+    return lines
+
+  def _EncodeLines(self, compiler, value):
+    return ['append(%s._Pack())' % value]
+
+
+class _FieldCompiler(object):
+  """Holds the names used by the code generated from fields."""
+
+  def __init__(self):
+    self.namespace = {'_unpack_from': struct.unpack_from,
+                      '_pack': struct.pack,
+                      '_new': object.__new__,
+                      '_getattr': getattr}
+    self._count = 0
+
+  def Name(self, value):
+    """Returns a new global name of the generated code bound to value."""
+    self._count += 1
+    name = '_g%d' % self._count
+    self.namespace[name] = value
+    return name
+
+  def Temp(self):
+    """Returns a new local variable name."""
+    self._count += 1
+    return '_t%d' % self._count
+
+
+def _CompileFields(slots, fields):
+  """Generates the decoder and encoder for a sequence of fields.
+
+  Runs of Fixed fields with the same byte order are packed as one format.
+
+  Args:
+    slots: tuple of strs, the slot names.
+    fields: sequence of Fields, one per slot.
+
+  Returns:
+    tuple of functions, (unpack_from, pack). unpack_from(data, offset)
+    returns (tuple of slot values, offset following the fields); pack(self)
+    returns the packed str.
+  """
+  compiler = _FieldCompiler()
+  targets = ['_v%d' % i for i in xrange(len(slots))]
+  values = [_SlotSource(slot) for slot in slots]
+  decode = ['if type(data) is not str:',
+            '  data = str(data)']
+  encode = ['parts = []',
+            'append = parts.append']
+  i = 0
+  while i < len(fields):
+    field = fields[i]
+    j = i + 1
+    if isinstance(field, Fixed) and field.order:
+      while (j < len(fields) and isinstance(fields[j], Fixed) and
+             fields[j].order == field.order):
+        j += 1
+    if j - i > 1:
+      codec = struct.Struct(field.order + ''.join([f.fmt[1:]
+                                                   for f in fields[i:j]]))
+      decode.extend(['%s, = %s(data, offset)' %
+                     (', '.join(targets[i:j]),
+                      compiler.Name(codec.unpack_from)),
+                     'offset += %d' % codec.size])
+      encode.append('append(%s(%s))' % (compiler.Name(codec.pack),
+                                        ', '.join(values[i:j])))
+    else:
+      decode.extend(field._DecodeLines(compiler, targets[i]))
+      encode.extend(field._EncodeLines(compiler, values[i]))
+    i = j
+  decode.append('return (%s,), offset' % ', '.join(targets))
+  encode.append('return "".join(parts)')
+  source = '\n'.join(['def unpack_from(data, offset):'] +
+                      ['  ' + line for line in decode] +
+                      ['def pack(self):'] +
+                      ['  ' + line for line in encode]) + '\n'
+  namespace = compiler.namespace
+  exec source in namespace
+  return namespace['unpack_from'], namespace['pack']
+
+
+def _UnpackFields(self, data):
+  """Unpacks data with the decoder generated from _FIELDS.
+
+  Args:
+    data: str or buffer, raw bytes containing the packed struct data.
+
+  Returns:
+    tuple, each element is the value of an instance variable.
+
+  Raises:
+    struct.error, if the data is too short for the fields.
+  """
+  values, offset = self._UnpackFrom(data, 0)
+  if offset > len(data):
+    raise struct.error('Data of length %d is too short for the fields of %s'
+                       % (len(data), self.__class__.__name__))
+  return values
 
 
 class Struct(object):
   """Models a simple structure."""
 
+  __metaclass__ = _StructMeta
+
   _types_ = {}
   _defaults_ = {}
+  _length = None
+  _parent = None
 
   def __init__(self, *args, **kwargs):
     """Constructor.
@@ -40,18 +462,22 @@ class Struct(object):
       raw_data = stream.read(size)
 
     if raw_data:
-      unpacked_data = list(self._Unpack(raw_data))
-      for param in self.__slots__:
-        setattr(self, param, unpacked_data.pop(0))
+      self._Assign(tuple(self._Unpack(raw_data)))
 
     else:
-      for param in self.__slots__:
-        var = kwargs.get(param, self._defaults_.get(param, None))
-        if param in self._types_:
-          if not isinstance(var, self._types_[param]):
-            raise AttributeError('Parameter %s is of type %s, not %s' %
+      defaults = self._defaults_
+      self._Assign([kwargs.get(param, defaults.get(param, None))
+                    for param in self.__slots__])
+      for param in self._typed_:
+        var = getattr(self, param)
+        if not isinstance(var, self._types_[param]):
+          raise AttributeError('Parameter %s is of type %s, not %s' %
                                (param, type(var), self._types_[param]))
-        setattr(self, param, var)
+
+  def __setattr__(self, name, value):
+    object.__setattr__(self, name, value)
+    if name[0] != '_':
+      self._Invalidate()
 
   def __str__(self):
     slist = map(lambda x: '\t%s=%s' % (x, getattr(self, x)), self.__slots__)
@@ -63,8 +489,9 @@ class Struct(object):
     Returns:
       str, the packed data.
     """
-    params = map(lambda x: getattr(self, x), self.__slots__)
-    return struct.pack(self._FORMAT, *params)
+    if self._STRUCT is None:
+      return struct.pack(self._FORMAT, *self._Values())
+    return self._STRUCT.pack(*self._Values())
 
   def _Unpack(self, data):
     """Unpacks data into a sequence of params.
@@ -81,34 +508,147 @@ class Struct(object):
       struct.error, if the incoming data cannot be unpacked.
     """
     try:
-      return struct.unpack(self._FORMAT, data)
+      if self._STRUCT is None:
+        return struct.unpack(self._FORMAT, data)
+      return self._STRUCT.unpack(data)
     except struct.error, e:
       raise struct.error('Data of length %d could not be unpacked into'
                          ' size %s format %s' %
                          (len(data), struct.calcsize(self._FORMAT), self._FORMAT
                          ))
 
+  def FromTuples(cls, rows):
+    """Creates structures from sequences of slot values.
+
+    The values are assigned without type checking.
+
+    Args:
+      rows: iterable, each item is a sequence of values, one per slot.
+
+    Returns:
+      list of instances of cls.
+    """
+    new = object.__new__
+    assign = cls._Assign
+    objs = []
+    for row in rows:
+      obj = new(cls)
+      assign(obj, row)
+      objs.append(obj)
+    return objs
+  FromTuples = classmethod(FromTuples)
+
+  def FromBuffer(cls, data, offset=0, count=None):
+    """Creates structures from consecutive records packed in _FORMAT.
+
+    Args:
+      data: str or buffer, the packed records.
+      offset: int, the offset of the first record within data.
+      count: int, the number of records to unpack, or None to unpack as many
+             whole records as data holds.
+
+    Returns:
+      list of instances of cls.
+    """
+    codec = cls._STRUCT
+    size = codec.size
+    if count is None:
+      count = (len(data) - offset) // size
+    unpack_from = codec.unpack_from
+    return cls.FromTuples(unpack_from(data, offset + i * size)
+                          for i in xrange(count))
+  FromBuffer = classmethod(FromBuffer)
+
+  def _PackedSize(self):
+    """Returns the length of the data returned by _Pack.
+
+    Returns:
+      int
+    """
+    if (self._STRUCT is not None and
+        self.__class__._Pack.im_func is Struct._Pack.im_func):
+      return self._STRUCT.size
+    return len(self._Pack())
+
+  def _ComputeLength(self):
+    """Computes the length of self's packed data.
+
+    Returns:
+      int
+    """
+    return len(repr(self))
+
+  def _Invalidate(self):
+    """Discards the cached length of self and of every enclosing list."""
+    node = self
+    while node is not None:
+      node.__dict__.pop('_length', None)
+      node = node._parent
+
   def _GetLength(self):
     """Returns the length of self's packed data.
 
+    The length is cached until a field of self, or of a chunk within self, is
+    set, or an element is added to or removed from a list within self.
+
     Returns:
       int
     """
-    return len(repr(self))
+    length = self._length
+    if length is None:
+      length = self._length = self._ComputeLength()
+    return length
   length = property(_GetLength, None, None, None)
 
 
+_CHUNK_HEADER = struct.Struct('<4sI')
+_LIST_HEADER = struct.Struct('<4sI4s')
+_SIZE = struct.Struct('<I')
+# The ID of filler chunks, which readers skip.
+_JUNK = 'JUNK'
+
+
 class Chunk(Struct):
 
   __slots__ = ()
   _FORMAT = ''
 
+  def _ComputeLength(self):
+    size = self._PackedSize()
+    return 8 + size + size % 2
+
   def __repr__(self):
-    data = self._Pack()
+    if _hook is None:
+      data = self._Pack()
+    else:
+      data = _Encode(self)
     length = len(data)
-    if length % 2:
-      data += '\0'
-    return struct.pack('4sI%ds' % len(data), self.ID, length, data)
+    # The s format pads the data with the pad byte, if any.
+    return struct.pack('<4sI%ds' % (length + length % 2), self.ID, length,
+                       data)
+
+  def PackTo(self, buf):
+    """Appends the chunk, as returned by repr, to a buffer.
+
+    Args:
+      buf: bytearray, the buffer.
+    """
+    codec = self._STRUCT
+    if (_hook is None and codec is not None and
+        self.__class__._Pack.im_func is Struct._Pack.im_func):
+      buf += _CHUNK_HEADER.pack(self.ID, codec.size)
+      buf += codec.pack(*self._Values())
+      size = codec.size
+    else:
+      if _hook is None:
+        data = self._Pack()
+      else:
+        data = _Encode(self)
+      size = len(data)
+      buf += _CHUNK_HEADER.pack(self.ID, size)
+      buf += data
+    if size % 2:
+      buf.append(0)
 
 
 class LIST(Chunk, list):
@@ -117,6 +657,9 @@ class LIST(Chunk, list):
   _HEADER = 'LIST'
   _CLASSES = {}
   _CHUNKBASE = None
+  _lazy = False
+  # The ds64 chunk of a form read from RF64.
+  _ds64 = None
 
   def __init__(self, *args, **kwargs):
     """Constructor.
@@ -128,24 +671,72 @@ class LIST(Chunk, list):
                 raw_data - str, such as might be read from a file.
                 stream - any file-like object, must support read, seek,
                          and tell at a minimum. Superceded by raw_data.
+                lazy - bool, if True only the location of each element is
+                       read from stream; an element is read and unpacked the
+                       first time it is accessed. stream must remain open
+                       until then.
+                index - ChunkIndex, the chunk locations within stream. The
+                        list is read lazily from the locations in the index
+                        instead of from the chunk headers.
+                entry - int, the number of the list's own entry in index.
+                select - sequence of strs, the paths of the chunks to read,
+                         as chunk IDs (list types for LISTs) below this list
+                         separated by '/', e.g. 'dwrf/doc_'. Each ID may be
+                         a shell-style pattern, e.g. 'dwrf/d*'. Any other
+                         chunk is skipped without being read, and None is
+                         stored in its place, so that elements keep their
+                         positions. A list with skipped elements cannot be
+                         packed.
+                source - tuple, identifies the file being read, for the
+                         chunk cache; see SetCache.
 
     Each element within the list is initialised either in order from args,
     from keywords in kwargs, or via raw data in raw_data or stream.
     """
     stream = kwargs.pop('stream', None)
     raw_data = kwargs.pop('raw_data', None)
+    lazy = kwargs.pop('lazy', False)
+    index = kwargs.pop('index', None)
+    entry = kwargs.pop('entry', 0)
+    select = kwargs.pop('select', None)
+    if select is not None:
+      select = _CompileSelect(select)
+    source = kwargs.pop('source', None)
     if raw_data is not None:
       stream = StringIO(raw_data)
 
-    if stream:
+    if index is not None:
+      list_type = index.entries[entry][1]
+      if list_type != self.ID:
+        raise ValueError('%s is not a %s: ID=%s' %
+                         (self._HEADER, self.ID, list_type))
+      self._lazy = True
+      list.extend(self, self._UnpackStream(stream, index=index, entry=entry,
+                                           select=select, source=source))
+
+    elif stream:
+      header = None
       if self._HEADER:
-        stream.seek(len(self._HEADER), 1)
+        header = stream.read(len(self._HEADER))
       list_size, list_type = struct.unpack('<I4s', stream.read(8))
       if list_type != self.ID:
         raise ValueError('%s is not a %s: ID=%s' %
                          (self._HEADER, self.ID, list_type))
 
-      self.extend(self._UnpackStream(stream))
+      # The list size includes the 4 bytes of the list type.
+      end = stream.tell() - 4 + list_size
+      sizes = None
+      if header in _RF64_HEADERS:
+        # The real sizes are in the ds64 chunk which must come first.
+        start = stream.tell() - 4
+        self._ds64 = DS64(stream=stream)
+        end = start + self._ds64.riff_size
+        sizes = self._ds64.Sizes()
+        lazy = lazy or bool(sizes)
+      self._lazy = lazy
+      list.extend(self, self._UnpackStream(stream, end=end, lazy=lazy,
+                                           sizes=sizes, select=select,
+                                           source=source))
 
     else:
       for param in self.__slots__:
@@ -166,9 +757,70 @@ class LIST(Chunk, list):
     return s
 
   def __repr__(self):
-    data = ''.join(map(repr, self[:]))
-    return struct.pack('<4sI4s%ds' % len(data),
-                       self._HEADER, len(data) + 4, self.ID, data)
+    buf = bytearray()
+    self.PackTo(buf)
+    return str(buf)
+
+  def PackTo(self, buf):
+    """Appends the list and all its elements to a buffer.
+
+    Every element appends itself, and the size of the list is filled in
+    afterwards, so the data is copied once however deeply the lists are
+    nested.
+
+    Args:
+      buf: bytearray, the buffer.
+    """
+    if not self._HEADER:
+      buf += repr(self)
+      return
+    start = len(buf)
+    buf += _LIST_HEADER.pack(self._HEADER, 0, self.ID)
+    for item in self:
+      item.PackTo(buf)
+    _SIZE.pack_into(buf, start + 4, len(buf) - start - 8)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(len(self)))]
+    item = list.__getitem__(self, index)
+    if isinstance(item, ChunkRef):
+      item = item.Load()
+      item._parent = self
+      list.__setitem__(self, index, item)
+    return item
+
+  def __setitem__(self, index, item):
+    if isinstance(index, slice):
+      item = list(item)
+      for each in item:
+        self._CheckItem(each)
+    else:
+      self._CheckItem(item)
+    list.__setitem__(self, index, item)
+    self._Invalidate()
+
+  def __delitem__(self, index):
+    list.__delitem__(self, index)
+    self._Invalidate()
+
+  def __setslice__(self, i, j, items):
+    self[max(0, i):max(0, j):] = items
+
+  def __delslice__(self, i, j):
+    del self[max(0, i):max(0, j):]
+
+  def __iadd__(self, items):
+    self.extend(items)
+    return self
+
+  def __getslice__(self, i, j):
+    return self[max(0, i):max(0, j):]
+
+  def __iter__(self):
+    if not self._lazy:
+      return list.__iter__(self)
+    return (self[index] for index in xrange(len(self)))
 
   def __getattr__(self, key):
     try:
@@ -178,21 +830,41 @@ class LIST(Chunk, list):
                        (key, self.__slots__, self.__class__))
 
   def append(self, item):
-    if not (hasattr(item, 'ID') and hasattr(item, '_Pack')):
-      raise AttributeError('append: Item %s<%s> is not a valid RIFF chunk' %
-                           (item, item.__class__))
+    self._CheckItem(item, 'append')
     list.append(self, item)
+    self._Invalidate()
 
   def insert(self, pos, item):
-    if not (hasattr(item, 'ID') and hasattr(item, '_Pack')):
-      raise AttributeError('append: Item %s<%s> is not a valid RIFF chunk' %
-                           (item, item.__class__))
-    list.insert(pos, item)
+    self._CheckItem(item, 'insert')
+    list.insert(self, pos, item)
+    self._Invalidate()
 
   def extend(self, items):
     for item in items:
       self.append(item)
 
+  def remove(self, item):
+    list.remove(self, item)
+    self._Invalidate()
+
+  def pop(self, *args):
+    item = list.pop(self, *args)
+    self._Invalidate()
+    return item
+
+  def _CheckItem(self, item, method='__setitem__'):
+    if not (hasattr(item, 'ID') and hasattr(item, '_Pack')):
+      raise AttributeError('%s: Item %s<%s> is not a valid RIFF chunk' %
+                           (method, item, item.__class__))
+
+  def _ComputeLength(self):
+    length = 12
+    for item in list.__iter__(self):
+      if not isinstance(item, ChunkRef):
+        item._parent = self
+      length += item.length
+    return length
+
   def _Unpack(self, data):
     """Unpacks the data into separate values, one per element.
 
@@ -206,19 +878,33 @@ class LIST(Chunk, list):
     """
     return self._UnpackStream(StringIO(data))
 
-  def _UnpackStream(self, stream):
+  def _UnpackStream(self, stream, end=None, lazy=False, index=None,
+                    entry=None, sizes=None, select=None, source=None):
     """Unpacks the stream data into separate values, one per element.
 
     Used when initialising from a stream or raw data.
 
     Args:
       stream: file-like, must support read, seek, and tell.
+      end: int, the stream offset at which the list data ends, or None to
+           read until the end of the stream.
+      lazy: bool, if True return a ChunkRef for each element instead of
+            reading it.
+      index: ChunkIndex, if present the elements are located through the
+             index rather than by reading stream.
+      entry: int, the number of the list's own entry in index.
+      sizes: dict, {'chunk ID': size}, the 64-bit sizes of chunks whose size
+             field is 0xFFFFFFFF, from the ds64 chunk of an RF64 form.
+      select: list of tuples, the compiled paths of the chunks to read.
+      source: tuple, identifies the file being read, for the chunk cache.
 
     Returns:
       iterable, each item is the value of an element.
     """
     cf = ChunkFactory(self, stream, datadict=self._CLASSES,
-                      chunkbase=self._CHUNKBASE)
+                      chunkbase=self._CHUNKBASE, end=end, lazy=lazy,
+                      index=index, entry=entry, sizes=sizes, select=select,
+                      source=source)
     return iter(cf)
 
 
@@ -240,22 +926,557 @@ class MultiRecordList(LIST):
     if raw_data:
       stream = StringIO(raw_data)
 
+    record_struct = self._RECORD_STRUCT
+    size = struct.calcsize(record_struct._FORMAT)
     while True:
-      data = stream.read(struct.calcsize(self._RECORD_STRUCT._FORMAT))
+      data = stream.read(size)
       if not data:
         break
-      obj = self._RECORD_STRUCT(raw_data=data)
+      obj = record_struct(raw_data=data)
       self.append(obj)
 
   def __repr__(self):
     data = ''.join(map(repr, self[:]))
     return struct.pack('<4s%ds' % len(data), self.ID, data)
 
+  def _ComputeLength(self):
+    length = 4
+    for item in self:
+      item._parent = self
+      length += item.length
+    return length
+
   def __str__(self):
     data = ''.join(map(str, self[:]))
     return struct.pack('<6s%ds' % len(data), '<%s>' % self.ID, data)
 
 
+class RecordTable(MultiRecordList):
+  """Models a sequence of fixed-format records, stored column by column.
+
+  The whole block of records is decoded in one call, into a NumPy structured
+  array if NumPy is available, or otherwise into one array.array (or list,
+  for strings) per field. A _RECORD_STRUCT object is only created when an
+  element is accessed, and is a copy: setting its fields does not change the
+  table. Use Column to work with a whole field at once.
+
+  Records are packed back to back, as they are read, by __repr__.
+  """
+
+  def __init__(self, raw_data=None, stream=None):
+    """Constructor.
+
+    Args:
+      raw_data: str, contains the binary struct data.
+      stream: file-like, must support read. Contains the binary struct data if
+              raw_data is None. Superceded by raw_data.
+
+    If neither is present the table is empty.
+    """
+    if raw_data is None:
+      raw_data = stream and stream.read() or ''
+    record_struct = self._RECORD_STRUCT
+    prefix, codes = _ParseFormat(record_struct._FORMAT)
+    size = struct.calcsize(record_struct._FORMAT)
+    if len(raw_data) % size:
+      raise struct.error('Data of length %d is not a whole number of records'
+                         ' of size %d format %s' %
+                         (len(raw_data), size, record_struct._FORMAT))
+    self._prefix = prefix
+    self._codes = codes
+    self._count = len(raw_data) // size
+    if numpy is not None:
+      self._records = numpy.frombuffer(raw_data, _NumpyDtype(
+          record_struct._FORMAT, record_struct.__slots__)).copy()
+      self._columns = None
+    else:
+      self._records = None
+      values = self._UnpackAll(raw_data)
+      self._columns = []
+      width = len(codes)
+      for i, code in enumerate(codes):
+        column = values[i::width]
+        typecode = _ARRAY_TYPECODES.get(code)
+        if typecode:
+          self._columns.append(array.array(typecode, column))
+        else:
+          self._columns.append(list(column))
+
+  def _UnpackAll(self, data):
+    """Unpacks every record in data.
+
+    Args:
+      data: str or buffer, the packed records.
+
+    Returns:
+      tuple, the field values of every record in turn.
+    """
+    fmt = self._RECORD_STRUCT._FORMAT
+    if self._prefix in '<>!=':
+      body = fmt.lstrip('<>!=')
+      return struct.unpack(self._prefix + body * self._count, data)
+    # Natively aligned records cannot be repeated in a single format without
+    # changing the padding between them.
+    codec = struct.Struct(fmt)
+    values = []
+    for i in xrange(self._count):
+      values.extend(codec.unpack_from(data, i * codec.size))
+    return tuple(values)
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(self._count))]
+    if index < 0:
+      index += self._count
+    if not 0 <= index < self._count:
+      raise IndexError('RecordTable index out of range')
+    return self._RECORD_STRUCT.FromTuples([self._Row(index)])[0]
+
+  def __iter__(self):
+    return (self[index] for index in xrange(self._count))
+
+  def __setitem__(self, index, item):
+    self._CheckItem(item)
+    if self._records is not None:
+      self._records[index] = item._Values()
+    else:
+      for column, value in zip(self._columns, item._Values()):
+        column[index] = value
+    self._Invalidate()
+
+  def append(self, item):
+    self._CheckItem(item, 'append')
+    if self._records is not None:
+      row = numpy.array([item._Values()], dtype=self._records.dtype)
+      self._records = numpy.concatenate((self._records, row))
+    else:
+      for column, value in zip(self._columns, item._Values()):
+        column.append(value)
+    self._count += 1
+    self._Invalidate()
+
+  def insert(self, pos, item):
+    self._CheckItem(item, 'insert')
+    if pos < 0:
+      pos = max(0, pos + self._count)
+    pos = min(pos, self._count)
+    if self._records is not None:
+      row = numpy.array([item._Values()], dtype=self._records.dtype)
+      self._records = numpy.concatenate((self._records[:pos], row,
+                                         self._records[pos:]))
+    else:
+      for column, value in zip(self._columns, item._Values()):
+        column.insert(pos, value)
+    self._count += 1
+    self._Invalidate()
+
+  def __delitem__(self, index):
+    if not isinstance(index, slice):
+      if index < 0:
+        index += self._count
+      if not 0 <= index < self._count:
+        raise IndexError('RecordTable index out of range')
+    if self._records is not None:
+      self._records = numpy.delete(self._records, index)
+      self._count = len(self._records)
+    else:
+      for column in self._columns:
+        del column[index]
+      self._count = len(self._columns[0])
+    self._Invalidate()
+
+  def remove(self, item):
+    """Removes the first record with the same field values as item.
+
+    Records are copies, so they are matched by value rather than by
+    identity.
+    """
+    values = item._Values()
+    for index in xrange(self._count):
+      if self._Row(index) == values:
+        del self[index]
+        return
+    raise ValueError('RecordTable.remove(x): x not in table')
+
+  def pop(self, index=-1):
+    item = self[index]
+    del self[index]
+    return item
+
+  def _Row(self, index):
+    """Returns the field values of a record.
+
+    Args:
+      index: int, the record number.
+
+    Returns:
+      tuple.
+    """
+    if self._records is not None:
+      return tuple(self._records[index].tolist())
+    return tuple([column[index] for column in self._columns])
+
+  def Column(self, name):
+    """Returns every value of one field.
+
+    Args:
+      name: str, the field name from _RECORD_STRUCT.__slots__.
+
+    Returns:
+      numpy.ndarray if NumPy is available, which is a view into the table,
+      otherwise array.array or list.
+    """
+    if self._records is not None:
+      return self._records[name]
+    return self._columns[list(self._RECORD_STRUCT.__slots__).index(name)]
+
+  def _PackRecords(self):
+    """Packs every record.
+
+    Returns:
+      str, the records packed back to back.
+    """
+    if self._records is not None:
+      # Copy field by field, so that padding is packed as zeros, as struct
+      # packs it, rather than as whatever memory the table holds there.
+      packed = numpy.zeros(self._count, self._records.dtype)
+      for name in self._records.dtype.names:
+        packed[name] = self._records[name]
+      return packed.tobytes()
+    values = []
+    for row in zip(*self._columns):
+      values.extend(row)
+    fmt = self._RECORD_STRUCT._FORMAT
+    if self._prefix in '<>!=':
+      return struct.pack(self._prefix + fmt.lstrip('<>!=') * self._count,
+                         *values)
+    width = len(self._codes)
+    codec = struct.Struct(fmt)
+    return ''.join([codec.pack(*values[i:i + width])
+                    for i in xrange(0, len(values), width)])
+
+  def __repr__(self):
+    return self.ID + self._PackRecords()
+
+  def __str__(self):
+    return '<%s>%s' % (self.ID, ''.join(map(str, self)))
+
+  def _ComputeLength(self):
+    return 4 + self._count * struct.calcsize(self._RECORD_STRUCT._FORMAT)
+
+
+class ChunkTable(LIST):
+  """Models a LIST of many small chunks, stored in parallel arrays.
+
+  Each element is held as the number of its kind (its chunk ID and class),
+  its data size, and an offset. Where the class has a fixed _FORMAT and the
+  default _Pack and _Unpack, the offset is the row of the element's field
+  values, which are kept in one array.array (or list, for strings) per field
+  of the class; for any other chunk it is the offset of its packed data within
+  one bytearray. A Chunk is only created when an element is accessed, and is a
+  copy: setting its fields does not change the table, but assigning it to the
+  element does.
+
+  A form can be stored the same way by deriving from both ChunkTable and
+  RIFF, in that order. The elements are always read in full, so lazy reading
+  has no effect, and index and select are not supported. Data replaced by
+  assigning an element is not reclaimed.
+  """
+
+  # An empty table, until _Clear is called.
+  _count = 0
+  _kinds = ()
+  _types = _sizes = _offsets = _columns = ()
+  _data = ''
+
+  def _UnpackStream(self, stream, end=None, lazy=False, index=None,
+                    entry=None, sizes=None, select=None, source=None):
+    if index is not None or select is not None:
+      raise ValueError('%s cannot be read from an index or with select' %
+                       self.__class__.__name__)
+    self._Clear()
+    if end is None:
+      data = stream.read()
+    else:
+      data = _ReadData(stream, end - stream.tell())
+    if not isinstance(data, str):
+      data = str(data)
+
+    kinds = {}
+    types = self._types
+    offsets = self._offsets
+    data_sizes = self._sizes
+    unpack_header = _CHUNK_HEADER.unpack_from
+    length = len(data)
+    pos = 0
+    padded = False
+    while length - pos >= 8:
+      if padded and data[pos] == '\0':
+        # Skip the pad byte which follows a chunk of odd size.
+        pos += 1
+        padded = False
+        continue
+      chunk_type, size = unpack_header(data, pos)
+      if size == 0xFFFFFFFF and sizes is not None and chunk_type in sizes:
+        size = sizes[chunk_type]
+      padded = size % 2
+      if chunk_type == _JUNK:
+        pos += 8 + size
+        continue
+      is_list = chunk_type == 'LIST' or chunk_type == 'RIFF'
+      if is_list:
+        chunk_type = data[pos + 8:pos + 12]
+      kind = kinds.get((chunk_type, is_list))
+      if kind is None:
+        kind = kinds[(chunk_type, is_list)] = self._KindOf(
+            chunk_type, self._GetClass(chunk_type), is_list, size)
+      codec = self._kinds[kind][3]
+      if codec is not None and size != codec.size:
+        kind = self._KindOf(chunk_type, self._kinds[kind][1], is_list, size)
+        codec = None
+      types.append(kind)
+      data_sizes.append(size)
+      if codec is not None:
+        columns = self._columns[kind]
+        offsets.append(len(columns[0]))
+        for column, value in zip(columns, codec.unpack_from(data, pos + 8)):
+          column.append(value)
+      else:
+        offsets.append(len(self._data))
+        if is_list:
+          # Lists are kept with their header, as ChunkFactory reads them.
+          self._data += buffer(data, pos, size + 8)
+        else:
+          self._data += buffer(data, pos + 8, size)
+      pos += 8 + size
+    self._count = len(types)
+    return ()
+
+  def _Clear(self):
+    """Empties the table."""
+    # {(chunk ID, class, is a LIST, codec): kind number}
+    self._kind_numbers = {}
+    # (chunk ID, class, is a LIST, codec or None) per kind.
+    self._kinds = []
+    # The field columns of each kind with a codec, None for the others.
+    self._columns = []
+    self._types = array.array('H')
+    self._sizes = array.array('I')
+    self._offsets = array.array('L')
+    self._data = bytearray()
+    self._count = 0
+
+  def _GetClass(self, chunk_type):
+    """Returns the class which models an element.
+
+    Args:
+      chunk_type: str, the chunk ID, or the list type for a LIST.
+
+    Returns:
+      class, a Chunk subclass.
+    """
+    return _ChunkClass(self.__class__, chunk_type, self._CLASSES,
+                       self._CHUNKBASE)
+
+  def _KindOf(self, chunk_id, chunk_class, is_list, size):
+    """Returns the number of the kind of an element, adding it if new.
+
+    Args:
+      chunk_id: str, the chunk ID, or the list type for a LIST.
+      chunk_class: class, the class which models the element.
+      is_list: bool, True if the element is a LIST.
+      size: int, the size of the element's data.
+
+    Returns:
+      int
+    """
+    codec = chunk_class._STRUCT
+    if (is_list or codec is None or codec.size != size or
+        not chunk_class.__slots__ or
+        chunk_class._Pack.im_func is not Struct._Pack.im_func or
+        chunk_class._Unpack.im_func is not Struct._Unpack.im_func):
+      codec = None
+    key = (chunk_id, chunk_class, is_list, codec)
+    kind = self._kind_numbers.get(key)
+    if kind is None:
+      kind = self._kind_numbers[key] = len(self._kinds)
+      self._kinds.append(key)
+      columns = None
+      if codec is not None:
+        columns = []
+        for code in _ParseFormat(chunk_class._FORMAT)[1]:
+          typecode = _ARRAY_TYPECODES.get(code)
+          if typecode:
+            columns.append(array.array(typecode))
+          else:
+            columns.append([])
+      self._columns.append(columns)
+    return kind
+
+  def _Store(self, item):
+    """Stores the data of a chunk.
+
+    Args:
+      item: Chunk, the chunk.
+
+    Returns:
+      tuple, (int, int, int), the kind, data size and offset of the element.
+    """
+    is_list = isinstance(item, LIST)
+    if is_list:
+      buf = bytearray()
+      item.PackTo(buf)
+      size = len(buf) - 8
+      kind = self._KindOf(item.ID, item.__class__, True, size)
+      offset = len(self._data)
+      self._data += buf
+      return kind, size, offset
+    if _hook is None:
+      packed = item._Pack()
+    else:
+      packed = _Encode(item)
+    size = len(packed)
+    kind = self._KindOf(item.ID, item.__class__, False, size)
+    columns = self._columns[kind]
+    if columns is not None:
+      offset = len(columns[0])
+      for column, value in zip(columns, item._Values()):
+        column.append(value)
+    else:
+      offset = len(self._data)
+      self._data += packed
+    return kind, size, offset
+
+  def __len__(self):
+    return self._count
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(self._count))]
+    if index < 0:
+      index += self._count
+    if not 0 <= index < self._count:
+      raise IndexError('ChunkTable index out of range')
+    chunk_id, chunk_class, is_list, codec = self._kinds[self._types[index]]
+    offset = self._offsets[index]
+    if codec is not None:
+      row = [column[offset] for column in self._columns[self._types[index]]]
+      return chunk_class.FromTuples([row])[0]
+    size = self._sizes[index]
+    if is_list:
+      data = str(buffer(self._data, offset, size + 8))
+      if chunk_class._HEADER:
+        return chunk_class(stream=StringIO(data))
+    else:
+      data = str(buffer(self._data, offset, size))
+    return chunk_class(raw_data=data)
+
+  def __iter__(self):
+    return (self[index] for index in xrange(self._count))
+
+  def __setitem__(self, index, item):
+    self._CheckItem(item)
+    if index < 0:
+      index += self._count
+    if not 0 <= index < self._count:
+      raise IndexError('ChunkTable index out of range')
+    kind, size, offset = self._Store(item)
+    self._types[index] = kind
+    self._sizes[index] = size
+    self._offsets[index] = offset
+    self._Invalidate()
+
+  def append(self, item):
+    self._CheckItem(item, 'append')
+    if not self._count:
+      self._Clear()
+    kind, size, offset = self._Store(item)
+    self._types.append(kind)
+    self._sizes.append(size)
+    self._offsets.append(offset)
+    self._count += 1
+    self._Invalidate()
+
+  def insert(self, pos, item):
+    self._CheckItem(item, 'insert')
+    if not self._count:
+      self._Clear()
+    if pos < 0:
+      pos = max(0, pos + self._count)
+    pos = min(pos, self._count)
+    kind, size, offset = self._Store(item)
+    self._types.insert(pos, kind)
+    self._sizes.insert(pos, size)
+    self._offsets.insert(pos, offset)
+    self._count += 1
+    self._Invalidate()
+
+  def __delitem__(self, index):
+    if not isinstance(index, slice):
+      if index < 0:
+        index += self._count
+      if not 0 <= index < self._count:
+        raise IndexError('ChunkTable index out of range')
+    elif not self._count:
+      return
+    del self._types[index]
+    del self._sizes[index]
+    del self._offsets[index]
+    self._count = len(self._types)
+    self._Invalidate()
+
+  def remove(self, item):
+    """Removes the first element with the same ID and data as item.
+
+    Elements are copies, so they are matched by their packed data rather
+    than by identity.
+    """
+    packed = repr(item)
+    for index in xrange(self._count):
+      if (self._kinds[self._types[index]][0] == item.ID and
+          repr(self[index]) == packed):
+        del self[index]
+        return
+    raise ValueError('ChunkTable.remove(x): x not in table')
+
+  def pop(self, index=-1):
+    item = self[index]
+    del self[index]
+    return item
+
+  def PackTo(self, buf):
+    start = len(buf)
+    buf += _LIST_HEADER.pack(self._HEADER, 0, self.ID)
+    kinds = self._kinds
+    pack_header = _CHUNK_HEADER.pack
+    data = self._data
+    for i in xrange(self._count):
+      kind = self._types[i]
+      chunk_id, _, is_list, codec = kinds[kind]
+      size = self._sizes[i]
+      offset = self._offsets[i]
+      if codec is not None:
+        buf += pack_header(chunk_id, size)
+        buf += codec.pack(*[column[offset] for column in self._columns[kind]])
+      elif is_list:
+        buf += buffer(data, offset, size + 8)
+      else:
+        buf += pack_header(chunk_id, size)
+        buf += buffer(data, offset, size)
+      if size % 2:
+        buf.append(0)
+    _SIZE.pack_into(buf, start + 4, len(buf) - start - 8)
+
+  def _ComputeLength(self):
+    length = 12
+    for size in self._sizes:
+      length += 8 + size + size % 2
+    return length
+
+
 class RIFF(LIST):
   """Models a RIFF form."""
 
@@ -272,27 +1493,110 @@ class RIFF(LIST):
                 filename - str, the name of the RIFF file.
                 stream - any file-like object, must support read, seek,
                          and tell at a minimum. Superceded by filename.
+                lazy - bool, if True elements are read on first access.
+                       A file opened from filename is then kept open until
+                       Close is called.
+                mmap - bool, if True the file named by filename is
+                       memory-mapped, and chunk data is exposed as buffers
+                       into the map rather than copied. The map is kept
+                       open until Close is called.
+                index - ChunkIndex, the chunk locations within the file, as
+                        returned by ChunkIndex.Open. Elements are read
+                        lazily from these locations without reading any
+                        chunk headers.
+                buffered - bool, if True the stream is read forward only,
+                           in large blocks, through a ReadAheadStream. A
+                           stream which cannot seek, such as a pipe, can
+                           then be read, though not lazily.
+                select - sequence of strs, the paths of the only chunks to
+                         read, as for LIST.
+                shared - bool, if True the file named by filename is read
+                         through a PositionalFile, with no shared stream
+                         position, so that elements can be loaded by many
+                         threads at once. Implies lazy.
 
     """
     filename = kwargs.pop('filename', None)
     stream = kwargs.pop('stream', None)
-    if filename:
-      stream = open(filename)
+    lazy = kwargs.pop('lazy', False)
+    use_mmap = kwargs.pop('mmap', False)
+    index = kwargs.pop('index', None)
+    buffered = kwargs.pop('buffered', False) and not use_mmap
+    select = kwargs.get('select')
+    shared = kwargs.pop('shared', False)
+    if index is not None or shared:
+      lazy = True
+    self._file = None
+    self._map = None
+    self._shared = None
+    if filename and shared:
+      self._shared = PositionalFile(filename)
+      stream = self._shared.Cursor()
+      use_mmap = buffered = False
+    elif filename:
+      if buffered:
+        # The ReadAheadStream does the buffering.
+        stream = open(filename, 'rb', 0)
+      else:
+        stream = open(filename, 'rb')
+      if use_mmap:
+        self._file = stream
+        self._map = stream = mmap.mmap(stream.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+    opened = stream
+    source = None
+    if filename and not use_mmap and _cache is not None:
+      source = _FileSource(filename, stream)
     if stream:
-      LIST.__init__(self, stream=stream)
-    if filename:
-      stream.close()
+      if _hook is not None and not isinstance(stream, CountingStream):
+        stream = CountingStream(stream)
+      if buffered and not isinstance(stream, ReadAheadStream):
+        stream = ReadAheadStream(stream)
+      LIST.__init__(self, stream=stream, lazy=lazy, index=index,
+                    select=select, source=source)
+      # An RF64 form is always read lazily, whatever was asked for.
+      lazy = self._lazy
+    if filename and not use_mmap and not shared:
+      if lazy:
+        self._file = opened
+      else:
+        opened.close()
     if not (filename or stream):
       LIST.__init__(self, *args, **kwargs)
 
+  def Close(self):
+    """Closes the file and map kept open for lazy or mapped reading, if any.
+
+    Elements which have not yet been accessed can no longer be read, and
+    buffers into a closed map can no longer be used.
+    """
+    if self._map:
+      self._map.close()
+      self._map = None
+    if self._shared:
+      self._shared.Close()
+      self._shared = None
+    if self._file:
+      self._file.close()
+      self._file = None
+
   def Save(self, filename):
     """Writes the RIFF data to a file.
 
+    The data is written one chunk at a time, so the whole form is never
+    held in memory in packed form. A form read from RF64 is written so that
+    it is promoted to RF64 again if it is over 4 GB.
+
     Args:
       filename: str, the name of the file to write.
     """
-    f = open(filename, 'w')
-    f.write(repr(self))
+    f = open(filename, 'wb')
+    writer = RIFFWriter(f, self.ID, rf64=self._ds64 is not None)
+    if self._ds64 is not None:
+      writer.sample_count = self._ds64.sample_count
+    for item in self:
+      writer.WriteChunk(item)
+    writer.Close()
     f.close()
 
 
@@ -317,11 +1621,162 @@ class ZeroPaddedString(Chunk):
     return tuple(dlist)
 
 
-class ChunkFactory(list):
-  """Automatic Chunk initialiser."""
+class DataStruct(Chunk):
+  """Models a Chunk of opaque data, exposed through the data accessor.
 
-  def __init__(self, caller, stream, datadict=None, chunkbase=False):
-    """Constructor.
+  When read from a memory-mapped RIFF, data is a buffer into the map, so the
+  chunk costs no heap memory until its data is used.
+  """
+
+  __slots__ = ('data',)
+
+  def _Pack(self):
+    return str(self.data)
+
+  def _PackedSize(self):
+    return len(self.data)
+
+  def _Unpack(self, data):
+    return (data,)
+
+
+class DS64(Chunk):
+  """Models the ds64 chunk which holds the 64-bit sizes of an RF64 form.
+
+  table is a list of (chunk ID, size) pairs for chunks other than data whose
+  32-bit size field is 0xFFFFFFFF.
+  """
+
+  ID = 'ds64'
+  __slots__ = ('riff_size', 'data_size', 'sample_count', 'table')
+  _FORMAT = '<QQQI'
+  _TABLE_FORMAT = '<4sQ'
+
+  def _Pack(self):
+    data = [struct.pack(self._FORMAT, self.riff_size, self.data_size,
+                        self.sample_count, len(self.table))]
+    for entry in self.table:
+      data.append(struct.pack(self._TABLE_FORMAT, *entry))
+    return ''.join(data)
+
+  def _Unpack(self, data):
+    riff_size, data_size, sample_count, count = struct.unpack_from(
+        self._FORMAT, data)
+    entry_size = struct.calcsize(self._TABLE_FORMAT)
+    table = [struct.unpack_from(self._TABLE_FORMAT, data,
+                                self._STRUCT.size + i * entry_size)
+             for i in xrange(count)]
+    return (riff_size, data_size, sample_count, table)
+
+  def Sizes(self):
+    """Returns the 64-bit sizes of the form's chunks.
+
+    Returns:
+      dict, {'chunk ID': size}.
+    """
+    sizes = dict(self.table)
+    sizes['data'] = self.data_size
+    return sizes
+
+
+class ChunkRef(object):
+  """Records the location of a chunk which has not yet been read."""
+
+  __slots__ = ('ID', 'chunk_class', 'stream', 'offset', 'size', 'index',
+               'entry', 'source')
+
+  def __init__(self, chunk_id, chunk_class, stream, offset, size, index=None,
+               entry=None, source=None):
+    """Constructor.
+
+    Args:
+      chunk_id: str, the chunk ID, or the list type for a LIST.
+      chunk_class: class, models the chunk.
+      stream: file-like, must support read, seek, and tell. Contains the raw
+              chunk data.
+      offset: int, the stream offset of the chunk header.
+      size: int, the data size given in the chunk header.
+      index: ChunkIndex, if present a LIST is read from the index rather than
+             from its chunk headers.
+      entry: int, the number of the chunk's entry in index.
+      source: tuple, identifies the file being read, for the chunk cache.
+    """
+    self.ID = chunk_id
+    self.chunk_class = chunk_class
+    self.stream = stream
+    self.offset = offset
+    self.size = size
+    self.index = index
+    self.entry = entry
+    self.source = source
+
+  def _GetLength(self):
+    """Returns the length the chunk occupies in the stream.
+
+    Returns:
+      int
+    """
+    return 8 + self.size + self.size % 2
+  length = property(_GetLength, None, None, None)
+
+  def Load(self):
+    """Reads and initialises the chunk.
+
+    A LIST with a header is itself read lazily.
+
+    Returns:
+      Chunk, the initialised chunk.
+    """
+    stream = self.stream
+    chunk_class = self.chunk_class
+    cache = None
+    if self.source is not None:
+      cache = _cache
+    if issubclass(chunk_class, LIST) and chunk_class._HEADER:
+      if self.index is None:
+        stream = _OwnStream(stream, self.offset)
+      probe = None
+      if _hook is not None:
+        probe = _Probe(stream)
+      if self.index is not None:
+        chunk = chunk_class(stream=stream, index=self.index, entry=self.entry,
+                            source=self.source)
+      else:
+        chunk = chunk_class(stream=stream, lazy=True, source=self.source)
+    else:
+      if cache is not None:
+        chunk = cache.Get(self.source, self.offset, chunk_class)
+        if chunk is not None:
+          return chunk
+      stream = _OwnStream(stream, self.offset)
+      probe = None
+      if _hook is not None:
+        # Counted on the stream actually read, which may be a new one.
+        probe = _Probe(stream)
+      if issubclass(chunk_class, LIST) and stream.read(4) in ('LIST', 'RIFF'):
+        # As in ChunkFactory, a header-less LIST is given its header too.
+        stream.seek(self.offset)
+        data = stream.read(self.size + 8)
+      else:
+        stream.seek(self.offset + 8)
+        data = _ReadData(stream, self.size)
+      if probe is not None:
+        probe.Report(READ, self.ID, chunk_class, self.size)
+      chunk = chunk_class(raw_data=data)
+      if cache is not None:
+        cache.Put(self.source, self.offset, chunk, data)
+    if probe is not None:
+      probe.Report(DECODE, self.ID, chunk_class, self.size)
+    return chunk
+
+
+class ChunkFactory(list):
+  """Automatic Chunk initialiser."""
+
+  def __init__(self, caller, stream, datadict=None, chunkbase=False,
+               end=None, lazy=False, index=None, entry=None, sizes=None,
+               select=None, source=None):
+    """Constructor.
 
     Args:
       caller: object, the calling RIFF or LIST.
@@ -330,56 +1785,2013 @@ class ChunkFactory(list):
       datadict: dict, {'chunk ID': class_object}.
       chunkbase: class, the base for chunk classes to be automatically created
                  for chunk IDs absent in datadict.
+      end: int, the stream offset at which to stop reading, or None to read
+           until the end of the stream.
+      lazy: bool, if True record a ChunkRef for each chunk instead of reading
+            its data.
+      index: ChunkIndex, if present record a ChunkRef for each child of the
+             index entry numbered entry, without reading stream.
+      entry: int, the number of the caller's entry in index.
+      sizes: dict, {'chunk ID': size}, the real sizes of chunks whose size
+             field is 0xFFFFFFFF. Such chunks are always recorded as a
+             ChunkRef, so they are never read unless accessed.
+      select: list of tuples, the compiled paths of the chunks to read, or
+              None to read every chunk. None is recorded for the others.
+      source: tuple, identifies the file being read, for the chunk cache, or
+              None if it is not to be cached.
     """
     self._caller = caller
+    self._select = select
+    self._source = source
     self._stream = stream
     self._datadict = datadict
     self._chunkbase = chunkbase
-    self._Read()
+    self._end = end
+    self._lazy = lazy
+    self._sizes = sizes
+    if index is not None:
+      self._ReadIndex(index, entry)
+    else:
+      self._Read()
 
   def _Read(self):
     """Reads and initialises the chunks."""
     stream = self._stream
+    end = self._end
+    sizes = self._sizes
+    select = self._select
+    source = self._source
+    cache = None
+    if source is not None:
+      cache = _cache
+    padded = False
+    hook = _hook
 
     while True:
+      if hook is not None:
+        probe = _Probe(stream)
+      offset = stream.tell()
+      if end is not None and offset >= end:
+        break
       data = stream.read(8)
+      if padded and data[:1] == '\0':
+        # Skip the pad byte which follows a chunk of odd size.
+        offset += 1
+        if end is not None and offset >= end:
+          break
+        data = data[1:] + stream.read(1)
       if not data:
         break
       chunk_type, size = struct.unpack('<4sI', data)
-
-      if chunk_type == 'LIST' or chunk_type == 'RIFF':
+      oversized = (size == 0xFFFFFFFF and sizes is not None and
+                   chunk_type in sizes)
+      if oversized:
+        size = sizes[chunk_type]
+      padded = size % 2
+
+      if chunk_type == _JUNK:
+        # Filler, such as space left by RIFFEditor; not an element.
+        stream.seek(offset + 8 + size)
+        continue
+
+      is_list = chunk_type == 'LIST' or chunk_type == 'RIFF'
+      if is_list:
         list_type, = struct.unpack('4s', stream.read(4))
         # LIST-types don't have an explicit size
         # (the LIST itself does, of course, since that's a Chunk)
         # the size needs to apply to the next-read chunk
         chunk_type = list_type
 
-        # Rewind the 8 we read for the header, and 4 for the list type.
-        # Add to the size to read those bytes again.
-        size += 8
-        stream.seek(stream.tell() - 12)
-
-      chunk_class = self._datadict.get(chunk_type, None)
-
-      if not chunk_class:
-        if self._chunkbase:
-          module = sys.modules[self._caller.__module__]
-          cls_name = '_auto__%s__%s' % (self._caller.__class__.__name__,
-                                        chunk_type)
-          cls_str = """class %s(%s):
-                         ID = '%s'
-                         pass""" % (cls_name, self._chunkbase.__name__,
-                                    chunk_type)
-          cls_code = compile(cls_str, '__string__', 'single', 0, 1)
-          eval(cls_code, module.__dict__)
-          chunk_class = module.__dict__[cls_name]
+      inner = None
+      if select is not None:
+        inner = _SelectWithin(select, chunk_type)
+        if inner == [] or (inner is not None and not is_list):
+          # Not selected, nor a LIST holding a selected chunk.
+          self.append(None)
+          stream.seek(offset + 8 + size)
+          continue
+
+      chunk_class = self._GetClass(chunk_type)
+
+      if inner is not None:
+        if not chunk_class._HEADER:
+          self.append(None)
+          stream.seek(offset + 8 + size)
+          continue
+        stream.seek(offset)
+        self.append(chunk_class(stream=stream, select=inner, source=source))
+        stream.seek(offset + 8 + size)
+
+      elif self._lazy or oversized:
+        self.append(ChunkRef(chunk_type, chunk_class, stream, offset, size,
+                             source=source))
+        stream.seek(offset + 8 + size)
+        if hook is not None:
+          probe.Report(READ, chunk_type, chunk_class, 8)
+
+      elif is_list and chunk_class._HEADER:
+        if hook is not None:
+          probe.Report(READ, chunk_type, chunk_class, 12)
+        # Read nested lists in place rather than copying their data.
+        stream.seek(offset)
+        self.append(chunk_class(stream=stream, source=source))
+        stream.seek(offset + 8 + size)
+        if hook is not None:
+          probe.Report(DECODE, chunk_type, chunk_class, size)
+
+      else:
+        if cache is not None:
+          chunk = cache.Get(source, offset, chunk_class)
+          if chunk is not None:
+            self.append(chunk)
+            stream.seek(offset + 8 + size)
+            continue
+        if is_list:
+          # Rewind the 8 we read for the header, and 4 for the list type.
+          # Add to the size to read those bytes again.
+          size += 8
+          stream.seek(offset)
+        chunk_data = _ReadData(stream, size)
+        if hook is not None:
+          probe.Report(READ, chunk_type, chunk_class, size + 8)
+        chunk = chunk_class(raw_data=chunk_data)
+        self.append(chunk)
+        if hook is not None:
+          probe.Report(DECODE, chunk_type, chunk_class, size)
+        if cache is not None:
+          cache.Put(source, offset, chunk, chunk_data)
+
+  def _ReadIndex(self, index, entry):
+    """Records a ChunkRef for each chunk listed in an index.
 
-        else:
-          raise AttributeError('Object has no class defined for chunk-id %s' %
-                               (chunk_type))
+    Args:
+      index: ChunkIndex, the chunk locations.
+      entry: int, the number of the caller's entry in index.
+    """
+    stream = self._stream
+    select = self._select
+    rf64 = index.entries[entry][0] in _RF64_HEADERS
+    for child in index.Children(entry):
+      header, chunk_type, offset, size, parent = index.entries[child]
+      if rf64 and header == 'ds64':
+        # Read as part of the form header, not as an element.
+        continue
+      if header == _JUNK:
+        continue
+      if select is not None and _SelectWithin(select, chunk_type) == []:
+        self.append(None)
+        continue
+      self.append(ChunkRef(chunk_type, self._GetClass(chunk_type), stream,
+                           offset, size, index=index, entry=child,
+                           source=self._source))
+
+  def _GetClass(self, chunk_type):
+    """Returns the class which models a chunk.
+
+    Args:
+      chunk_type: str, the chunk ID, or the list type for a LIST.
+
+    Returns:
+      class, a Chunk subclass.
+
+    Raises:
+      AttributeError, if there is no class for chunk_type and no chunkbase.
+    """
+    return _ChunkClass(self._caller.__class__, chunk_type, self._datadict,
+                       self._chunkbase)
+
+
+def _ChunkClass(container, chunk_type, datadict, chunkbase):
+  """Returns the class which models a chunk within a list.
+
+  Args:
+    container: class, the RIFF or LIST class containing the chunk.
+    chunk_type: str, the chunk ID, or the list type for a LIST.
+    datadict: dict, {'chunk ID': class_object}.
+    chunkbase: class, the base for auto-classes, or None.
+
+  Returns:
+    class, a Chunk subclass.
+
+  Raises:
+    AttributeError, if there is no class for chunk_type and no chunkbase.
+  """
+  chunk_class = datadict.get(chunk_type, None)
+
+  if not chunk_class:
+    if chunkbase:
+      chunk_class = AutoClass(container, chunk_type, chunkbase=chunkbase)
+
+    else:
+      raise AttributeError('Object has no class defined for chunk-id %s' %
+                           (chunk_type))
+
+  return chunk_class
+
+
+def _CompileSelect(paths):
+  """Splits chunk paths into their IDs.
+
+  Args:
+    paths: sequence of strs, e.g. ['dwrf/doc_', 'addr'], or of tuples of
+           strs as returned by this function.
+
+  Returns:
+    list of tuples of strs, e.g. [('dwrf', 'doc_'), ('addr',)].
+  """
+  if isinstance(paths, basestring):
+    paths = [paths]
+  return [isinstance(path, tuple) and path or tuple(path.strip('/').split('/'))
+          for path in paths]
+
+
+def _SelectWithin(select, chunk_id):
+  """Returns the selected paths which lie within a chunk.
+
+  Args:
+    select: list of tuples, compiled paths, as returned by _CompileSelect.
+    chunk_id: str, the chunk ID, or the list type for a LIST.
+
+  Returns:
+    None if the whole chunk is selected, or else a list of the paths below
+    the chunk, which is empty if nothing within it is selected.
+  """
+  inner = []
+  for path in select:
+    if fnmatch.fnmatchcase(chunk_id, path[0]):
+      if len(path) == 1:
+        return None
+      inner.append(path[1:])
+  return inner
+
+
+def Select(form_class, paths, **kwargs):
+  """Reads only the chunks at the given paths from a RIFF form.
+
+  Args:
+    form_class: class, the RIFF subclass modelling the form.
+    paths: sequence of strs, chunk paths as for the select argument of LIST.
+    kwargs: dict, passed on to form_class, e.g. filename or stream.
+
+  Returns:
+    list of Chunks, the selected chunks in stream order.
+  """
+  selected = []
+  def Collect(chunk, select):
+    for item in chunk:
+      if item is None:
+        continue
+      inner = _SelectWithin(select, item.ID)
+      if inner is None:
+        selected.append(item)
+      elif inner:
+        Collect(item, inner)
+  select = _CompileSelect(paths)
+  Collect(form_class(select=select, **kwargs), select)
+  return selected
+
+
+_RF64_HEADERS = ('RF64', 'BW64')
+
+ENTER_LIST = 'enter'
+CHUNK = 'chunk'
+EXIT_LIST = 'exit'
+
+
+def Walk(stream):
+  """Generates an event for each chunk in a stream, reading only headers.
+
+  Each event is a tuple (event, header, chunk ID, offset, size):
+    event - ENTER_LIST at the start of a RIFF or LIST, EXIT_LIST at its end,
+            and CHUNK for any other chunk.
+    header - 'RIFF', 'RF64', 'BW64' or 'LIST' for lists, the chunk ID
+             otherwise.
+    chunk ID - the list type for lists.
+    offset - the stream offset of the chunk header.
+    size - the data size from the chunk header, or from the ds64 chunk for
+           RF64 forms and the oversized chunks within them.
+
+  No chunk objects are created. When a CHUNK event is generated the stream is
+  positioned at the start of the chunk data, which may be read before asking
+  for the next event; the walk carries on from the next chunk header either
+  way. For example, to checksum the data of every chunk:
+
+    for event, _, chunk_id, _, size in riff.Walk(f):
+      if event == riff.CHUNK:
+        sums[chunk_id] = zlib.crc32(f.read(size))
+
+  Args:
+    stream: file-like, must support read, seek, and tell, positioned at the
+            start of a RIFF form. Forms are read until the end of the stream.
+
+  Yields:
+    tuple, as described above.
+  """
+  lists = []
+  offset = stream.tell()
+  padded = False
+  sizes = {}
+
+  while True:
+    if lists and offset >= lists[-1][4]:
+      header, list_type, list_offset, size, _ = lists.pop()
+      yield EXIT_LIST, header, list_type, list_offset, size
+      continue
+    stream.seek(offset)
+    data = stream.read(8)
+    if padded and data[:1] == '\0':
+      # Skip the pad byte which follows a chunk of odd size.
+      offset += 1
+      padded = False
+      continue
+    if len(data) < 8:
+      break
+    chunk_type, size = struct.unpack('<4sI', data)
+    if (size == 0xFFFFFFFF and len(lists) == 1 and
+        lists[0][0] in _RF64_HEADERS):
+      size = sizes.get(chunk_type, size)
+    padded = size % 2
+    if chunk_type in _RF64_HEADERS:
+      list_type = stream.read(4)
+      ds64 = DS64(stream=stream)
+      size = ds64.riff_size
+      sizes = ds64.Sizes()
+      lists.append((chunk_type, list_type, offset, size, offset + 8 + size))
+      yield ENTER_LIST, chunk_type, list_type, offset, size
+      offset += 12
+    elif chunk_type == 'LIST' or chunk_type == 'RIFF':
+      list_type = stream.read(4)
+      lists.append((chunk_type, list_type, offset, size, offset + 8 + size))
+      yield ENTER_LIST, chunk_type, list_type, offset, size
+      offset += 12
+    else:
+      yield CHUNK, chunk_type, chunk_type, offset, size
+      offset += 8 + size
+
+  # Close any lists cut short by the end of the stream.
+  while lists:
+    header, list_type, list_offset, size, _ = lists.pop()
+    yield EXIT_LIST, header, list_type, list_offset, size
+
+
+_AUTO_CLASSES = {}
+_auto_classes_frozen = False
+
+
+def AutoClass(container, chunk_id, chunkbase=None):
+  """Returns the class which models a chunk absent from a list's _CLASSES.
+
+  The class is created from the list's _CHUNKBASE the first time it is needed
+  and reused for every later chunk with the same ID in the same kind of list.
+
+  Args:
+    container: class, the RIFF or LIST class containing the chunk.
+    chunk_id: str, the chunk ID.
+    chunkbase: class, the base for the new class. Defaults to the container's
+               _CHUNKBASE.
+
+  Returns:
+    class, a subclass of chunkbase with ID set to chunk_id.
+
+  Raises:
+    AttributeError, if the class does not exist and auto-classes are frozen.
+  """
+  key = (container, chunk_id)
+  chunk_class = _AUTO_CLASSES.get(key)
+  if chunk_class is None:
+    if _auto_classes_frozen:
+      raise AttributeError('Object has no class defined for chunk-id %s' %
+                           (chunk_id))
+    if chunkbase is None:
+      chunkbase = container._CHUNKBASE
+    cls_name = '_auto__%s__%s' % (container.__name__, chunk_id)
+    chunk_class = type(chunkbase)(cls_name, (chunkbase,),
+                                  {'ID': chunk_id,
+                                   '__module__': container.__module__})
+    chunk_class = _AUTO_CLASSES.setdefault(key, chunk_class)
+    # Publish the class in the container's module so it can be pickled.
+    setattr(sys.modules[container.__module__], cls_name, chunk_class)
+  return chunk_class
+
+
+def PreloadAutoClasses(container, chunk_ids=None):
+  """Creates the auto-classes for a list before any data is read.
+
+  Args:
+    container: class, a RIFF or LIST class with a _CHUNKBASE.
+    chunk_ids: sequence of strs, the chunk IDs to create classes for. Defaults
+               to the container's __slots__ which are not in its _CLASSES.
+  """
+  if chunk_ids is None:
+    chunk_ids = [slot for slot in container.__slots__
+                 if slot not in container._CLASSES]
+  for chunk_id in chunk_ids:
+    AutoClass(container, chunk_id)
+
+
+def FreezeAutoClasses(frozen=True):
+  """Stops, or with frozen=False resumes, the creation of new auto-classes.
+
+  While frozen, reading a chunk with no existing class raises AttributeError,
+  as it would for a list without _CHUNKBASE.
+
+  Args:
+    frozen: bool.
+  """
+  global _auto_classes_frozen
+  _auto_classes_frozen = frozen
+
+
+READ = 'read'
+DECODE = 'decode'
+ENCODE = 'encode'
+
+_hook = None
+
+
+def SetHook(hook):
+  """Installs a function to be told about every chunk read, decoded or encoded.
+
+  The hook is called as hook(event, chunk_id, chunk_class, nbytes, seconds,
+  reads, seeks), where event is one of:
+    READ - the chunk header, and the chunk data unless it is read lazily or
+           is a LIST read in place, has been read. nbytes is the number of
+           bytes read.
+    DECODE - the chunk object has been initialised from its data. nbytes is
+             the data size. For a LIST the time includes its elements.
+    ENCODE - the chunk data has been packed. nbytes is the data size.
+  seconds is the time taken, and reads and seeks count the calls made to the
+  stream, which are only known for a stream wrapped in a CountingStream.
+  A RIFF wraps its stream automatically if a hook is installed when it is
+  created; chunk data is then copied from a memory map rather than exposed
+  as buffers.
+
+  With no hook installed the cost is one test per chunk.
+
+  Args:
+    hook: callable, or None to remove the hook.
+
+  Returns:
+    callable, the hook previously installed, or None.
+  """
+  global _hook
+  previous = _hook
+  _hook = hook
+  return previous
+
+
+class CountingStream(object):
+  """Wraps a stream, counting the calls to read and seek and the bytes read."""
+
+  def __init__(self, stream):
+    """Constructor.
+
+    Args:
+      stream: file-like, the stream to wrap.
+    """
+    self.stream = stream
+    self.bytes_read = 0
+    self.reads = 0
+    self.seeks = 0
+
+  def read(self, *args):
+    data = self.stream.read(*args)
+    self.reads += 1
+    self.bytes_read += len(data)
+    return data
+
+  def seek(self, *args):
+    self.seeks += 1
+    return self.stream.seek(*args)
+
+  def tell(self):
+    return self.stream.tell()
+
+  def __getattr__(self, key):
+    return getattr(self.stream, key)
+
+
+class ReadAheadStream(object):
+  """Wraps a stream so that it is read forward only, in large blocks.
+
+  Small reads, such as those of chunk headers, are served from a buffer
+  filled block_size bytes at a time. Reads of a block or more go straight to
+  the wrapped stream. The end of the previous block is kept when the buffer
+  is refilled, so the parsers' short seeks back to re-read a LIST header need
+  no call to the wrapped stream.
+
+  A seek outside the buffer moves the wrapped stream if it can seek.
+  Otherwise a forward seek reads and discards the data in between, and a
+  backward seek raises IOError.
+  """
+
+  _BLOCK_SIZE = 1 << 18
+  # The bytes kept before the current position when the buffer is refilled.
+  _LOOK_BEHIND = 64
+
+  def __init__(self, stream, block_size=_BLOCK_SIZE):
+    """Constructor.
+
+    Args:
+      stream: file-like, must support read.
+      block_size: int, the size of the reads made from stream.
+    """
+    self.stream = stream
+    self.block_size = block_size
+    try:
+      self._base = stream.tell()
+    except (IOError, AttributeError):
+      self._base = 0
+    # The buffer holds the data from stream offset _base.
+    self._buffer = ''
+    self._pos = 0
+
+  def tell(self):
+    return self._base + self._pos
+
+  def read(self, size=-1):
+    buf = self._buffer
+    pos = self._pos
+    if 0 <= size <= len(buf) - pos:
+      self._pos = pos + size
+      return buf[pos:pos + size]
+
+    keep = max(0, pos - self._LOOK_BEHIND)
+    head = buf[pos:]
+    need = size - len(head)
+    if size < 0 or need >= self.block_size:
+      if size < 0:
+        tail = self.stream.read()
+      else:
+        tail = self.stream.read(need)
+      data = head + tail
+      if len(data) < self._LOOK_BEHIND:
+        self._buffer = buf[keep:pos] + data
+      else:
+        self._buffer = data[-self._LOOK_BEHIND:]
+      self._base += len(buf) + len(tail) - len(self._buffer)
+      self._pos = len(self._buffer)
+      return data
+
+    block = self.stream.read(self.block_size)
+    while 0 < len(block) < need:
+      more = self.stream.read(self.block_size)
+      if not more:
+        break
+      block += more
+    self._buffer = buf[keep:] + block
+    self._base += keep
+    self._pos = min(pos - keep + size, len(self._buffer))
+    return self._buffer[pos - keep:self._pos]
+
+  def seek(self, offset, whence=0):
+    if whence == 1:
+      offset += self.tell()
+    elif whence == 2:
+      self.stream.seek(offset, 2)
+      offset = self.stream.tell()
+    if whence != 2 and self._base <= offset <= self._base + len(self._buffer):
+      self._pos = offset - self._base
+      return
+    try:
+      self.stream.seek(offset)
+    except (IOError, AttributeError):
+      position = self.tell()
+      if offset < position:
+        raise IOError('Cannot seek back from %d to %d in a forward-only'
+                      ' stream' % (position, offset))
+      while position < offset:
+        skipped = self.read(min(offset - position, self.block_size))
+        if not skipped:
+          break
+        position += len(skipped)
+      return
+    self._base = offset
+    self._buffer = ''
+    self._pos = 0
+
+  def __getattr__(self, key):
+    return getattr(self.stream, key)
+
+
+class PositionalFile(object):
+  """Reads a file at given offsets, with no position shared between readers.
+
+  The file is memory-mapped, and each read copies a slice of the map, so
+  any number of threads can read at once. A file which cannot be mapped,
+  such as an empty one, is read with a seek and a read under a lock.
+
+  The parsers read through a FileCursor, a stream with its own position.
+  A ChunkRef whose stream is a cursor reads through a new cursor each time
+  it is loaded, so one lazily read RIFF can load its elements from many
+  threads; see the shared argument of RIFF.
+  """
+
+  def __init__(self, filename, use_mmap=True):
+    """Constructor.
+
+    Args:
+      filename: str, the name of the file.
+      use_mmap: bool, if False the file is always read under a lock.
+    """
+    self.name = filename
+    self._file = open(filename, 'rb')
+    self._lock = threading.Lock()
+    self._map = None
+    if use_mmap:
+      try:
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+      except (ValueError, EnvironmentError):
+        pass
+    if self._map is not None:
+      self.size = len(self._map)
+    else:
+      self.size = os.fstat(self._file.fileno()).st_size
+
+  def ReadAt(self, offset, size):
+    """Reads from an offset, without changing any stream position.
+
+    Args:
+      offset: int, the file offset.
+      size: int, the number of bytes to read; fewer are returned at the end
+            of the file.
+
+    Returns:
+      str
+    """
+    if self._map is not None:
+      return self._map[offset:offset + size]
+    self._lock.acquire()
+    try:
+      self._file.seek(offset)
+      return self._file.read(size)
+    finally:
+      self._lock.release()
+
+  def Cursor(self, offset=0):
+    """Returns a new stream over the file.
+
+    Args:
+      offset: int, the initial position of the stream.
+
+    Returns:
+      FileCursor
+    """
+    return FileCursor(self, offset)
+
+  def fileno(self):
+    return self._file.fileno()
+
+  def Close(self):
+    """Closes the map and the file. Cursors can then no longer be read."""
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+    self._file.close()
+
+
+class FileCursor(object):
+  """A stream over a PositionalFile, with a position of its own.
+
+  A cursor is not itself safe to share between threads; each thread reads
+  through cursors of its own, which Cursor provides.
+  """
+
+  def __init__(self, positional_file, offset=0):
+    """Constructor.
+
+    Args:
+      positional_file: PositionalFile, the file.
+      offset: int, the initial position.
+    """
+    self.file = positional_file
+    self._pos = offset
+
+  def read(self, size=-1):
+    if size < 0:
+      size = max(0, self.file.size - self._pos)
+    data = self.file.ReadAt(self._pos, size)
+    self._pos += len(data)
+    return data
+
+  def seek(self, offset, whence=0):
+    if whence == 1:
+      offset += self._pos
+    elif whence == 2:
+      offset += self.file.size
+    self._pos = offset
+
+  def tell(self):
+    return self._pos
+
+  def fileno(self):
+    return self.file.fileno()
+
+  def Cursor(self, offset=0):
+    """Returns a new cursor over the same file.
+
+    Args:
+      offset: int, the initial position of the new cursor.
+
+    Returns:
+      FileCursor
+    """
+    return FileCursor(self.file, offset)
+
+
+def _OwnStream(stream, offset):
+  """Returns a stream positioned at an offset, for the caller alone if it can.
+
+  Args:
+    stream: file-like, the stream.
+    offset: int, the position.
+
+  Returns:
+    file-like, a new cursor if stream is a FileCursor, or a new
+    CountingStream around a new cursor if stream counts the reads of a
+    FileCursor, otherwise stream itself, seeked to offset.
+  """
+  if isinstance(stream, FileCursor):
+    return stream.Cursor(offset)
+  if (isinstance(stream, CountingStream) and
+      isinstance(stream.stream, FileCursor)):
+    return CountingStream(stream.stream.Cursor(offset))
+  stream.seek(offset)
+  return stream
+
+
+def _Counts(stream):
+  """Returns the (bytes read, reads, seeks) counted for a stream so far."""
+  if isinstance(stream, CountingStream):
+    return (stream.bytes_read, stream.reads, stream.seeks)
+  return (0, 0, 0)
+
+
+class _Probe(object):
+  """Measures the steps of reading or writing one chunk, for the hook."""
+
+  __slots__ = ('stream', 'counts', 'start')
+
+  def __init__(self, stream=None):
+    self.stream = stream
+    self.counts = _Counts(stream)
+    self.start = time.time()
+
+  def Report(self, event, chunk_id, chunk_class, size):
+    """Calls the hook with the time and I/O since the last report.
+
+    Args:
+      event: str, READ, DECODE or ENCODE.
+      chunk_id: str, the chunk ID.
+      chunk_class: class, models the chunk.
+      size: int, the data size, reported as the number of bytes read when
+            the stream is not counted.
+    """
+    seconds = time.time() - self.start
+    counts = _Counts(self.stream)
+    nbytes, reads, seeks = [now - then for now, then in zip(counts,
+                                                             self.counts)]
+    if event != READ or not reads:
+      nbytes = size
+    hook = _hook
+    if hook is not None:
+      hook(event, chunk_id, chunk_class, nbytes, seconds, reads, seeks)
+    self.counts = counts
+    self.start = time.time()
+
+
+def _Encode(chunk):
+  """Packs a chunk's data, reporting it to the hook.
+
+  Returns:
+    str, as returned by chunk._Pack.
+  """
+  probe = _Probe()
+  data = chunk._Pack()
+  probe.Report(ENCODE, chunk.ID, chunk.__class__, len(data))
+  return data
+
+
+class Stats(object):
+  """Accumulates the hook's events into totals per chunk ID and class.
+
+  Example:
+
+    stats = riff.Stats()
+    riff.SetHook(stats)
+    form = howto.Dwarves(filename='dwarves.riff')
+    riff.SetHook(None)
+    print stats.Report()
+
+  Attributes:
+    totals: dict, {(chunk ID, class name): dict of counts}. The counts are
+            'decoded' and 'encoded', the number of chunks; 'bytes', 'reads'
+            and 'seeks' from READ events; and 'read_time', 'decode_time' and
+            'encode_time' in seconds.
+  """
+
+  _COUNTS = ('decoded', 'bytes', 'reads', 'seeks', 'read_time', 'decode_time',
+             'encoded', 'encode_time')
+
+  def __init__(self):
+    self.totals = {}
+
+  def __call__(self, event, chunk_id, chunk_class, nbytes, seconds, reads,
+               seeks):
+    key = (chunk_id, chunk_class.__name__)
+    totals = self.totals.get(key)
+    if totals is None:
+      totals = self.totals[key] = dict.fromkeys(self._COUNTS, 0)
+    if event == READ:
+      totals['bytes'] += nbytes
+      totals['reads'] += reads
+      totals['seeks'] += seeks
+      totals['read_time'] += seconds
+    elif event == DECODE:
+      totals['decoded'] += 1
+      totals['decode_time'] += seconds
+    elif event == ENCODE:
+      totals['encoded'] += 1
+      totals['encode_time'] += seconds
+
+  def Reset(self):
+    """Discards all totals."""
+    self.totals.clear()
+
+  def Report(self):
+    """Formats the totals as a table, the most time-consuming first.
+
+    Returns:
+      str
+    """
+    lines = ['%-6s %-24s %8s %10s %7s %7s %8s %8s %8s %8s' %
+             ('id', 'class', 'decoded', 'bytes', 'reads', 'seeks', 'read s',
+              'decode s', 'encoded', 'encode s')]
+    def Cost(item):
+      totals = item[1]
+      return -(totals['read_time'] + totals['decode_time'] +
+               totals['encode_time'])
+    for (chunk_id, class_name), totals in sorted(self.totals.items(),
+                                                 key=Cost):
+      lines.append('%-6r %-24s %8d %10d %7d %7d %8.4f %8.4f %8d %8.4f' %
+                   (chunk_id, class_name[:24], totals['decoded'],
+                    totals['bytes'], totals['reads'], totals['seeks'],
+                    totals['read_time'], totals['decode_time'],
+                    totals['encoded'], totals['encode_time']))
+    return '\n'.join(lines)
+
+
+_cache = None
+
+
+def SetCache(cache):
+  """Installs a cache of decoded chunks, shared by every RIFF read by name.
+
+  While a cache is installed, each chunk read by a RIFF created with a
+  filename (and without mmap) is looked up in the cache before it is read,
+  and stored in it after. Lists are not cached, but their elements are.
+
+  Args:
+    cache: ChunkCache, or None to stop caching.
+
+  Returns:
+    ChunkCache, the cache previously installed, or None.
+  """
+  global _cache
+  previous = _cache
+  _cache = cache
+  return previous
+
+
+def _FileSource(filename, stream):
+  """Returns the key which identifies a version of a file in the cache.
 
-      chunk_data = stream.read(size)
-      self.append(chunk_class(raw_data=chunk_data))
+  Args:
+    filename: str, the name of the file.
+    stream: file, the open file.
+
+  Returns:
+    tuple, (absolute path, device, inode, mtime, size).
+  """
+  st = os.fstat(stream.fileno())
+  return (os.path.abspath(filename), st.st_dev, st.st_ino, st.st_mtime,
+          st.st_size)
+
+
+class ChunkCache(object):
+  """A least-recently-used cache of decoded chunks, with a size budget.
+
+  Entries are keyed by the file's path, inode, mtime and size, the chunk's
+  offset, and the class decoding it, so a file which changes is read afresh.
+  When the budget is exceeded, the least recently used entries are evicted
+  until the cache is within three quarters of its budget.
+  Each lookup returns a new chunk: a plain Chunk is rebuilt from its cached
+  field values without calling _Unpack, and any other chunk, such as a
+  MultiRecordList, is decoded again from its cached data. Field values are
+  shared between the chunks returned, so they should not be changed in
+  place.
+
+  The cache may be used from several threads.
+
+  Attributes:
+    max_bytes: int, the budget. An entry's cost is the size of the chunk
+               data.
+    size: int, the total cost of the entries.
+    hits: int, the number of lookups which found a chunk.
+    misses: int, the number of lookups which did not.
+    evictions: int, the number of entries discarded to keep to the budget.
+  """
+
+  def __init__(self, max_bytes=64 << 20):
+    """Constructor.
+
+    Args:
+      max_bytes: int, the budget.
+    """
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    # {key: [field values, data, cost, last use]}
+    self._entries = {}
+    self._uses = 0
+    self._lock = threading.Lock()
+
+  def Get(self, source, offset, chunk_class):
+    """Returns a chunk from the cache.
+
+    Args:
+      source: tuple, identifies the file, as returned by _FileSource.
+      offset: int, the offset of the chunk header.
+      chunk_class: class, models the chunk.
+
+    Returns:
+      Chunk, a new chunk, or None if there is no entry.
+    """
+    key = (source, offset, chunk_class)
+    self._lock.acquire()
+    try:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._uses += 1
+      entry[3] = self._uses
+      self.hits += 1
+    finally:
+      self._lock.release()
+    values, data = entry[:2]
+    if data is not None:
+      return chunk_class(raw_data=data)
+    chunk = object.__new__(chunk_class)
+    chunk_class._Assign(chunk, values)
+    return chunk
+
+  def Put(self, source, offset, chunk, data):
+    """Stores a chunk in the cache.
+
+    Args:
+      source: tuple, identifies the file, as returned by _FileSource.
+      offset: int, the offset of the chunk header.
+      chunk: Chunk, the decoded chunk.
+      data: str or buffer, the data the chunk was decoded from.
+    """
+    chunk_class = chunk.__class__
+    cost = len(data)
+    if cost > self.max_bytes:
+      return
+    if (isinstance(chunk, LIST) or
+        chunk_class.__init__.im_func is not Struct.__init__.im_func):
+      entry = [None, str(data), cost, 0]
+    else:
+      entry = [chunk._Values(), None, cost, 0]
+    key = (source, offset, chunk_class)
+    self._lock.acquire()
+    try:
+      self._uses += 1
+      entry[3] = self._uses
+      previous = self._entries.get(key)
+      if previous is not None:
+        self.size -= previous[2]
+      self._entries[key] = entry
+      self.size += cost
+      if self.size > self.max_bytes:
+        self._Evict(self.max_bytes * 3 // 4)
+    finally:
+      self._lock.release()
+
+  def _Evict(self, target):
+    """Evicts the least recently used entries down to a total cost.
+
+    Must be called with the lock held.
+
+    Args:
+      target: int, the total cost to keep to.
+    """
+    entries = self._entries
+    by_use = sorted(entries.items(), key=lambda item: item[1][3])
+    for key, entry in by_use:
+      if self.size <= target:
+        break
+      del entries[key]
+      self.size -= entry[2]
+      self.evictions += 1
+
+  def Clear(self):
+    """Discards every entry, keeping the statistics."""
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+      self.size = 0
+    finally:
+      self._lock.release()
+
+  def Stats(self):
+    """Returns the statistics of the cache.
+
+    Returns:
+      dict, with the entries, size, max_bytes, hits, misses and evictions.
+    """
+    return {'entries': len(self._entries), 'size': self.size,
+            'max_bytes': self.max_bytes, 'hits': self.hits,
+            'misses': self.misses, 'evictions': self.evictions}
+
+
+class ChunkIndex(object):
+  """A table of contents of the chunks within a RIFF file.
+
+  Each entry is a tuple (header, chunk ID, offset, size, parent), where header
+  is 'RIFF', 'RF64', 'BW64' or 'LIST' for lists and the chunk ID otherwise,
+  chunk ID is the list type for lists, offset is the file offset of the chunk
+  header, size is the data size as given by Walk, and parent is the number of
+  the entry of the enclosing list, or -1 for the form itself.
+
+  An index can be saved alongside its file, or in a cache directory, and
+  passed to RIFF to open the file again without reading any chunk headers:
+
+    index = riff.ChunkIndex.Open(filename)
+    the_riff = SomeRiff(filename=filename, index=index)
+  """
+
+  _MAGIC = 'RIDX'
+  _VERSION = 2
+  _HEADER_FORMAT = '<4sHQdI'
+  _ENTRY_FORMAT = '<4s4sQQi'
+  _SUFFIX = '.ridx'
+
+  def __init__(self, stream=None, file_size=0, mtime=0.0, entries=None):
+    """Constructor.
+
+    Args:
+      stream: file-like, must support read, seek, and tell. If present, the
+              index is built by reading the chunk headers from the current
+              position, which must be the start of the form.
+      file_size: int, the size of the indexed file.
+      mtime: float, the modification time of the indexed file.
+      entries: list of tuples, as described above.
+    """
+    self.file_size = file_size
+    self.mtime = mtime
+    self.entries = entries or []
+    if stream:
+      self._Read(stream)
+    self._children = None
+
+  def _Read(self, stream):
+    """Records the location of every chunk by walking the chunk headers.
+
+    Chunk data is skipped by seeking.
+
+    Args:
+      stream: file-like, must support read, seek, and tell.
+    """
+    entries = self.entries
+    parents = [-1]
+    for event, header, chunk_id, offset, size in Walk(stream):
+      if event == EXIT_LIST:
+        parents.pop()
+        continue
+      entries.append((header, chunk_id, offset, size, parents[-1]))
+      if event == ENTER_LIST:
+        parents.append(len(entries) - 1)
+
+  def Children(self, entry):
+    """Returns the entries of the elements of a list.
+
+    Args:
+      entry: int, the number of the list's entry.
+
+    Returns:
+      list of ints, entry numbers in file order.
+    """
+    if self._children is None:
+      children = {}
+      for number, (_, _, _, _, parent) in enumerate(self.entries):
+        children.setdefault(parent, []).append(number)
+      self._children = children
+    return self._children.get(entry, [])
+
+  def Path(self, entry):
+    """Returns the nesting path of an entry.
+
+    Args:
+      entry: int, the entry number.
+
+    Returns:
+      tuple of strs, the chunk IDs from the form down to the entry.
+    """
+    path = []
+    while entry >= 0:
+      path.append(self.entries[entry][1])
+      entry = self.entries[entry][4]
+    path.reverse()
+    return tuple(path)
+
+  def Find(self, path):
+    """Returns the first entry with a given nesting path.
+
+    Args:
+      path: sequence of strs, chunk IDs below the form, e.g. ('dwrf', 'doc_').
+
+    Returns:
+      int, the entry number, or None if there is no such chunk.
+    """
+    entry = 0
+    for chunk_id in path:
+      for child in self.Children(entry):
+        if self.entries[child][1] == chunk_id:
+          entry = child
+          break
+      else:
+        return None
+    return entry
+
+  def IsCurrent(self, filename):
+    """Returns True if the index matches the size and mtime of a file.
+
+    Args:
+      filename: str, the name of the indexed file.
+    """
+    st = os.stat(filename)
+    return st.st_size == self.file_size and st.st_mtime == self.mtime
+
+  def Pack(self):
+    """Packs the index for storage.
+
+    Returns:
+      str, the packed index.
+    """
+    data = [struct.pack(self._HEADER_FORMAT, self._MAGIC, self._VERSION,
+                        self.file_size, self.mtime, len(self.entries))]
+    for entry in self.entries:
+      data.append(struct.pack(self._ENTRY_FORMAT, *entry))
+    return ''.join(data)
+
+  def Unpack(cls, data):
+    """Unpacks an index packed by Pack.
+
+    Args:
+      data: str, the packed index.
+
+    Returns:
+      ChunkIndex.
+
+    Raises:
+      ValueError, if data is not a packed index of this version.
+    """
+    header_size = struct.calcsize(cls._HEADER_FORMAT)
+    entry_size = struct.calcsize(cls._ENTRY_FORMAT)
+    magic, version, file_size, mtime, count = struct.unpack(
+        cls._HEADER_FORMAT, data[:header_size])
+    if magic != cls._MAGIC or version != cls._VERSION:
+      raise ValueError('Not a version %d chunk index' % cls._VERSION)
+    if len(data) != header_size + count * entry_size:
+      raise ValueError('Chunk index is truncated')
+    entries = [struct.unpack_from(cls._ENTRY_FORMAT, data,
+                                  header_size + i * entry_size)
+               for i in xrange(count)]
+    return cls(file_size=file_size, mtime=mtime, entries=entries)
+  Unpack = classmethod(Unpack)
+
+  def IndexPath(cls, filename, cache_dir=None):
+    """Returns the name of the index file for a RIFF file.
+
+    Args:
+      filename: str, the name of the RIFF file.
+      cache_dir: str, a directory to hold the index, or None to keep the
+                 index next to the RIFF file.
+
+    Returns:
+      str.
+    """
+    if cache_dir is None:
+      return filename + cls._SUFFIX
+    digest = hashlib.sha1(os.path.abspath(filename)).hexdigest()
+    return os.path.join(cache_dir, digest + cls._SUFFIX)
+  IndexPath = classmethod(IndexPath)
+
+  def Build(cls, filename):
+    """Builds the index of a RIFF file.
+
+    Args:
+      filename: str, the name of the RIFF file.
+
+    Returns:
+      ChunkIndex.
+    """
+    f = open(filename, 'rb')
+    try:
+      st = os.fstat(f.fileno())
+      return cls(stream=f, file_size=st.st_size, mtime=st.st_mtime)
+    finally:
+      f.close()
+  Build = classmethod(Build)
+
+  def Load(cls, filename, cache_dir=None):
+    """Loads the saved index of a RIFF file, if it is current.
+
+    Args:
+      filename: str, the name of the RIFF file.
+      cache_dir: str, the directory holding the index, or None if the index
+                 is next to the RIFF file.
+
+    Returns:
+      ChunkIndex, or None if there is no index, or the file has changed since
+      the index was built.
+    """
+    try:
+      f = open(cls.IndexPath(filename, cache_dir), 'rb')
+    except IOError:
+      return None
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    try:
+      index = cls.Unpack(data)
+    except (ValueError, struct.error):
+      return None
+    if not index.IsCurrent(filename):
+      return None
+    return index
+  Load = classmethod(Load)
+
+  def Save(self, filename, cache_dir=None):
+    """Saves the index of a RIFF file.
+
+    Args:
+      filename: str, the name of the indexed RIFF file.
+      cache_dir: str, a directory to hold the index, or None to save the
+                 index next to the RIFF file.
+    """
+    f = open(self.IndexPath(filename, cache_dir), 'wb')
+    f.write(self.Pack())
+    f.close()
+
+  def Open(cls, filename, cache_dir=None):
+    """Loads the saved index of a RIFF file, building and saving it if needed.
+
+    Args:
+      filename: str, the name of the RIFF file.
+      cache_dir: str, the directory holding the index, or None if the index
+                 is next to the RIFF file.
+
+    Returns:
+      ChunkIndex.
+    """
+    index = cls.Load(filename, cache_dir)
+    if index is None:
+      index = cls.Build(filename)
+      index.Save(filename, cache_dir)
+    return index
+  Open = classmethod(Open)
+
+
+class RIFFWriter(object):
+  """Writes a RIFF form to a file incrementally.
+
+  Chunks are written as they are given. The size field of each LIST, and of
+  each chunk written in blocks, is filled in when it is closed, so the file
+  must support seek and tell.
+
+  With rf64=True, space for a ds64 chunk is reserved as a JUNK chunk at the
+  start of the form. If the form grows past 4 GB it is promoted to RF64 (or
+  BW64) when closed: the reserved chunk becomes the ds64 chunk holding the
+  64-bit sizes of the form and of the data chunk, whose 32-bit size fields
+  are set to 0xFFFFFFFF.
+
+  Example:
+
+    writer = riff.RIFFWriter(open('out.riff', 'wb'), 'modo')
+    writer.BeginList('dwrf')
+    writer.WriteChunk(some_chunk)
+    writer.EndList()
+    writer.BeginChunk('data')
+    for block in blocks:
+      writer.WriteData(block)
+    writer.EndChunk()
+    writer.Close()
+  """
+
+  _MAX_SIZE = 0xFFFFFFFF
+
+  def __init__(self, fileobj, form_id, rf64=False, header64='RF64'):
+    """Constructor.
+
+    Args:
+      fileobj: file-like, must support write, seek, and tell.
+      form_id: str, the form type, e.g. 'WAVE'.
+      rf64: bool, if True reserve space so that the form can be promoted to
+            RF64 if it grows past 4 GB.
+      header64: str, 'RF64' or 'BW64', the header used on promotion.
+    """
+    self._file = fileobj
+    self._lists = []
+    self._chunk = None
+    self._sizes64 = {}
+    self._header64 = header64
+    # The sample count to record in the ds64 chunk on promotion.
+    self.sample_count = 0
+    self.BeginList(form_id, header='RIFF')
+    self._ds64 = None
+    if rf64:
+      self._ds64 = self._file.tell()
+      self._file.write(struct.pack('<4sI%dx' % DS64._STRUCT.size, _JUNK,
+                                   DS64._STRUCT.size))
+
+  def BeginList(self, list_id, header='LIST'):
+    """Starts a LIST. Subsequent chunks are written inside it.
+
+    Args:
+      list_id: str, the list type.
+      header: str, the list header.
+    """
+    self._CheckNoChunk()
+    self._lists.append((self._file.tell(), header))
+    self._file.write(struct.pack('<4sI4s', header, 0, list_id))
+
+  def EndList(self):
+    """Ends the innermost open LIST, filling in its size."""
+    self._CheckNoChunk()
+    if not self._lists:
+      raise ValueError('EndList: no LIST is open')
+    offset, header = self._lists.pop()
+    if self._lists:
+      self._PatchSize(offset, header)
+    else:
+      self._EndForm(offset)
+
+  def WriteChunk(self, chunk):
+    """Writes a complete chunk, or a LIST and all its elements.
+
+    Args:
+      chunk: Chunk, the chunk to write.
+    """
+    self._CheckNoChunk()
+    if isinstance(chunk, LIST):
+      if not chunk._HEADER:
+        self._file.write(repr(chunk))
+        return
+      self.BeginList(chunk.ID, header=chunk._HEADER)
+      for item in chunk:
+        self.WriteChunk(item)
+      self.EndList()
+      return
+
+    if _hook is None:
+      data = chunk._Pack()
+    else:
+      data = _Encode(chunk)
+    if len(data) > self._MAX_SIZE:
+      # Only the size patching knows how to record a 64-bit size.
+      self.BeginChunk(chunk.ID)
+      self.WriteData(data)
+      self.EndChunk()
+      return
+    self._file.write(struct.pack('<4sI', chunk.ID, len(data)))
+    self._file.write(data)
+    if len(data) % 2:
+      self._file.write('\0')
+
+  def BeginChunk(self, chunk_id):
+    """Starts a chunk whose data will be given by calls to WriteData.
+
+    Args:
+      chunk_id: str, the chunk ID.
+    """
+    self._CheckNoChunk()
+    self._chunk = (self._file.tell(), chunk_id)
+    self._file.write(struct.pack('<4sI', chunk_id, 0))
+
+  def WriteData(self, data):
+    """Writes a block of data to the chunk started by BeginChunk.
+
+    Args:
+      data: str, the data to append.
+    """
+    if self._chunk is None:
+      raise ValueError('WriteData: no chunk is open')
+    self._file.write(data)
+
+  def EndChunk(self):
+    """Ends the chunk started by BeginChunk, filling in its size."""
+    if self._chunk is None:
+      raise ValueError('EndChunk: no chunk is open')
+    offset, chunk_id = self._chunk
+    size = self._PatchSize(offset, chunk_id)
+    if size % 2:
+      self._file.write('\0')
+    self._chunk = None
+
+  def Close(self):
+    """Ends any open chunk and LISTs, including the form itself.
+
+    The underlying file is not closed.
+    """
+    if self._chunk is not None:
+      self.EndChunk()
+    while self._lists:
+      self.EndList()
+
+  def _CheckNoChunk(self):
+    if self._chunk is not None:
+      raise ValueError('Chunk started by BeginChunk has not been ended')
+
+  def _PatchSize(self, offset, chunk_id):
+    """Fills in the size field of the chunk whose header is at offset.
+
+    A data chunk too large for the size field is recorded for the ds64 chunk
+    if the form may be promoted to RF64.
+
+    Args:
+      offset: int, the file offset of the chunk header.
+      chunk_id: str, the chunk ID, or 'LIST'.
+
+    Returns:
+      int, the size of the chunk data.
+
+    Raises:
+      ValueError, if the chunk is too large.
+    """
+    end = self._file.tell()
+    size = end - offset - 8
+    field = size
+    if size > self._MAX_SIZE:
+      if self._ds64 is None or chunk_id != 'data':
+        raise ValueError('%s chunk of size %d is too large for a RIFF form%s'
+                         % (chunk_id, size,
+                            self._ds64 is None and ' without rf64' or ''))
+      self._sizes64[chunk_id] = size
+      field = 0xFFFFFFFF
+    self._file.seek(offset + 4)
+    self._file.write(struct.pack('<I', field))
+    self._file.seek(end)
+    return size
+
+  def _EndForm(self, offset):
+    """Fills in the size of the form, promoting it to RF64 if needed.
+
+    Args:
+      offset: int, the file offset of the form header.
+    """
+    f = self._file
+    end = f.tell()
+    size = end - offset - 8
+    if size <= self._MAX_SIZE and not self._sizes64:
+      self._PatchSize(offset, 'RIFF')
+      return
+    if self._ds64 is None:
+      raise ValueError('RIFF form of size %d is too large without rf64' %
+                       size)
+    f.seek(offset)
+    f.write(struct.pack('<4sI', self._header64, 0xFFFFFFFF))
+    ds64 = DS64(riff_size=size, data_size=self._sizes64.get('data', 0),
+                sample_count=self.sample_count, table=[])
+    f.seek(self._ds64)
+    f.write(repr(ds64))
+    f.seek(end)
+
+
+_FORMAT_TOKEN = re.compile(r'(\d*)([xcbB?hHiIlLqQfdspP])')
+
+# array.array typecodes able to hold each struct code's values.
+_ARRAY_TYPECODES = {'b': 'b', 'B': 'B', 'h': 'h', 'H': 'H', 'i': 'i',
+                    'I': 'L', 'l': 'l', 'L': 'L', 'f': 'f', 'd': 'd'}
+if array.array('l').itemsize >= 8:
+  _ARRAY_TYPECODES.update({'q': 'l', 'Q': 'L'})
+
+# NumPy type codes with standard sizes, for formats with an explicit byte
+# order.
+_NUMPY_STANDARD_CODES = {'b': 'i1', 'B': 'u1', '?': 'b1', 'h': 'i2',
+                         'H': 'u2', 'i': 'i4', 'I': 'u4', 'l': 'i4',
+                         'L': 'u4', 'q': 'i8', 'Q': 'u8', 'f': 'f4',
+                         'd': 'f8', 'c': 'S1'}
+
+
+def _ParseFormat(fmt):
+  """Splits a struct format into one code per unpacked value.
+
+  Args:
+    fmt: str, a struct format.
+
+  Returns:
+    tuple, (byte order prefix, list of codes). The prefix is '@' if fmt has
+    none. Repeated codes are expanded, string codes keep their length, e.g.
+    '<2H4s' gives ('<', ['H', 'H', '4s']), and pad bytes are omitted.
+  """
+  prefix = '@'
+  if fmt[:1] in '@=<>!':
+    prefix, fmt = fmt[0], fmt[1:]
+  codes = []
+  for count, code in _FORMAT_TOKEN.findall(fmt.replace(' ', '')):
+    if code in 'sp':
+      codes.append(count + code)
+    elif code != 'x':
+      codes.extend([code] * int(count or 1))
+  return prefix, codes
+
+
+def _NumpyDtype(fmt, names):
+  """Builds a NumPy structured dtype with the same layout as a struct format.
+
+  Args:
+    fmt: str, a struct format.
+    names: sequence of strs, one field name per unpacked value.
+
+  Returns:
+    numpy.dtype.
+  """
+  prefix = '@'
+  if fmt[:1] in '@=<>!':
+    prefix = fmt[0]
+  byte_order = {'<': '<', '>': '>', '!': '>', '=': '='}.get(prefix, '=')
+  formats = []
+  offsets = []
+  layout = prefix
+  for count, code in _FORMAT_TOKEN.findall(fmt.lstrip('@=<>!').replace(' ',
+                                                                      '')):
+    if code == 'x':
+      # Pad bytes hold no field but move the fields after them.
+      layout += count + code
+      continue
+    if code in 'sp':
+      items = [count + code]
+    else:
+      items = [code] * int(count or 1)
+    for item in items:
+      if item[-1] in 'sp':
+        numpy_code = 'S' + (item[:-1] or '1')
+      elif item == 'c':
+        numpy_code = 'S1'
+      elif prefix == '@':
+        numpy_code = byte_order + item
+      else:
+        numpy_code = byte_order + _NUMPY_STANDARD_CODES[item]
+      # The offset of a field is where struct would place it after the
+      # fields before it, including any alignment padding.
+      offsets.append(struct.calcsize(layout + item) -
+                     struct.calcsize(prefix + item))
+      layout += item
+      formats.append(numpy_code)
+  return numpy.dtype({'names': list(names), 'formats': formats,
+                      'offsets': offsets, 'itemsize': struct.calcsize(fmt)})
+
+
+class RIFFEditor(object):
+  """Changes chunks within an existing RIFF file without rewriting it.
+
+  A chunk is overwritten in place when its new data fits in the space it
+  occupies, together with any JUNK chunk directly after it; space left over
+  becomes a JUNK chunk. Otherwise the chunk is moved to the end of the file
+  along with the element of the form holding it and every element after
+  that one, so that elements keep their order; the space they occupied
+  becomes a JUNK chunk, and the affected LIST and RIFF sizes are updated.
+  Readers skip JUNK chunks, so an edited file reads as the new data.
+
+  Example:
+
+    editor = riff.RIFFEditor('dwarves.riff')
+    editor.Replace('dwrf/doc_', new_doc)
+    editor.Close()
+  """
+
+  _BLOCK_SIZE = 1 << 20
+
+  def __init__(self, filename):
+    """Constructor.
+
+    Args:
+      filename: str, the name of the RIFF file to change.
+    """
+    self._file = open(filename, 'r+b')
+    self._index = None
+
+  def Close(self):
+    """Closes the file."""
+    self._file.close()
+
+  def _GetIndex(self):
+    if self._index is None:
+      self._file.seek(0)
+      self._index = ChunkIndex(stream=self._file)
+    return self._index
+  index = property(_GetIndex, None, None, None)
+
+  def Replace(self, path, chunk):
+    """Replaces the data of a chunk.
+
+    Args:
+      path: str or sequence of strs, the chunk IDs below the form, e.g.
+            'dwrf/doc_' or ('dwrf', 'doc_').
+      chunk: Chunk, the new chunk. Its data is given by _Pack, or for a LIST
+             by its elements.
+
+    Raises:
+      ValueError, if there is no chunk at path.
+    """
+    if isinstance(path, str):
+      path = path.split('/')
+    index = self.index
+    entry = index.Find(path)
+    if entry is None:
+      raise ValueError('No chunk %s in %s' % ('/'.join(path), index.Path(0)))
+    header, chunk_id, offset, size, parent = index.entries[entry]
+
+    if isinstance(chunk, LIST) and chunk._HEADER:
+      data = repr(chunk)[8:]
+    else:
+      data = chunk._Pack()
+    new_total = 8 + len(data) + len(data) % 2
+
+    chunk_end = self._End(entry)
+    available = chunk_end - offset
+    siblings = index.Children(parent)
+    position = siblings.index(entry)
+    if position + 1 < len(siblings):
+      next_entry = siblings[position + 1]
+      if index.entries[next_entry][0] == _JUNK:
+        available = self._End(next_entry) - offset
+
+    if new_total == available or new_total + 8 <= available:
+      self._WriteChunk(offset, header, data)
+      if new_total < available:
+        self._file.write(struct.pack('<4sI', _JUNK,
+                                     available - new_total - 8))
+    else:
+      self._Relocate(entry, header, data, chunk_end)
+    self._index = None
+
+  def _End(self, entry):
+    """Returns the offset after a chunk and its pad byte, if it has one.
+
+    The end is where the next chunk in the same list starts, or the end of
+    the list, since a pad byte cannot be assumed to be present.
+
+    Args:
+      entry: int, the index entry of the chunk.
+
+    Returns:
+      int
+    """
+    index = self.index
+    _, _, offset, size, parent = index.entries[entry]
+    if parent < 0:
+      return offset + 8 + size
+    siblings = index.Children(parent)
+    position = siblings.index(entry)
+    if position + 1 < len(siblings):
+      return index.entries[siblings[position + 1]][2]
+    return self._End(parent)
+
+  def _WriteChunk(self, offset, header, data):
+    """Writes a chunk header and data, with pad byte if needed.
+
+    Args:
+      offset: int, the file offset at which to write.
+      header: str, the chunk ID, or 'LIST' or 'RIFF'.
+      data: str, the chunk data, including any list type.
+    """
+    self._file.seek(offset)
+    self._file.write(struct.pack('<4sI', header, len(data)))
+    self._file.write(data)
+    if len(data) % 2:
+      self._file.write('\0')
+
+  def _Relocate(self, entry, header, data, chunk_end):
+    """Moves a chunk, and everything after it in the form, to the end of
+    the file.
+
+    The move starts at the element of the form holding the chunk, so that
+    every element keeps its position. The space moved from becomes a JUNK
+    chunk.
+
+    Args:
+      entry: int, the index entry of the chunk.
+      header: str, the chunk ID, or 'LIST' or 'RIFF'.
+      data: str, the new chunk data, including any list type.
+      chunk_end: int, the offset after the chunk as it is.
+
+    Raises:
+      ValueError, if the form does not end at the end of the file.
+    """
+    index = self.index
+    f = self._file
+    _, _, form_offset, form_size, _ = index.entries[0]
+    f.seek(0, 2)
+    end = f.tell()
+    if form_offset + 8 + form_size != end:
+      raise ValueError('Cannot move a chunk: the form does not end at the'
+                       ' end of the file')
+
+    chain = [entry]
+    while index.entries[chain[-1]][4] != 0:
+      chain.append(index.entries[chain[-1]][4])
+    chain.reverse()
+    top_offset = index.entries[chain[0]][2]
+    offset = index.entries[entry][2]
+    delta = 8 + len(data) + len(data) % 2 - (chunk_end - offset)
+
+    dest = end
+    if dest % 2:
+      f.write('\0')
+      dest += 1
+    # Copy from the element of the form holding the chunk to the end of the
+    # form, with the new chunk in place of the old one.
+    self._Copy(top_offset, offset, dest)
+    self._WriteChunk(dest + offset - top_offset, header, data)
+    new_end = self._Copy(chunk_end, end, f.tell())
+    for list_entry in chain[:-1]:
+      _, _, list_offset, list_size, _ = index.entries[list_entry]
+      f.seek(dest + list_offset - top_offset + 4)
+      f.write(struct.pack('<I', list_size + delta))
+
+    f.seek(top_offset)
+    f.write(struct.pack('<4sI', _JUNK, end - top_offset - 8))
+    if index.entries[0][0] in _RF64_HEADERS:
+      # Update riff_size in the ds64 chunk, which follows the form type.
+      f.seek(form_offset + 20)
+      f.write(struct.pack('<Q', new_end - form_offset - 8))
+    else:
+      f.seek(form_offset + 4)
+      f.write(struct.pack('<I', new_end - form_offset - 8))
+
+  def _Copy(self, start, stop, dest):
+    """Copies a range of the file in blocks.
+
+    Args:
+      start: int, the offset of the first byte to copy.
+      stop: int, the offset after the last byte to copy.
+      dest: int, the offset to copy to, which must not be before stop.
+
+    Returns:
+      int, the offset after the last byte written.
+    """
+    f = self._file
+    while start < stop:
+      f.seek(start)
+      block = f.read(min(self._BLOCK_SIZE, stop - start))
+      f.seek(dest)
+      f.write(block)
+      start += len(block)
+      dest += len(block)
+    return dest
+
+
+class RIFFAppender(object):
+  """Appends chunks or records to the end of an existing RIFF file.
+
+  The target is the form itself, or a chunk or LIST ending where the form
+  ends, reached through the last element at each level. New data is written
+  at the end of the file, and Flush updates only the size fields of the
+  target and of the lists holding it, so a flush costs the same however
+  large the file is. Until then, readers see the file as it was before the
+  appends, followed by data they ignore.
+
+  Example:
+
+    appender = riff.RIFFAppender('capture.riff', 'recs')
+    for record in records:
+      appender.AppendRecords([record])
+      appender.Flush()
+    appender.Close()
+  """
+
+  def __init__(self, filename, path=None, sync_bytes=None):
+    """Constructor.
+
+    Args:
+      filename: str, the name of the RIFF file.
+      path: str or sequence of strs, the IDs (list types for LISTs) of the
+            last element at each level below the form, e.g. 'dwrf' or
+            ('dwrf', 'doc_'), or None to append to the form itself.
+      sync_bytes: int, the number of bytes to append between calls to
+                  os.fsync by Flush, 0 to sync on every flush, or None to
+                  leave writing to the disk to the operating system.
+
+    Raises:
+      ValueError, if the file is not a RIFF form which ends at the end of
+      the file, or path does not name the last element at each level.
+    """
+    if isinstance(path, str):
+      path = path.split('/')
+    self._file = open(filename, 'r+b')
+    self._sync_bytes = sync_bytes
+    self._unsynced = 0
+    try:
+      self._Open(path or ())
+    except:
+      self._file.close()
+      raise
+
+  def _Open(self, path):
+    """Finds the target and the lists holding it.
+
+    Args:
+      path: sequence of strs, as given to the constructor.
+    """
+    f = self._file
+    f.seek(0, 2)
+    file_size = f.tell()
+    f.seek(0)
+    header, size, form_id = struct.unpack('<4sI4s', f.read(12))
+    if header != 'RIFF' and header not in _RF64_HEADERS:
+      raise ValueError('Not a RIFF form: header=%r' % header)
+    sizes = {}
+    # {offset of a chunk: offset of its 64-bit size in the ds64 chunk}
+    self._sizes64 = {}
+    if header in _RF64_HEADERS:
+      ds64 = DS64(stream=f)
+      size = ds64.riff_size
+      sizes = ds64.Sizes()
+      # riff_size follows the header of the ds64 chunk, itself after the
+      # form header, and data_size follows riff_size.
+      self._sizes64[0] = 20
+    end = 8 + size
+    if end + size % 2 != file_size:
+      raise ValueError('The form of size %d does not end at the end of the'
+                       ' file, at %d' % (size, file_size))
+    # The file offset of each chunk holding the target, and the target last.
+    self._chain = [0]
+    self._is_list = True
+    start = 12
+    for i, chunk_id in enumerate(path):
+      last = None
+      offset = start
+      while offset < end:
+        f.seek(offset)
+        chunk_type, size = struct.unpack('<4sI', f.read(8))
+        oversized = size == 0xFFFFFFFF and i == 0 and chunk_type in sizes
+        if oversized:
+          size = sizes[chunk_type]
+        last = offset, chunk_type, size, oversized
+        offset += 8 + size + size % 2
+      if last is None:
+        raise ValueError('No %s: %s is empty' % ('/'.join(path[:i + 1]),
+                                                 '/'.join(path[:i]) or 'form'))
+      offset, chunk_type, size, oversized = last
+      is_list = chunk_type == 'LIST'
+      if is_list:
+        chunk_type = f.read(4)
+      if chunk_type != chunk_id:
+        raise ValueError('%s is not the last element of %s, %s is' %
+                         (chunk_id, '/'.join(path[:i]) or 'form', chunk_type))
+      if offset + 8 + size + size % 2 != end:
+        raise ValueError('%s of size %d does not end where its list does' %
+                         ('/'.join(path[:i + 1]), size))
+      if oversized:
+        if chunk_type != 'data':
+          raise ValueError('Cannot append to %s, whose size is in the table'
+                           ' of the ds64 chunk' % chunk_type)
+        self._sizes64[offset] = 28
+      self._chain.append(offset)
+      self._is_list = is_list
+      if not is_list and i + 1 < len(path):
+        raise ValueError('%s is not a LIST' % '/'.join(path[:i + 1]))
+      start = offset + 12
+      end = offset + 8 + size
+    # Where the next data is written: the end of the target's data.
+    self._end = end
+
+  def Append(self, chunk):
+    """Appends a chunk, or a LIST and all its elements, to the target LIST.
+
+    Args:
+      chunk: Chunk, the chunk.
+
+    Raises:
+      ValueError, if the target is not a LIST.
+    """
+    if not self._is_list:
+      raise ValueError('Cannot append a chunk to a chunk; use AppendRecords'
+                       ' or AppendData')
+    buf = bytearray()
+    chunk.PackTo(buf)
+    self._Write(buf)
+
+  def AppendRecords(self, records):
+    """Appends records, such as those of a MultiRecordList, to the target.
+
+    Args:
+      records: iterable of Structs, each packed by its _Pack.
+    """
+    self.AppendData(''.join([record._Pack() for record in records]))
+
+  def AppendData(self, data):
+    """Appends data to the target chunk.
+
+    Args:
+      data: str, the data.
+
+    Raises:
+      ValueError, if the target is a LIST.
+    """
+    if self._is_list:
+      raise ValueError('Cannot append data to a LIST; use Append')
+    self._Write(data)
+
+  def _Write(self, data):
+    """Writes data at the end of the target.
+
+    A pad byte follows if the target's data is then of odd size; it is
+    overwritten by the next data appended.
+
+    Args:
+      data: str or bytearray, the data.
+
+    Raises:
+      ValueError, if a size would exceed 32 bits.
+    """
+    end = self._end + len(data)
+    for offset in self._chain:
+      if offset not in self._sizes64 and end - offset - 8 > 0xFFFFFFFF:
+        raise ValueError('Cannot append %d bytes: the size of the chunk at'
+                         ' %d would exceed 4 GB' % (len(data), offset))
+    f = self._file
+    f.seek(self._end)
+    f.write(data)
+    if (end - self._chain[-1]) % 2:
+      f.write('\0')
+    self._end = end
+    self._unsynced += len(data)
+
+  def Flush(self):
+    """Updates the size fields to cover the data appended, and writes them.
+
+    If sync_bytes were given and that many bytes have been appended since
+    the last sync, the data is synced to disk before the sizes, so that the
+    sizes never cover data which was not written.
+    """
+    f = self._file
+    sync = (self._sync_bytes is not None and
+            self._unsynced >= self._sync_bytes)
+    if sync:
+      f.flush()
+      os.fsync(f.fileno())
+    target = self._chain[-1]
+    # The lists holding the target also hold its pad byte, if any.
+    padded_end = self._end + (self._end - target) % 2
+    for offset in self._chain:
+      if offset == target:
+        size = self._end - offset - 8
+      else:
+        size = padded_end - offset - 8
+      if offset in self._sizes64:
+        f.seek(self._sizes64[offset])
+        f.write(struct.pack('<Q', size))
+      else:
+        f.seek(offset + 4)
+        f.write(_SIZE.pack(size))
+    f.flush()
+    if sync:
+      os.fsync(f.fileno())
+      self._unsynced = 0
+
+  def Close(self):
+    """Flushes, syncing if sync_bytes were given, and closes the file."""
+    if self._sync_bytes is not None:
+      self._sync_bytes = 0
+    self.Flush()
+    self._file.close()
+
+
+def _ReadData(stream, size):
+  """Reads chunk data from the current position of a stream.
+
+  Data within a memory map is not copied.
+
+  Args:
+    stream: file-like, must support read, seek, and tell.
+    size: int, the number of bytes to read.
+
+  Returns:
+    str, or a buffer into the map if stream is an mmap.
+  """
+  if isinstance(stream, mmap.mmap):
+    offset = stream.tell()
+    stream.seek(offset + size)
+    return buffer(stream, offset, size)
+  return stream.read(size)
 
 
 def PackVar(*items):
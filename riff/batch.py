@@ -0,0 +1,217 @@
+#!/usr/bin/python2.4
+# (C) Simon Drabble  2008
+# This software is released under the Gnu General Public Licence v2.0.
+# See http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+"""
+Parses many RIFF files in parallel.
+
+Files are parsed across a pool of processes. Only the selected parts of each
+file are returned, as plain picklable data, and a file which fails to parse
+is reported without stopping the rest of the batch:
+
+  for filename, result, error in riff.batch.ParseFiles(
+      glob.glob('dwarves/*.riff'), MockDwarfRiff,
+      select=['dwrf.doc_.food', 'addr']):
+    ...
+
+The form class must be importable by name, since it is sent to the worker
+processes.
+
+From the command line:
+
+  python -m riff.batch --form=dwarves:MockDwarfRiff \
+      --select=dwrf.doc_.food 'dwarves/*.riff'
+
+prints one JSON object per file.
+"""
+
+__author__ = 'Simon Drabble <python-devel@thebigmachine.org>'
+
+
+import glob
+import json
+import multiprocessing
+import optparse
+import sys
+
+import riff
+
+
+def Plain(obj):
+  """Converts chunks into plain data which can be pickled.
+
+  Args:
+    obj: object, a Chunk, LIST, or value held by a chunk.
+
+  Returns:
+    A LIST becomes a list of its elements, a RecordTable a dict of its
+    columns, and a Chunk a dict of its slots plus 'ID'. Buffers become strs.
+    Other values are returned unchanged.
+  """
+  if isinstance(obj, riff.RecordTable):
+    plain = {}
+    for name in obj._RECORD_STRUCT.__slots__:
+      column = obj.Column(name)
+      if riff.numpy is not None and isinstance(column, riff.numpy.ndarray):
+        # tolist gives Python values rather than NumPy scalars.
+        plain[name] = column.tolist()
+      else:
+        plain[name] = list(column)
+    return plain
+  if isinstance(obj, riff.LIST):
+    return [Plain(item) for item in obj]
+  if isinstance(obj, riff.Struct):
+    plain = dict([(slot, Plain(getattr(obj, slot))) for slot in obj.__slots__])
+    plain['ID'] = obj.ID
+    return plain
+  if isinstance(obj, buffer):
+    return str(obj)
+  return obj
+
+
+def Resolve(obj, path):
+  """Follows a dotted path of slot names or element numbers.
+
+  Args:
+    obj: Chunk, the starting point, e.g. a RIFF.
+    path: str, e.g. 'dwrf.doc_.food' or 'dwrf.0.food'.
+
+  Returns:
+    object, the chunk or value at path.
+  """
+  for part in path.split('.'):
+    if part.isdigit():
+      obj = obj[int(part)]
+    else:
+      obj = getattr(obj, part)
+  return obj
+
+
+def ParseFile(filename, form_class, select=None):
+  """Parses one file and returns the selected parts as plain data.
+
+  The file is read lazily, so only the selected chunks are decoded.
+
+  Args:
+    filename: str, the name of the RIFF file.
+    form_class: class, a RIFF subclass modelling the file.
+    select: sequence of strs, paths as accepted by Resolve, or None for the
+            whole form.
+
+  Returns:
+    dict, {path: plain data}, or the whole form as plain data if select is
+    None.
+  """
+  the_riff = form_class(filename=filename, lazy=True)
+  try:
+    if select is None:
+      return Plain(the_riff)
+    return dict([(path, Plain(Resolve(the_riff, path))) for path in select])
+  finally:
+    the_riff.Close()
+
+
+def _ParseFileSafely(args):
+  """Calls ParseFile, catching any error.
+
+  Args:
+    args: tuple, (filename, form_class, select).
+
+  Returns:
+    tuple, (filename, result, error), where error is None or a str.
+  """
+  filename, form_class, select = args
+  try:
+    return filename, ParseFile(filename, form_class, select), None
+  except Exception, e:
+    return filename, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+def ParseFiles(filenames, form_class, select=None, processes=None,
+               chunksize=16):
+  """Parses files across a pool of processes.
+
+  Args:
+    filenames: sequence of strs, the names of the RIFF files.
+    form_class: class, a RIFF subclass modelling the files, importable by
+                name from the worker processes.
+    select: sequence of strs, paths as accepted by Resolve, or None for the
+            whole form.
+    processes: int, the number of worker processes. Defaults to the number
+               of CPUs; 1 parses in the calling process.
+    chunksize: int, the number of files given to a worker at a time.
+
+  Returns:
+    list of tuples, (filename, result, error) in the order of filenames,
+    where result is as returned by ParseFile, or None if the file could not
+    be parsed, in which case error describes the problem.
+  """
+  tasks = [(filename, form_class, select) for filename in filenames]
+  if processes == 1:
+    return map(_ParseFileSafely, tasks)
+  pool = multiprocessing.Pool(processes)
+  try:
+    return list(pool.imap(_ParseFileSafely, tasks, chunksize))
+  finally:
+    pool.close()
+    pool.join()
+
+
+def ExpandPatterns(patterns):
+  """Expands glob patterns into file names.
+
+  Args:
+    patterns: sequence of strs, file names or glob patterns.
+
+  Returns:
+    list of strs, in the given order, each pattern's matches sorted.
+  """
+  filenames = []
+  for pattern in patterns:
+    if glob.has_magic(pattern):
+      filenames.extend(sorted(glob.glob(pattern)))
+    else:
+      filenames.append(pattern)
+  return filenames
+
+
+def ImportClass(name):
+  """Imports a class given as 'module:Class'.
+
+  Args:
+    name: str, e.g. 'riff.RIFF'.
+
+  Returns:
+    class.
+  """
+  module_name, class_name = name.split(':')
+  __import__(module_name)
+  return getattr(sys.modules[module_name], class_name)
+
+
+def main(argv=None):
+  parser = optparse.OptionParser(
+      usage='%prog --form=module:Class [options] FILE_OR_GLOB...')
+  parser.add_option('--form', help='the RIFF subclass, as module:Class')
+  parser.add_option('--select', action='append',
+                    help='a dotted path to return; may be repeated')
+  parser.add_option('--processes', type='int',
+                    help='the number of worker processes')
+  options, args = parser.parse_args(argv)
+  if not options.form or not args:
+    parser.error('--form and at least one file are required')
+
+  form_class = ImportClass(options.form)
+  errors = 0
+  for filename, result, error in ParseFiles(ExpandPatterns(args), form_class,
+                                            select=options.select,
+                                            processes=options.processes):
+    if error:
+      errors += 1
+    print json.dumps({'file': filename, 'result': result, 'error': error},
+                     encoding='latin-1', sort_keys=True)
+  return errors and 1 or 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
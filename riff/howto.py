@@ -109,6 +109,14 @@ variable-length, we need to override the _Unpack method of riff.Chunk:
       d2 = struct.unpack('%ds' % l2, data[l1+2:])
       return (d1, d2)
 
+Alternatively, the fields can be declared, one per slot, and riff will
+generate _Unpack and _Pack when the class is defined:
+    _FIELDS = (riff.PrefixedString(), riff.PrefixedString())
+
+Besides PrefixedString, riff provides Fixed (a single struct format such as
+'<I'), ZeroString (zero-terminated, or zero-padded to a fixed size), Array (a
+counted list of any field) and Nested (another Struct, without a header).
+
 Now we'll define the class that handles unpacking the dwrf LIST:
 
 Again, the name doesn't matter, and doesn't have to match the LIST-type, but
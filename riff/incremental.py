@@ -0,0 +1,361 @@
+#!/usr/bin/python2.4
+# (C) Simon Drabble  2008
+# This software is released under the Gnu General Public Licence v2.0.
+# See http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+"""
+Reads and writes RIFF forms incrementally, for non-blocking I/O.
+
+IncrementalReader parses a form from data as it arrives, without a stream
+to read from: each block is passed to Feed, which returns the chunks it
+completed. Only the data of the chunk being received is buffered.
+
+  reader = riff.incremental.IncrementalReader(MockDwarfRiff)
+  for block in blocks:
+    for chunk in reader.Feed(block):
+      ...
+  form = reader.Close()
+
+RIFFReceiver and RIFFSender run a reader and a writer over sockets within an
+asyncore loop, so that one process can serve many connections without a
+thread for each. The sender packs one chunk each time the socket is ready,
+so the loop serves other connections between chunks.
+"""
+
+__author__ = 'Simon Drabble <python-devel@thebigmachine.org>'
+
+
+import asynchat
+import asyncore
+import struct
+
+import riff
+
+
+class IncrementalReader(object):
+  """Parses a RIFF form from blocks of data pushed by the caller.
+
+  The chunks are read as ChunkFactory reads them from a stream: a LIST
+  whose class has a header is filled in as its elements arrive, any other
+  chunk is created once all its data has arrived, and a pad byte after a
+  chunk of odd size is skipped if present, as is any JUNK chunk. Forms with
+  64-bit sizes (RF64) are not supported.
+
+  Attributes:
+    form: RIFF, the form, once it is complete; None until then.
+  """
+
+  def __init__(self, form_class):
+    """Constructor.
+
+    Args:
+      form_class: class, the RIFF or LIST subclass modelling the form.
+    """
+    self._form_class = form_class
+    self._data = ''
+    self._pos = 0
+    self._pieces = []
+    self._waiting = 0
+    self._offset = 0
+    # (list, offset of the end of its data, size) for each open list.
+    self._lists = []
+    self._padded = False
+    self.form = None
+
+  def _Read(self, size, consume=True):
+    """Returns the next bytes, if they have all arrived.
+
+    Args:
+      size: int, the number of bytes.
+      consume: bool, if False the bytes are returned again by the next call.
+
+    Returns:
+      str, or None if fewer than size bytes are buffered.
+    """
+    available = len(self._data) - self._pos
+    if available < size:
+      if available + self._waiting < size:
+        return None
+      self._pieces.insert(0, self._data[self._pos:])
+      self._data = ''.join(self._pieces)
+      self._pos = 0
+      self._pieces = []
+      self._waiting = 0
+    data = self._data[self._pos:self._pos + size]
+    if consume:
+      self._pos += size
+      self._offset += size
+    return data
+
+  def Feed(self, data):
+    """Parses a block of data.
+
+    Args:
+      data: str, the next block of the form. Data after the end of the form
+            is ignored.
+
+    Returns:
+      list of Chunks, each chunk completed by the block, in stream order. A
+      LIST is included once its last element has arrived, and the form
+      itself last of all.
+
+    Raises:
+      ValueError, if the data is not a form of the expected type.
+      AttributeError, if there is no class for a chunk.
+      struct.error, if a chunk's data cannot be unpacked.
+    """
+    if data:
+      self._pieces.append(data)
+      self._waiting += len(data)
+    completed = []
+    lists = self._lists
+
+    while self.form is None:
+      if lists and self._offset >= lists[-1][1]:
+        chunk, _, size = lists.pop()
+        self._padded = size % 2
+        completed.append(chunk)
+        if not lists:
+          self.form = chunk
+        continue
+
+      if self._padded:
+        pad = self._Read(1, consume=False)
+        if pad is None:
+          break
+        if pad == '\0':
+          # Skip the pad byte which follows a chunk of odd size.
+          self._Read(1)
+        self._padded = False
+        continue
+
+      header = self._Read(8, consume=False)
+      if header is None:
+        break
+      chunk_type, size = struct.unpack('<4sI', header)
+      is_list = chunk_type == 'LIST' or chunk_type == 'RIFF'
+      if not lists or is_list:
+        header = self._Read(12, consume=False)
+        if header is None:
+          break
+        list_type = header[8:]
+        if not lists:
+          chunk_class = self._CheckForm(chunk_type, list_type)
+        else:
+          chunk_class = self._GetClass(list_type)
+        if chunk_class._HEADER:
+          self._Read(12)
+          chunk = chunk_class()
+          if lists:
+            list.append(lists[-1][0], chunk)
+          # The list size includes the 4 bytes of the list type.
+          lists.append((chunk, self._offset - 4 + size, size))
+          continue
+        # A LIST without a header is given its header as data, as
+        # ChunkFactory does.
+        data = self._Read(size + 8)
+        if data is None:
+          break
+      elif chunk_type == riff._JUNK:
+        # Filler, skipped as ChunkFactory skips it.
+        if self._Read(size + 8) is None:
+          break
+        self._padded = size % 2
+        continue
+      else:
+        chunk_class = self._GetClass(chunk_type)
+        if self._Read(size + 8, consume=False) is None:
+          break
+        self._Read(8)
+        data = self._Read(size)
+
+      chunk = chunk_class(raw_data=data)
+      # As in ChunkFactory, elements are not checked for an ID.
+      list.append(lists[-1][0], chunk)
+      completed.append(chunk)
+      self._padded = size % 2
+
+    return completed
+
+  def _CheckForm(self, header, list_type):
+    """Checks the header of the form.
+
+    Returns:
+      class, the form class.
+
+    Raises:
+      ValueError, if the header is not that of the expected form.
+    """
+    form_class = self._form_class
+    if header in riff._RF64_HEADERS:
+      raise ValueError('%s forms cannot be read incrementally' % header)
+    if header != form_class._HEADER or list_type != form_class.ID:
+      raise ValueError('%s is not a %s: ID=%s' %
+                       (form_class._HEADER, form_class.ID, list_type))
+    return form_class
+
+  def _GetClass(self, chunk_type):
+    """Returns the class which models a chunk in the innermost open list."""
+    container = self._lists[-1][0].__class__
+    return riff._ChunkClass(container, chunk_type, container._CLASSES,
+                            container._CHUNKBASE)
+
+  def Close(self):
+    """Finishes parsing.
+
+    Returns:
+      RIFF, the form.
+
+    Raises:
+      ValueError, if the form is incomplete.
+    """
+    if self.form is None:
+      raise ValueError('Data ended at offset %d, within the form' %
+                       (self._offset + len(self._data) - self._pos +
+                        self._waiting))
+    return self.form
+
+
+def _Pieces(chunk):
+  """Generates the packed data of a chunk, one chunk at a time.
+
+  Args:
+    chunk: Chunk, the chunk, or a LIST whose elements are packed in turn.
+
+  Yields:
+    str, the header of each LIST, or the packed form of any other chunk.
+  """
+  if isinstance(chunk, riff.LIST) and chunk._HEADER:
+    yield struct.pack('<4sI4s', chunk._HEADER, chunk.length - 8, chunk.ID)
+    for item in chunk:
+      for piece in _Pieces(item):
+        yield piece
+  else:
+    yield repr(chunk)
+
+
+class ChunkProducer(object):
+  """An asynchat producer of a chunk's packed data, one chunk at a time."""
+
+  def __init__(self, chunk):
+    """Constructor.
+
+    Args:
+      chunk: Chunk, the chunk or form to send.
+    """
+    self._pieces = _Pieces(chunk)
+
+  def more(self):
+    for piece in self._pieces:
+      return piece
+    return ''
+
+
+class RIFFReceiver(asyncore.dispatcher):
+  """Receives a RIFF form from a socket within an asyncore loop.
+
+  Override HandleChunk to act on each chunk as it arrives, and HandleForm and
+  HandleError to act on the outcome. The socket is closed once the form is
+  complete or an error occurs.
+
+  Attributes:
+    form: RIFF, the form once it has been received, or None.
+    error: Exception, the reason the form could not be received, or None.
+  """
+
+  _BLOCK_SIZE = 65536
+
+  def __init__(self, sock, form_class, map=None):
+    """Constructor.
+
+    Args:
+      sock: socket, the connected socket.
+      form_class: class, the RIFF or LIST subclass modelling the form.
+      map: dict, the asyncore socket map, or None for the global map.
+    """
+    asyncore.dispatcher.__init__(self, sock, map)
+    self.reader = IncrementalReader(form_class)
+    self.form = None
+    self.error = None
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    data = self.recv(self._BLOCK_SIZE)
+    try:
+      for chunk in self.reader.Feed(data):
+        self.HandleChunk(chunk)
+    except (ValueError, AttributeError, struct.error), e:
+      self.close()
+      self.HandleError(e)
+      return
+    if self.reader.form is not None:
+      self.close()
+      self.HandleForm(self.reader.form)
+
+  def handle_close(self):
+    self.close()
+    try:
+      self.reader.Close()
+    except ValueError, e:
+      self.HandleError(e)
+
+  def HandleChunk(self, chunk):
+    """Called with each chunk as it is completed.
+
+    Args:
+      chunk: Chunk, the chunk.
+    """
+    pass
+
+  def HandleForm(self, form):
+    """Called when the whole form has been received.
+
+    Args:
+      form: RIFF, the form.
+    """
+    self.form = form
+
+  def HandleError(self, error):
+    """Called if the data is invalid, or ends before the form is complete.
+
+    Args:
+      error: Exception, the reason.
+    """
+    self.error = error
+
+
+class RIFFSender(asynchat.async_chat):
+  """Sends chunks to a socket within an asyncore loop.
+
+  Example:
+
+    sender = riff.incremental.RIFFSender(sock)
+    sender.Send(form)
+    sender.close_when_done()
+    asyncore.loop()
+  """
+
+  def __init__(self, sock, map=None):
+    """Constructor.
+
+    Args:
+      sock: socket, the connected socket.
+      map: dict, the asyncore socket map, or None for the global map.
+    """
+    asynchat.async_chat.__init__(self, sock, map)
+
+  def collect_incoming_data(self, data):
+    # Nothing is expected from the peer.
+    pass
+
+  def found_terminator(self):
+    pass
+
+  def Send(self, chunk):
+    """Queues a chunk, or a whole form, to be sent.
+
+    Args:
+      chunk: Chunk, the chunk.
+    """
+    self.push_with_producer(ChunkProducer(chunk))
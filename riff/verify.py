@@ -0,0 +1,221 @@
+#!/usr/bin/python2.4
+# (C) Simon Drabble  2008
+# This software is released under the Gnu General Public Licence v2.0.
+# See http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+"""
+Checks that RIFF files are structurally sound, reading only chunk headers.
+
+No chunk is decoded and no form class is needed: the payload of each chunk is
+seeked over, so a file is checked with a few reads per chunk however large it
+is. A file is sound if every chunk lies within its enclosing LIST or form,
+every form lies within the file, and every chunk of odd size is followed by
+its pad byte. The first problem found in each file is reported with its
+offset:
+
+  for filename, problem in riff.verify.VerifyFiles(
+      glob.glob('archive/*.wav')):
+    if problem:
+      offset, message = problem
+      ...
+
+Files are checked across a pool of processes. From the command line:
+
+  python -m riff.verify 'archive/*.wav'
+
+prints one JSON object per file, and exits with status 1 if any file has a
+problem.
+"""
+
+__author__ = 'Simon Drabble <python-devel@thebigmachine.org>'
+
+
+import json
+import multiprocessing
+import optparse
+import os
+import struct
+import sys
+
+import riff
+import riff.batch
+
+
+def VerifyStream(stream, size):
+  """Checks the chunk headers of a stream of RIFF forms.
+
+  Args:
+    stream: file-like, must support read, seek, and tell, positioned at the
+            start of a RIFF form. Forms are checked until the end of the
+            stream.
+    size: int, the offset of the end of the stream.
+
+  Returns:
+    tuple, (int, str), the offset of the first problem and a description of
+    it, or None if the stream is sound.
+  """
+  offset = stream.tell()
+  # The offset of the end of each open list, innermost last; the end of the
+  # stream first.
+  ends = [size]
+  sizes = {}
+  rf64 = False
+  # The problem with a form which runs beyond the end of the file, reported
+  # if none of its chunks does.
+  truncated = None
+
+  while True:
+    end = ends[-1]
+    if offset == end:
+      if len(ends) == 1:
+        return None
+      if len(ends) == 2 and truncated:
+        return truncated
+      ends.pop()
+      continue
+    if end - offset < 8:
+      if truncated and end == size:
+        return offset, 'the file ends within a chunk header'
+      return offset, ('%d bytes remain before offset %d, too few for a chunk'
+                      ' header' % (end - offset, end))
+
+    stream.seek(offset)
+    chunk_type, chunk_size = struct.unpack('<4sI', stream.read(8))
+    if len(ends) == 1:
+      if chunk_type not in ('RIFF',) + riff._RF64_HEADERS:
+        return offset, 'expected a RIFF form, found %r' % chunk_type
+      rf64 = chunk_type in riff._RF64_HEADERS
+      if rf64:
+        try:
+          stream.read(4)
+          ds64 = riff.DS64(stream=stream)
+        except struct.error, e:
+          return offset + 12, 'bad ds64 chunk: %s' % e
+        chunk_size = ds64.riff_size
+        sizes = ds64.Sizes()
+    elif chunk_size == 0xFFFFFFFF and rf64 and len(ends) == 2:
+      if chunk_type not in sizes:
+        return offset, 'no 64-bit size in ds64 for %r' % chunk_type
+      chunk_size = sizes[chunk_type]
+
+    chunk_end = offset + 8 + chunk_size
+    if chunk_end > end:
+      problem = offset, ('%r of size %d ends at %d, beyond the end of the %s'
+                         ' at %d' % (chunk_type, chunk_size, chunk_end,
+                                     (end == size) and 'file' or 'list', end))
+      if len(ends) > 1:
+        return problem
+      # Check the chunks within the file, to find where it was cut short.
+      truncated = problem
+      chunk_end = size
+
+    if len(ends) == 1 or chunk_type in ('LIST', 'RIFF'):
+      if chunk_size < 4:
+        return offset, ('%r of size %d is too small for a list type' %
+                        (chunk_type, chunk_size))
+      if chunk_end - offset < 12:
+        return truncated
+      ends.append(chunk_end)
+      # For RF64 forms this carries on from the ds64 chunk, which is checked
+      # like any other.
+      offset += 12
+      continue
+
+    offset = chunk_end
+    if chunk_size % 2:
+      if offset == end:
+        if truncated and end == size:
+          return truncated
+        return offset, ('the pad byte of %r of size %d is outside its list' %
+                        (chunk_type, chunk_size))
+      stream.seek(offset)
+      if stream.read(1) != '\0':
+        return offset, ('the pad byte of %r of size %d is missing' %
+                        (chunk_type, chunk_size))
+      offset += 1
+
+
+def VerifyFile(filename):
+  """Checks the chunk headers of a RIFF file.
+
+  Args:
+    filename: str, the name of the file.
+
+  Returns:
+    tuple, (int, str), the offset of the first problem and a description of
+    it, or None if the file is sound.
+
+  Raises:
+    IOError, if the file cannot be read.
+  """
+  f = open(filename, 'rb')
+  try:
+    return VerifyStream(f, os.fstat(f.fileno()).st_size)
+  finally:
+    f.close()
+
+
+def _VerifyFileSafely(filename):
+  """Calls VerifyFile, reporting an unreadable file as a problem.
+
+  Returns:
+    tuple, (filename, problem), where problem is as returned by VerifyFile,
+    or (None, str) if the file could not be read.
+  """
+  try:
+    return filename, VerifyFile(filename)
+  except (IOError, OSError), e:
+    return filename, (None, '%s: %s' % (e.__class__.__name__, e))
+
+
+def VerifyFiles(filenames, processes=None, chunksize=16):
+  """Checks files across a pool of processes.
+
+  Args:
+    filenames: sequence of strs, the names of the RIFF files.
+    processes: int, the number of worker processes. Defaults to the number
+               of CPUs; 1 checks in the calling process.
+    chunksize: int, the number of files given to a worker at a time.
+
+  Returns:
+    list of tuples, (filename, problem) in the order of filenames, where
+    problem is None if the file is sound, and otherwise (offset, description)
+    as returned by VerifyFile, with an offset of None if the file could not
+    be read.
+  """
+  if processes == 1:
+    return map(_VerifyFileSafely, filenames)
+  pool = multiprocessing.Pool(processes)
+  try:
+    return list(pool.imap(_VerifyFileSafely, filenames, chunksize))
+  finally:
+    pool.close()
+    pool.join()
+
+
+def main(argv=None):
+  parser = optparse.OptionParser(usage='%prog [options] FILE_OR_GLOB...')
+  parser.add_option('--processes', type='int',
+                    help='the number of worker processes')
+  parser.add_option('--quiet', action='store_true',
+                    help='print only the files with problems')
+  options, args = parser.parse_args(argv)
+  if not args:
+    parser.error('at least one file is required')
+
+  problems = 0
+  for filename, problem in VerifyFiles(riff.batch.ExpandPatterns(args),
+                                       processes=options.processes):
+    if problem:
+      problems += 1
+      offset, error = problem
+    elif options.quiet:
+      continue
+    else:
+      offset, error = None, None
+    print json.dumps({'file': filename, 'offset': offset, 'error': error},
+                     encoding='latin-1', sort_keys=True)
+  return problems and 1 or 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,261 @@
+#!/usr/bin/python2.4
+# (C) Simon Drabble  2008
+# This software is released under the Gnu General Public Licence v2.0.
+# See http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+"""
+Models WAVE audio files, with frame access that reads only what is used.
+
+The data chunk of a WAVE opened lazily or memory-mapped is never read as a
+whole. Samples returns frames as a NumPy array of shape (frames, channels)
+which maps the file, so only the pages holding the frames used are read:
+
+  wav = riff.wave.WAVE(filename='long.wav', lazy=True)
+  rate = wav.Format().sample_rate
+  minute = wav.Samples(600 * rate, 660 * rate)
+  for block in wav.Blocks(rate):
+    ...
+  wav.Close()
+
+Without NumPy, ReadFrames returns the packed frames of a range as a str.
+"""
+
+__author__ = 'Simon Drabble <python-devel@thebigmachine.org>'
+
+
+import mmap
+import struct
+
+import riff
+
+numpy = riff.numpy
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class FmtChunk(riff.Chunk):
+  """Models the fmt chunk, which describes the sample format.
+
+  Any bytes after the 16 of the basic format, such as the extension of
+  WAVE_FORMAT_EXTENSIBLE, are kept in extra.
+  """
+
+  ID = 'fmt '
+  __slots__ = ('format_tag', 'channels', 'sample_rate', 'byte_rate',
+               'block_align', 'bits_per_sample', 'extra')
+  _defaults_ = {'extra': ''}
+  _BASIC_FORMAT = struct.Struct('<HHIIHH')
+
+  def _Pack(self):
+    return self._BASIC_FORMAT.pack(*self._Values()[:6]) + self.extra
+
+  def _Unpack(self, data):
+    data = str(data)
+    basic = self._BASIC_FORMAT.unpack(data[:self._BASIC_FORMAT.size])
+    return basic + (data[self._BASIC_FORMAT.size:],)
+
+  def SampleFormat(self):
+    """Returns the format of the samples.
+
+    For WAVE_FORMAT_EXTENSIBLE this is taken from the sub-format GUID.
+
+    Returns:
+      int, e.g. WAVE_FORMAT_PCM.
+    """
+    if self.format_tag == WAVE_FORMAT_EXTENSIBLE and len(self.extra) >= 10:
+      # cbSize, wValidBitsPerSample, dwChannelMask, then the GUID.
+      return struct.unpack('<H', self.extra[8:10])[0]
+    return self.format_tag
+
+  def SampleType(self):
+    """Returns the NumPy type of one sample.
+
+    24-bit samples have no NumPy type; they are given as 3 bytes each, by a
+    trailing axis of length 3.
+
+    Returns:
+      tuple, (numpy.dtype, int, the length of the trailing axis, or 0).
+
+    Raises:
+      ValueError, if the samples are compressed or of an unknown size.
+    """
+    sample_format = self.SampleFormat()
+    bits = self.bits_per_sample
+    if sample_format == WAVE_FORMAT_PCM:
+      if bits == 8:
+        return numpy.dtype('u1'), 0
+      if bits == 24:
+        return numpy.dtype('u1'), 3
+      if bits in (16, 32):
+        return numpy.dtype('<i%d' % (bits // 8)), 0
+    elif sample_format == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+      return numpy.dtype('<f%d' % (bits // 8)), 0
+    raise ValueError('Unsupported sample format %#x with %d bits' %
+                     (sample_format, bits))
+
+
+class DataChunk(riff.DataStruct):
+  """Models the data chunk, which holds the frames."""
+
+  ID = 'data'
+
+
+class InfoList(riff.LIST):
+  """Models a LIST of INFO text chunks, which are kept as opaque data."""
+
+  ID = 'INFO'
+  _CHUNKBASE = riff.DataStruct
+
+
+class WAVE(riff.RIFF):
+  """Models a WAVE form.
+
+  Chunks other than fmt, data and INFO lists are kept as opaque data.
+  """
+
+  ID = 'WAVE'
+  _CLASSES = {'fmt ': FmtChunk,
+              'data': DataChunk,
+              'INFO': InfoList}
+  _CHUNKBASE = riff.DataStruct
+
+  def _Find(self, chunk_id):
+    """Returns the first element with a given ID, without reading it.
+
+    Returns:
+      tuple, (int, the element number, Chunk or ChunkRef, the element).
+
+    Raises:
+      ValueError, if there is no such element.
+    """
+    for i in xrange(len(self)):
+      item = list.__getitem__(self, i)
+      if item is not None and item.ID == chunk_id:
+        return i, item
+    raise ValueError('WAVE has no %r chunk' % chunk_id)
+
+  def Format(self):
+    """Returns the fmt chunk.
+
+    Returns:
+      FmtChunk
+    """
+    return self[self._Find('fmt ')[0]]
+
+  def FrameCount(self):
+    """Returns the number of frames in the data chunk, without reading it.
+
+    Returns:
+      int
+    """
+    _, data = self._Find('data')
+    if isinstance(data, riff.ChunkRef):
+      size = data.size
+    else:
+      size = len(data.data)
+    return size // self.Format().block_align
+
+  def _FrameRange(self, start, stop):
+    """Clips a range of frames to the data chunk.
+
+    Returns:
+      tuple, (int, int), the first frame and the frame after the last.
+    """
+    count = self.FrameCount()
+    if stop is None or stop > count:
+      stop = count
+    start = max(0, min(start, stop))
+    return start, stop
+
+  def ReadFrames(self, start=0, stop=None):
+    """Reads a range of frames, as they are packed in the file.
+
+    Only the range is read, if the data chunk has not been read already.
+
+    Args:
+      start: int, the first frame.
+      stop: int, the frame after the last, or None for the last frame.
+
+    Returns:
+      str, the packed frames.
+    """
+    start, stop = self._FrameRange(start, stop)
+    block_align = self.Format().block_align
+    _, data = self._Find('data')
+    if isinstance(data, riff.ChunkRef):
+      stream = riff._OwnStream(data.stream,
+                               data.offset + 8 + start * block_align)
+      return stream.read((stop - start) * block_align)
+    return data.data[start * block_align:stop * block_align]
+
+  def Samples(self, start=0, stop=None):
+    """Returns a range of frames as a NumPy array.
+
+    If the data chunk has not been read, the array maps the file, which must
+    be a real file; if it was read from a memory map, the array is a view of
+    the map. Either way no frames are read until the array is used, and then
+    only the pages used.
+
+    Args:
+      start: int, the first frame.
+      stop: int, the frame after the last, or None for the last frame.
+
+    Returns:
+      numpy.ndarray, read-only, of shape (frames, channels), or (frames,
+      channels, 3) for 24-bit samples.
+
+    Raises:
+      ValueError, if the samples are compressed or NumPy is unavailable.
+    """
+    if numpy is None:
+      raise ValueError('Samples needs NumPy; use ReadFrames instead')
+    fmt = self.Format()
+    dtype, width = fmt.SampleType()
+    start, stop = self._FrameRange(start, stop)
+    shape = (stop - start, fmt.channels)
+    if width:
+      shape += (width,)
+    if not shape[0]:
+      return numpy.zeros(shape, dtype)
+    offset = start * fmt.block_align
+    _, data = self._Find('data')
+    if isinstance(data, riff.ChunkRef):
+      offset += data.offset + 8
+      stream = data.stream
+      if isinstance(stream, riff.CountingStream):
+        stream = stream.stream
+      if isinstance(stream, riff.FileCursor):
+        # numpy.memmap moves the position of the stream it is given.
+        stream = stream.Cursor()
+      if not isinstance(stream, mmap.mmap):
+        return numpy.memmap(stream, dtype=dtype, mode='r', offset=offset,
+                            shape=shape)
+      buf = buffer(stream)
+    else:
+      buf = data.data
+    array = numpy.frombuffer(buf, dtype=dtype, count=numpy.prod(shape),
+                             offset=offset)
+    return array.reshape(shape)
+
+  def Blocks(self, frames, start=0, stop=None):
+    """Generates consecutive blocks of frames.
+
+    Args:
+      frames: int, the number of frames in each block. The last block may be
+              shorter.
+      start: int, the first frame.
+      stop: int, the frame after the last, or None for the last frame.
+
+    Yields:
+      numpy.ndarray, as returned by Samples, or str, as returned by
+      ReadFrames, if NumPy is unavailable.
+    """
+    start, stop = self._FrameRange(start, stop)
+    if numpy is None:
+      read = self.ReadFrames
+    else:
+      read = self.Samples
+    for block_start in xrange(start, stop, frames):
+      yield read(block_start, min(block_start + frames, stop))
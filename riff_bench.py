@@ -0,0 +1,429 @@
+#!/usr/bin/python2.4
+# (C) Simon Drabble  2008
+# This software is released under the Gnu General Public Licence v2.0.
+# See http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
+"""
+Benchmarks for the riff module.
+
+A synthetic corpus of RIFF files is generated in a temporary directory, in the
+style of the examples in riff/howto.py:
+
+  flat    - one RIFF holding many small fixed-format chunks.
+  deep    - LISTs nested many levels deep, with a few chunks at each level.
+  tiny    - one RIFF holding a very large number of 2-byte chunks.
+  huge    - a few large opaque data chunks.
+  dwarves - a LIST of variable-length chunks modelled through _CHUNKBASE.
+  records - an index chunk of fixed-format records, read as a
+            MultiRecordList and as a RecordTable.
+
+Each operation is timed on each file: parsing (eager, lazy, mapped and
+buffered),
+accessing one chunk, computing length, repr, Save and a parse-and-save round
+trip. Every measurement runs in a fresh child process, so that its peak
+memory can be recorded too. Results are written as JSON, and can be compared
+with an earlier run:
+
+  python riff_bench.py --output=before.json
+  ...
+  python riff_bench.py --compare=before.json
+"""
+
+__author__ = 'Simon Drabble <python-devel@thebigmachine.org>'
+
+
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import riff
+
+
+class BenchLeaf(riff.Chunk):
+
+  ID = 'leaf'
+  __slots__ = ('frob', 'nitz', 'gonk')
+  _FORMAT = '<IIH'
+
+
+class BenchTiny(riff.Chunk):
+
+  ID = 'tiny'
+  __slots__ = ('value',)
+  _FORMAT = '<H'
+
+
+class BenchBlob(riff.DataStruct):
+
+  ID = 'blob'
+
+
+class BenchFlat(riff.RIFF):
+
+  ID = 'flat'
+  _CLASSES = {'leaf': BenchLeaf,
+              'tiny': BenchTiny,
+              'blob': BenchBlob}
+
+
+class BenchNest(riff.LIST):
+
+  ID = 'nest'
+  _CLASSES = {'leaf': BenchLeaf}
+
+BenchNest._CLASSES['nest'] = BenchNest
+
+
+class BenchDeep(riff.RIFF):
+
+  ID = 'deep'
+  _CLASSES = {'nest': BenchNest}
+
+
+class BenchDwarfStruct(riff.Chunk):
+
+  __slots__ = ('colour', 'food')
+
+  def _Unpack(self, data):
+    l1, = struct.unpack('B', data[0])
+    d1, = struct.unpack('%ds' % l1, data[1:l1+1])
+    l2, = struct.unpack('B', data[l1+1])
+    d2, = struct.unpack('%ds' % l2, data[l1+2:])
+    return (d1, d2)
+
+  def _Pack(self):
+    return riff.PackVar(chr(len(self.colour)), self.colour,
+                        chr(len(self.food)), self.food)
+
+
+class BenchDwarfList(riff.LIST):
+
+  ID = 'dwrf'
+  _CHUNKBASE = BenchDwarfStruct
+
+
+class BenchDwarves(riff.RIFF):
+
+  ID = 'modo'
+  _CLASSES = {'dwrf': BenchDwarfList}
+
+
+class BenchRecord(riff.Chunk):
+
+  ID = 'rec '
+  __slots__ = ('chunk_id', 'flags', 'offset', 'size')
+  _FORMAT = '<4sIII'
+
+
+class BenchRecordList(riff.MultiRecordList):
+
+  ID = 'idx1'
+  _RECORD_STRUCT = BenchRecord
+
+
+class BenchRecordTable(riff.RecordTable):
+
+  ID = 'idx1'
+  _RECORD_STRUCT = BenchRecord
+
+
+class BenchRecords(riff.RIFF):
+
+  ID = 'recs'
+  _CLASSES = {'idx1': BenchRecordList}
+
+
+class BenchRecordsTable(riff.RIFF):
+
+  ID = 'recs'
+  _CLASSES = {'idx1': BenchRecordTable}
+
+
+def MakeFlat(writer, scale):
+  for i in xrange(20000 * scale):
+    writer.WriteChunk(BenchLeaf(frob=i, nitz=i * 2, gonk=i % 65536))
+
+
+def MakeDeep(writer, scale):
+  for i in xrange(20 * scale):
+    for depth in xrange(50):
+      writer.BeginList('nest')
+      writer.WriteChunk(BenchLeaf(frob=i, nitz=depth, gonk=0))
+    for depth in xrange(50):
+      writer.EndList()
+
+
+def MakeTiny(writer, scale):
+  for i in xrange(100000 * scale):
+    writer.WriteChunk(BenchTiny(value=i % 65536))
+
+
+def MakeHuge(writer, scale):
+  block = '\xa5' * (1 << 20)
+  for i in xrange(4):
+    writer.BeginChunk('blob')
+    for j in xrange(8 * scale):
+      writer.WriteData(block)
+    writer.EndChunk()
+
+
+def MakeDwarves(writer, scale):
+  writer.BeginList('dwrf')
+  for i in xrange(10000 * scale):
+    dwarf = BenchDwarfStruct(colour='colour%d' % i, food='food%d' % i)
+    dwarf.ID = 'd%03d' % (i % 1000)
+    writer.WriteChunk(dwarf)
+  writer.EndList()
+
+
+def MakeRecords(writer, scale):
+  writer.BeginChunk('idx1')
+  for i in xrange(100000 * scale):
+    writer.WriteData(struct.pack('<4sIII', 'leaf', 16, i * 18, 10))
+  writer.EndChunk()
+
+
+def AccessFirst(form):
+  return form[0]
+
+
+def AccessLast(form):
+  return form[-1]
+
+
+def AccessDeep(form):
+  node = form[-1]
+  while len(node) > 1:
+    node = node[-1]
+  return node[0]
+
+
+def AccessDwarf(form):
+  return form[0][-1].food
+
+
+def AccessRecord(form):
+  return form[0][len(form[0]) // 2].offset
+
+
+# name: (form ID, generator, [(form name, form class)], access function)
+CORPUS = {
+    'flat': ('flat', MakeFlat, [('', BenchFlat)], AccessLast),
+    'deep': ('deep', MakeDeep, [('', BenchDeep)], AccessDeep),
+    'tiny': ('flat', MakeTiny, [('', BenchFlat)], AccessLast),
+    'huge': ('flat', MakeHuge, [('', BenchFlat)], AccessLast),
+    'dwarves': ('modo', MakeDwarves, [('', BenchDwarves)], AccessDwarf),
+    'records': ('recs', MakeRecords,
+                [('list', BenchRecords), ('table', BenchRecordsTable)],
+                AccessRecord),
+}
+
+OPERATIONS = ('parse', 'parse_lazy', 'parse_mmap', 'parse_buffered', 'access',
+              'length', 'repr', 'save', 'roundtrip')
+
+
+def Generate(directory, scale):
+  """Writes the corpus files.
+
+  Args:
+    directory: str, the directory to write to.
+    scale: int, multiplies the number or size of chunks in each file.
+
+  Returns:
+    dict, {corpus name: file name}.
+  """
+  filenames = {}
+  for name, (form_id, generator, _, _) in CORPUS.items():
+    filename = os.path.join(directory, name + '.riff')
+    f = open(filename, 'wb')
+    writer = riff.RIFFWriter(f, form_id)
+    generator(writer, scale)
+    writer.Close()
+    f.close()
+    filenames[name] = filename
+  return filenames
+
+
+def _MaxRSS():
+  """Returns the peak resident set size of this process, in KB."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def RunOperation(operation, form_class, filename, access, scratch):
+  """Performs one operation once.
+
+  Args:
+    operation: str, one of OPERATIONS.
+    form_class: class, the RIFF subclass modelling the file.
+    filename: str, the file to operate on.
+    access: function, accesses one chunk of a form.
+    scratch: str, the name of a file which may be written.
+
+  Returns:
+    float, the time taken in seconds, excluding any setup.
+  """
+  if operation in ('access', 'length', 'repr', 'save'):
+    lazy = operation == 'access'
+    form = form_class(filename=filename, lazy=lazy)
+  start = time.time()
+  if operation == 'parse':
+    form_class(filename=filename)
+  elif operation == 'parse_lazy':
+    form_class(filename=filename, lazy=True).Close()
+  elif operation == 'parse_mmap':
+    form_class(filename=filename, mmap=True).Close()
+  elif operation == 'parse_buffered':
+    form_class(filename=filename, buffered=True)
+  elif operation == 'access':
+    access(form)
+  elif operation == 'length':
+    form.length
+  elif operation == 'repr':
+    repr(form)
+  elif operation == 'save':
+    form.Save(scratch)
+  elif operation == 'roundtrip':
+    form_class(filename=filename).Save(scratch)
+  elapsed = time.time() - start
+  if operation == 'access':
+    form.Close()
+  return elapsed
+
+
+def _Measure(queue, operation, form_class, filename, access, scratch,
+             repeat):
+  """Times an operation in a child process and reports it through queue."""
+  try:
+    base_rss = _MaxRSS()
+    seconds = min([RunOperation(operation, form_class, filename, access,
+                                scratch)
+                   for _ in xrange(repeat)])
+    queue.put((seconds, _MaxRSS() - base_rss, None))
+  except Exception, e:
+    queue.put((None, None, '%s: %s' % (e.__class__.__name__, e)))
+
+
+def Measure(operation, form_class, filename, access, scratch, repeat):
+  """Times an operation in a fresh child process.
+
+  Returns:
+    tuple, (best time in seconds, peak memory growth in KB, error).
+  """
+  queue = multiprocessing.Queue()
+  process = multiprocessing.Process(
+      target=_Measure,
+      args=(queue, operation, form_class, filename, access, scratch, repeat))
+  process.start()
+  result = queue.get()
+  process.join()
+  return result
+
+
+def Run(scale=1, repeat=3, corpus=None, operations=OPERATIONS):
+  """Generates the corpus and measures every operation on it.
+
+  Args:
+    scale: int, multiplies the size of the corpus.
+    repeat: int, the number of times to time each operation; the best time
+            is kept.
+    corpus: sequence of strs, the corpus names to run, or None for all.
+    operations: sequence of strs, the operations to run.
+
+  Returns:
+    dict, with 'meta' describing the run and 'results', a list of dicts.
+  """
+  directory = tempfile.mkdtemp(prefix='riff_bench')
+  try:
+    filenames = Generate(directory, scale)
+    scratch = os.path.join(directory, 'scratch.riff')
+    results = []
+    for name in sorted(corpus or CORPUS):
+      _, _, forms, access = CORPUS[name]
+      size = os.path.getsize(filenames[name])
+      for form_name, form_class in forms:
+        for operation in operations:
+          seconds, peak_kb, error = Measure(operation, form_class,
+                                            filenames[name], access, scratch,
+                                            repeat)
+          result = {'corpus': name, 'form': form_name,
+                    'operation': operation, 'bytes': size,
+                    'seconds': seconds, 'peak_kb': peak_kb, 'error': error}
+          if seconds:
+            result['mb_per_s'] = size / seconds / (1 << 20)
+          results.append(result)
+  finally:
+    shutil.rmtree(directory)
+  meta = {'python': platform.python_version(), 'platform': platform.platform(),
+          'scale': scale, 'repeat': repeat, 'time': time.time()}
+  return {'meta': meta, 'results': results}
+
+
+def _Key(result):
+  return (result['corpus'], result['form'], result['operation'])
+
+
+def Compare(old, new):
+  """Formats a comparison of two runs.
+
+  Args:
+    old: dict, the earlier results, as returned by Run.
+    new: dict, the later results.
+
+  Returns:
+    str, one line per measurement, with the ratio of new time to old time.
+  """
+  old_results = dict([(_Key(result), result) for result in old['results']])
+  lines = ['%-24s %10s %10s %7s %10s %10s' %
+           ('measurement', 'old s', 'new s', 'ratio', 'old KB', 'new KB')]
+  for result in new['results']:
+    previous = old_results.get(_Key(result))
+    if not previous or not previous['seconds'] or not result['seconds']:
+      continue
+    lines.append('%-24s %10.4f %10.4f %7.2f %10d %10d' %
+                 ('/'.join([part for part in _Key(result) if part]),
+                  previous['seconds'], result['seconds'],
+                  result['seconds'] / previous['seconds'],
+                  previous['peak_kb'], result['peak_kb']))
+  return '\n'.join(lines)
+
+
+def main(argv=None):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--scale', type='int', default=1,
+                    help='multiplies the size of the corpus')
+  parser.add_option('--repeat', type='int', default=3,
+                    help='times to run each measurement; the best is kept')
+  parser.add_option('--corpus', action='append', choices=sorted(CORPUS),
+                    help='a corpus file to run; may be repeated')
+  parser.add_option('--operation', action='append', choices=OPERATIONS,
+                    help='an operation to run; may be repeated')
+  parser.add_option('--output', help='write the JSON results to this file')
+  parser.add_option('--compare', help='compare with JSON results in this file')
+  options, _ = parser.parse_args(argv)
+
+  results = Run(scale=options.scale, repeat=options.repeat,
+                corpus=options.corpus,
+                operations=options.operation or OPERATIONS)
+  data = json.dumps(results, indent=1, sort_keys=True)
+  if options.output:
+    f = open(options.output, 'w')
+    f.write(data)
+    f.close()
+  if options.compare:
+    f = open(options.compare)
+    print Compare(json.load(f), results)
+    f.close()
+  elif not options.output:
+    print data
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
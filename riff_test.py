@@ -7,10 +7,20 @@
 __author__ = 'Simon Drabble <python-devel@thebigmachine.org>'
 
 
+import asyncore
+import json
+import os
+import socket
 import struct
 from StringIO import StringIO
+import tempfile
+import threading
 import unittest
 import riff
+import riff.batch
+import riff.incremental
+import riff.verify
+import riff.wave
 
 
 class MockSimpleRiff(riff.RIFF):
@@ -105,6 +115,14 @@ class MockDwarfRiff(riff.RIFF):
               'addr': MockDwrfAddr}
 
 
+class MockPaddedRiff(riff.RIFF):
+
+  ID = 'modo'
+  __slots__ = ('doc_', 'herb')
+  _CLASSES = {'doc_': MockDwarfStruct,
+              'herb': MockHerbChunk}
+
+
 class FromStreamTest(unittest.TestCase):
 
   def testRiffFromStreamSimple(self):
@@ -165,5 +183,1504 @@ class FromStreamTest(unittest.TestCase):
     self.assertEqual('haggis', the_riff.dwrf[2].food)
 
 
+class LazyTest(unittest.TestCase):
+
+  _PACKED = struct.pack('<4sI4s4sI4s4sIII4sIIH',
+                        'RIFF', 46, 'Tlst',
+                        'LIST', 34, 'tlst',
+                        'herb', 8, 4, 42,
+                        'spce', 6, 2, 65535)
+
+  def testElementsReadOnAccess(self):
+    the_riff = MockRiffWithList(stream=StringIO(self._PACKED), lazy=True)
+    self.assertTrue(isinstance(list.__getitem__(the_riff, 0), riff.ChunkRef))
+    the_list = the_riff.tlst
+    self.assertTrue(isinstance(the_list, MockListForRiffWithList))
+    self.assertTrue(isinstance(list.__getitem__(the_list, 1), riff.ChunkRef))
+    self.assertEqual(42, the_list.herb.sage)
+    self.assertTrue(isinstance(list.__getitem__(the_list, 1), riff.ChunkRef))
+    self.assertEqual(65535, the_list[1].paprika)
+
+  def testRoundTrip(self):
+    the_riff = MockRiffWithList(stream=StringIO(self._PACKED), lazy=True)
+    self.assertEqual(self._PACKED, repr(the_riff))
+
+  def testFromFile(self):
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, self._PACKED)
+    os.close(fd)
+    try:
+      the_riff = MockRiffWithList(filename=filename, lazy=True)
+      self.assertEqual(2, the_riff.tlst.spce.nutmeg)
+      the_riff.Close()
+    finally:
+      os.remove(filename)
+
+  _JUNK_PACKED = struct.pack('<4sI4s4sI3sx4sIB3sB4sx4sIII', 'RIFF', 50,
+                             'modo', 'JUNK', 3, 'abc',
+                             'doc_', 9, 3, 'red', 4, 'cake',
+                             'herb', 8, 4, 42)
+
+  def testJunkSkipped(self):
+    for lazy in (False, True):
+      the_riff = MockPaddedRiff(stream=StringIO(self._JUNK_PACKED), lazy=lazy)
+      self.assertEqual(2, len(the_riff))
+      self.assertEqual('cake', the_riff.doc_.food)
+      self.assertEqual(42, the_riff.herb.sage)
+
+  def testPaddedChunk(self):
+    packed = struct.pack('<4sI4s4sIB3sB4sx4sIII', 'RIFF', 38, 'modo',
+                         'doc_', 9, 3, 'red', 4, 'cake',
+                         'herb', 8, 4, 42)
+    for lazy in (False, True):
+      the_riff = MockPaddedRiff(stream=StringIO(packed), lazy=lazy)
+      self.assertEqual('cake', the_riff.doc_.food)
+      self.assertEqual(42, the_riff.herb.sage)
+
+
+class MockDataChunk(riff.DataStruct):
+  pass
+
+
+class MockDataRiff(riff.RIFF):
+
+  ID = 'test'
+  __slots__ = ('tlst', 'data')
+  _CLASSES = {'tlst': MockListForRiffWithList}
+  _CHUNKBASE = MockDataChunk
+
+
+class MmapTest(unittest.TestCase):
+
+  _PACKED = struct.pack('<4sI4s4sI4s4sIII4sIIH4sI5sx',
+                        'RIFF', 60, 'test',
+                        'LIST', 34, 'tlst',
+                        'herb', 8, 4, 42,
+                        'spce', 6, 2, 65535,
+                        'data', 5, 'abcde')
+
+  def setUp(self):
+    fd, self._filename = tempfile.mkstemp()
+    os.write(fd, self._PACKED)
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self._filename)
+
+  def testMapped(self):
+    for lazy in (False, True):
+      the_riff = MockDataRiff(filename=self._filename, mmap=True, lazy=lazy)
+      self.assertTrue(isinstance(the_riff.data.data, buffer))
+      self.assertEqual('abcde', str(the_riff.data.data))
+      self.assertEqual(42, the_riff.tlst.herb.sage)
+      self.assertEqual(self._PACKED, repr(the_riff))
+      the_riff.Close()
+
+
+class WriterTest(unittest.TestCase):
+
+  _PACKED = struct.pack('<4sI4s4sI4s4sIII4sIIH4sI5sx',
+                        'RIFF', 60, 'test',
+                        'LIST', 34, 'tlst',
+                        'herb', 8, 4, 42,
+                        'spce', 6, 2, 65535,
+                        'data', 5, 'abcde')
+
+  def testWriteIncrementally(self):
+    out = StringIO()
+    writer = riff.RIFFWriter(out, 'test')
+    writer.BeginList('tlst')
+    writer.WriteChunk(MockHerbChunk(chervil=4, sage=42))
+    writer.WriteChunk(MockSpceChunk(nutmeg=2, paprika=65535))
+    writer.EndList()
+    writer.BeginChunk('data')
+    writer.WriteData('abc')
+    writer.WriteData('de')
+    writer.EndChunk()
+    writer.Close()
+    self.assertEqual(self._PACKED, out.getvalue())
+
+  def testWriteList(self):
+    the_riff = MockDataRiff(raw_data=self._PACKED)
+    out = StringIO()
+    writer = riff.RIFFWriter(out, 'test')
+    for item in the_riff:
+      writer.WriteChunk(item)
+    writer.Close()
+    self.assertEqual(repr(the_riff), out.getvalue())
+
+  def testUnendedChunk(self):
+    writer = riff.RIFFWriter(StringIO(), 'test')
+    writer.BeginChunk('data')
+    self.assertRaises(ValueError, writer.BeginList, 'tlst')
+
+  def testSave(self):
+    the_riff = MockDataRiff(raw_data=self._PACKED)
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      the_riff.Save(filename)
+      f = open(filename, 'rb')
+      self.assertEqual(self._PACKED, f.read())
+      f.close()
+    finally:
+      os.remove(filename)
+
+
+class ChunkIndexTest(unittest.TestCase):
+
+  _PACKED = MmapTest._PACKED
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._filename = os.path.join(self._dir, 'test.riff')
+    f = open(self._filename, 'wb')
+    f.write(self._PACKED)
+    f.close()
+
+  def tearDown(self):
+    for name in os.listdir(self._dir):
+      os.remove(os.path.join(self._dir, name))
+    os.rmdir(self._dir)
+
+  def testBuild(self):
+    index = riff.ChunkIndex.Build(self._filename)
+    self.assertEqual([('RIFF', 'test', 0, 60, -1),
+                      ('LIST', 'tlst', 12, 34, 0),
+                      ('herb', 'herb', 24, 8, 1),
+                      ('spce', 'spce', 40, 6, 1),
+                      ('data', 'data', 54, 5, 0)], index.entries)
+    self.assertEqual(('test', 'tlst', 'spce'), index.Path(3))
+    self.assertEqual(3, index.Find(('tlst', 'spce')))
+    self.assertEqual(None, index.Find(('tlst', 'data')))
+
+  def testOpenSavesIndex(self):
+    index = riff.ChunkIndex.Open(self._filename, cache_dir=self._dir)
+    loaded = riff.ChunkIndex.Load(self._filename, cache_dir=self._dir)
+    self.assertEqual(index.entries, loaded.entries)
+    self.assertEqual(None, riff.ChunkIndex.Load(self._filename))
+
+  def testStaleIndex(self):
+    riff.ChunkIndex.Open(self._filename)
+    f = open(self._filename, 'ab')
+    f.write('JUNK\0\0\0\0')
+    f.close()
+    self.assertEqual(None, riff.ChunkIndex.Load(self._filename))
+
+  def testReadFromIndex(self):
+    index = riff.ChunkIndex.Open(self._filename)
+    the_riff = MockDataRiff(filename=self._filename, index=index)
+    self.assertEqual(42, the_riff.tlst.herb.sage)
+    self.assertEqual('abcde', the_riff.data.data)
+    self.assertEqual(self._PACKED, repr(the_riff))
+    the_riff.Close()
+
+
+class CodecTest(unittest.TestCase):
+
+  def testCompiledStruct(self):
+    self.assertEqual(struct.calcsize('<I6s'), MockFooChunk._STRUCT.size)
+    self.assertEqual(0, MockDwarfStruct._STRUCT.size)
+
+  def testFromTuples(self):
+    herbs = MockHerbChunk.FromTuples([(1, 2), (3, 4)])
+    self.assertEqual([1, 3], [herb.chervil for herb in herbs])
+    self.assertEqual([2, 4], [herb.sage for herb in herbs])
+    self.assertEqual(struct.pack('<II', 3, 4), herbs[1]._Pack())
+
+  def testFromBuffer(self):
+    data = struct.pack('<xIIIIII', 1, 2, 3, 4, 5, 6)
+    herbs = MockHerbChunk.FromBuffer(buffer(data), offset=1)
+    self.assertEqual([(1, 2), (3, 4), (5, 6)],
+                     [(herb.chervil, herb.sage) for herb in herbs])
+    herbs = MockHerbChunk.FromBuffer(data, offset=9, count=1)
+    self.assertEqual(3, herbs[0].chervil)
+
+  def testKeywordTypes(self):
+
+    class MockTypedChunk(riff.Chunk):
+      ID = 'type'
+      __slots__ = ('count', 'name')
+      _FORMAT = '<I4s'
+      _types_ = {'count': int}
+
+    self.assertEqual(3, MockTypedChunk(count=3, name='abcd').count)
+    self.assertRaises(AttributeError, MockTypedChunk, count='3')
+
+  def testKeywordSlots(self):
+
+    class MockKeywordChunk(riff.Chunk):
+      ID = 'kwds'
+      __slots__ = ('from', 'to')
+      _FORMAT = '<HH'
+
+    class MockKeywordList(riff.LIST):
+      ID = 'kwds'
+      __slots__ = ('from', 'with')
+      _CHUNKBASE = riff.DataStruct
+
+    chunk = MockKeywordChunk(raw_data=struct.pack('<HH', 1, 2))
+    self.assertEqual((1, 2), chunk._Values())
+    self.assertEqual(struct.pack('<HH', 1, 2), chunk._Pack())
+    packed = struct.pack('<4sI4s4sI2s', 'LIST', 14, 'kwds', 'from', 2, 'ab')
+    the_list = MockKeywordList(stream=StringIO(packed))
+    self.assertEqual('ab', getattr(the_list, 'from').data)
+
+
+class AutoClassTest(unittest.TestCase):
+
+  _PACKED = struct.pack('<4sI4s4sIB3sB4s4sIB6sB6s',
+                        'LIST', 43, 'dwrf',
+                        'doc_', 9, 3, 'red', 4, 'cake',
+                        'dopy', 14, 6, 'yellow', 6, 'apples')
+
+  def tearDown(self):
+    riff.FreezeAutoClasses(False)
+
+  def testClassReused(self):
+    first = MockDwrfList(raw_data=self._PACKED)
+    second = MockDwrfList(raw_data=self._PACKED)
+    self.assertTrue(first.doc_.__class__ is second.doc_.__class__)
+    self.assertTrue(isinstance(first.doc_, MockDwarfStruct))
+    self.assertEqual('doc_', first.doc_.ID)
+    self.assertTrue(first.dopy.__class__ is
+                    riff.AutoClass(MockDwrfList, 'dopy'))
+
+  def testFrozen(self):
+    riff.PreloadAutoClasses(MockDwrfList)
+    riff.FreezeAutoClasses()
+    self.assertEqual('apples', MockDwrfList(raw_data=self._PACKED).dopy.food)
+    self.assertRaises(AttributeError, riff.AutoClass, MockDwrfList, 'hppy')
+
+
+class LengthTest(unittest.TestCase):
+
+  def testMatchesRepr(self):
+    for packed, cls in ((LazyTest._PACKED, MockRiffWithList),
+                        (MmapTest._PACKED, MockDataRiff)):
+      the_riff = cls(raw_data=packed)
+      self.assertEqual(len(packed), the_riff.length)
+      self.assertEqual(len(repr(the_riff[0])), the_riff[0].length)
+
+  def testVariableLength(self):
+
+    class MockTextChunk(riff.Chunk):
+      ID = 'text'
+      __slots__ = ('text',)
+
+      def _Pack(self):
+        return self.text
+
+    chunk = MockTextChunk(text='abc')
+    self.assertEqual(12, chunk.length)
+    chunk.text = 'abcd'
+    self.assertEqual(len(repr(chunk)), chunk.length)
+
+  def testPackTo(self):
+    the_riff = MockDataRiff(raw_data=MmapTest._PACKED)
+    buf = bytearray('abc')
+    the_riff.PackTo(buf)
+    the_riff.PackTo(buf)
+    self.assertEqual('abc' + MmapTest._PACKED * 2, str(buf))
+
+  def testLazyListNotRead(self):
+    the_riff = MockRiffWithList(stream=StringIO(LazyTest._PACKED), lazy=True)
+    self.assertEqual(len(LazyTest._PACKED), the_riff.length)
+    self.assertTrue(isinstance(list.__getitem__(the_riff, 0), riff.ChunkRef))
+
+  def testFieldSetInvalidates(self):
+    the_riff = MockDataRiff(raw_data=MmapTest._PACKED)
+    self.assertEqual(len(MmapTest._PACKED), the_riff.length)
+    the_riff.data.data = 'abcdefgh'
+    self.assertEqual(len(repr(the_riff)), the_riff.length)
+    self.assertEqual(len(MmapTest._PACKED) + 2, the_riff.length)
+
+  def testListChangeInvalidates(self):
+    the_riff = MockRiffWithList(raw_data=LazyTest._PACKED)
+    the_list = the_riff.tlst
+    self.assertEqual(len(LazyTest._PACKED), the_riff.length)
+    the_list.append(MockHerbChunk(chervil=1, sage=2))
+    self.assertEqual(len(repr(the_riff)), the_riff.length)
+    the_list.insert(0, MockSpceChunk(nutmeg=1, paprika=2))
+    self.assertEqual(len(repr(the_riff)), the_riff.length)
+    del the_list[1]
+    self.assertEqual(len(repr(the_riff)), the_riff.length)
+    the_list.pop()
+    self.assertEqual(len(repr(the_riff)), the_riff.length)
+
+
+class MockCueRecord(riff.Chunk):
+
+  ID = 'cue '
+  __slots__ = ('position', 'flags', 'name')
+  _FORMAT = '<IH4s'
+
+
+class MockCueTable(riff.RecordTable):
+
+  ID = 'cues'
+  _RECORD_STRUCT = MockCueRecord
+
+
+class MockCueList(riff.MultiRecordList):
+
+  ID = 'cues'
+  _RECORD_STRUCT = MockCueRecord
+
+
+class MockAlignedRecord(riff.Chunk):
+
+  ID = 'algn'
+  __slots__ = ('first', 'second', 'third')
+  _FORMAT = 'BIB'
+
+
+class MockAlignedTable(riff.RecordTable):
+
+  ID = 'algn'
+  _RECORD_STRUCT = MockAlignedRecord
+
+
+class MockIndexRecord(riff.Chunk):
+
+  ID = 'idx1'
+  __slots__ = ('chunk_id', 'flags', 'offset', 'size')
+  _FORMAT = '<4sLLL'
+
+
+class MockIndexTable(riff.RecordTable):
+
+  ID = 'idx1'
+  _RECORD_STRUCT = MockIndexRecord
+
+
+class MockPadRecord(riff.Chunk):
+
+  ID = 'pads'
+  __slots__ = ('first', 'second', 'third')
+  _FORMAT = '<lB3xI'
+
+
+class MockPadTable(riff.RecordTable):
+
+  ID = 'pads'
+  _RECORD_STRUCT = MockPadRecord
+
+
+class RecordTableTest(unittest.TestCase):
+
+  _RECORDS = struct.pack('<IH4sIH4sIH4s', 1, 10, 'abcd', 2, 20, 'efgh',
+                         3, 30, 'ijkl')
+
+  def testDecode(self):
+    table = MockCueTable(raw_data=self._RECORDS)
+    records = MockCueList(raw_data=self._RECORDS)
+    self.assertEqual(3, len(table))
+    for record, expected in zip(table, records):
+      self.assertEqual(expected._Values(), record._Values())
+    self.assertEqual('efgh', table[-2].name)
+    self.assertEqual([10, 20, 30], list(table.Column('flags')))
+
+  def testRepr(self):
+    table = MockCueTable(stream=StringIO(self._RECORDS))
+    self.assertEqual('cues' + self._RECORDS, repr(table))
+    self.assertEqual(len(repr(table)), table.length)
+
+  def testAppendAndSet(self):
+    table = MockCueTable(raw_data=self._RECORDS)
+    self.assertEqual(4 + len(self._RECORDS), table.length)
+    table.append(MockCueRecord(position=4, flags=40, name='mnop'))
+    table[0] = MockCueRecord(position=5, flags=50, name='qrst')
+    self.assertEqual(4, len(table))
+    self.assertEqual(40, table[3].flags)
+    self.assertEqual(len(repr(table)), table.length)
+    self.assertEqual(struct.pack('<IH4s', 5, 50, 'qrst'), repr(table)[4:14])
+
+  def testNativeAlignment(self):
+    data = struct.pack('BIB', 1, 2, 3) + struct.pack('BIB', 4, 5, 6)
+    table = MockAlignedTable(raw_data=data)
+    self.assertEqual([2, 5], list(table.Column('second')))
+    self.assertEqual('algn' + data, repr(table))
+
+  def testStandardSizes(self):
+    data = struct.pack('<4sLLL4sLLL', 'data', 16, 4, 100, 'junk', 0, 112, 8)
+    table = MockIndexTable(raw_data=data)
+    self.assertEqual(['data', 'junk'], list(table.Column('chunk_id')))
+    self.assertEqual([16, 0], list(table.Column('flags')))
+    self.assertEqual([4, 112], list(table.Column('offset')))
+    self.assertEqual([100, 8], list(table.Column('size')))
+    self.assertEqual('idx1' + data, repr(table))
+
+  def testPadBytes(self):
+    data = (struct.pack('<lB3xI', -1, 2, 3) +
+            struct.pack('<lB3xI', 4, 5, 0xFFFFFFFF))
+    table = MockPadTable(raw_data=data)
+    self.assertEqual([-1, 4], list(table.Column('first')))
+    self.assertEqual([2, 5], list(table.Column('second')))
+    self.assertEqual([3, 0xFFFFFFFF], list(table.Column('third')))
+    self.assertEqual('pads' + data, repr(table))
+
+  def testInsertAndDelete(self):
+    table = MockCueTable(raw_data=self._RECORDS)
+    table.insert(1, MockCueRecord(position=4, flags=40, name='mnop'))
+    self.assertEqual([1, 4, 2, 3], list(table.Column('position')))
+    del table[0]
+    self.assertEqual([4, 2, 3], list(table.Column('position')))
+    self.assertRaises(IndexError, table.__delitem__, 3)
+    table.remove(MockCueRecord(position=2, flags=20, name='efgh'))
+    self.assertRaises(ValueError, table.remove,
+                      MockCueRecord(position=2, flags=20, name='efgh'))
+    self.assertEqual('ijkl', table.pop().name)
+    self.assertEqual(1, len(table))
+    self.assertEqual(len(repr(table)), table.length)
+    self.assertEqual('cues' + struct.pack('<IH4s', 4, 40, 'mnop'),
+                     repr(table))
+
+  def testTruncated(self):
+    self.assertRaises(struct.error, MockCueTable, raw_data=self._RECORDS[:-1])
+
+  def testLazy(self):
+    class MockCueRiff(riff.RIFF):
+      ID = 'cuer'
+      _CLASSES = {'cues': MockCueTable}
+
+    packed = struct.pack('<4sI4s4sI', 'RIFF', 38, 'cuer', 'cues', 30)
+    packed += self._RECORDS
+    the_riff = MockCueRiff(stream=StringIO(packed), lazy=True)
+    self.assertEqual([1, 2, 3], list(the_riff[0].Column('position')))
+
+
+class RecordTableWithoutNumpyTest(RecordTableTest):
+
+  def setUp(self):
+    self._numpy = riff.numpy
+    riff.numpy = None
+
+  def tearDown(self):
+    riff.numpy = self._numpy
+
+
+class MockTableList(riff.ChunkTable):
+
+  ID = 'tlst'
+  __slots__ = ('herb', 'spce')
+  _CLASSES = MockListForRiffWithList._CLASSES
+
+
+class MockTableRiff(riff.ChunkTable, riff.RIFF):
+
+  ID = 'test'
+  __slots__ = ('tlst', 'data')
+  _CLASSES = {'tlst': MockTableList}
+  _CHUNKBASE = MockDataChunk
+
+
+class ChunkTableTest(unittest.TestCase):
+
+  def testRead(self):
+    the_riff = MockTableRiff(stream=StringIO(MmapTest._PACKED))
+    self.assertEqual(2, len(the_riff))
+    self.assertEqual(MmapTest._PACKED, repr(the_riff))
+    self.assertEqual(len(MmapTest._PACKED), the_riff.length)
+    self.assertEqual('abcde', the_riff.data.data)
+    the_list = the_riff.tlst
+    self.assertTrue(isinstance(the_list, MockTableList))
+    self.assertEqual(42, the_list.herb.sage)
+    self.assertEqual([65535], [item.paprika for item in the_list[1:]])
+    # Fixed-format elements are held as columns, not as data.
+    self.assertEqual(0, len(the_list._data))
+
+  def testModify(self):
+    the_list = MockTableList(stream=StringIO(LazyTest._PACKED[12:]))
+    herb = the_list[0]
+    herb.sage = 7
+    self.assertEqual(42, the_list.herb.sage)
+    the_list[0] = herb
+    class MockNoteTable(MockTableList):
+      _CHUNKBASE = riff.DataStruct
+    the_list = MockNoteTable(stream=StringIO(repr(the_list)))
+    the_list.append(riff.AutoClass(MockNoteTable, 'note')(data='xyz'))
+    self.assertEqual(7, the_list.herb.sage)
+    self.assertEqual('xyz', the_list[2].data)
+    self.assertEqual(54, the_list.length)
+    packed = repr(the_list)
+    self.assertEqual(packed, repr(MockNoteTable(stream=StringIO(packed))))
+    self.assertRaises(IndexError, the_list.__getitem__, 3)
+
+  def testBuild(self):
+    the_list = MockTableList(herb=MockHerbChunk(chervil=4, sage=42),
+                             spce=MockSpceChunk(nutmeg=2, paprika=65535))
+    self.assertEqual(LazyTest._PACKED[12:], repr(the_list))
+    self.assertEqual(12, MockTableList().length)
+    self.assertRaises(ValueError, MockTableRiff,
+                      stream=StringIO(MmapTest._PACKED), select=['data'])
+
+  def testJunk(self):
+    packed = LazyTest._PACKED[12:24] + 'JUNK\0\0\0\0' + LazyTest._PACKED[24:]
+    packed = struct.pack('<4sI', 'LIST', len(packed) - 8) + packed[8:]
+    the_list = MockTableList(stream=StringIO(packed))
+    self.assertEqual(['herb', 'spce'], [item.ID for item in the_list])
+    self.assertEqual(65535, the_list.spce.paprika)
+
+  def testInsertAndDelete(self):
+    the_list = MockTableList(stream=StringIO(LazyTest._PACKED[12:]))
+    the_list.insert(0, MockSpceChunk(nutmeg=3, paprika=7))
+    self.assertEqual(3, len(the_list))
+    self.assertEqual([3, 2], [the_list[0].nutmeg, the_list[2].nutmeg])
+    del the_list[1]
+    self.assertEqual(['spce', 'spce'], [item.ID for item in the_list])
+    self.assertEqual(len(repr(the_list)), the_list.length)
+    self.assertRaises(IndexError, the_list.__delitem__, 2)
+    the_list.remove(MockSpceChunk(nutmeg=2, paprika=65535))
+    self.assertEqual([3], [item.nutmeg for item in the_list])
+    self.assertRaises(ValueError, the_list.remove,
+                      MockHerbChunk(chervil=1, sage=1))
+    self.assertEqual(7, the_list.pop().paprika)
+    self.assertEqual(0, len(the_list))
+    self.assertRaises(IndexError, the_list.pop)
+    empty = MockTableList()
+    empty.insert(5, MockHerbChunk(chervil=4, sage=42))
+    self.assertEqual(42, empty[0].sage)
+
+
+class WalkTest(unittest.TestCase):
+
+  def testEvents(self):
+    events = list(riff.Walk(StringIO(MmapTest._PACKED)))
+    self.assertEqual([(riff.ENTER_LIST, 'RIFF', 'test', 0, 60),
+                      (riff.ENTER_LIST, 'LIST', 'tlst', 12, 34),
+                      (riff.CHUNK, 'herb', 'herb', 24, 8),
+                      (riff.CHUNK, 'spce', 'spce', 40, 6),
+                      (riff.EXIT_LIST, 'LIST', 'tlst', 12, 34),
+                      (riff.CHUNK, 'data', 'data', 54, 5),
+                      (riff.EXIT_LIST, 'RIFF', 'test', 0, 60)], events)
+
+  def testReadPayload(self):
+    stream = StringIO(MmapTest._PACKED)
+    payloads = {}
+    for event, _, chunk_id, _, size in riff.Walk(stream):
+      if event == riff.CHUNK:
+        payloads[chunk_id] = stream.read(size)
+    self.assertEqual('abcde', payloads['data'])
+    self.assertEqual(struct.pack('<IH', 2, 65535), payloads['spce'])
+
+  def testTruncated(self):
+    events = list(riff.Walk(StringIO(MmapTest._PACKED[:30])))
+    self.assertEqual((riff.EXIT_LIST, 'RIFF', 'test', 0, 60), events[-1])
+    self.assertEqual(riff.EXIT_LIST, events[-2][0])
+
+
+class MockBigSpceChunk(riff.Chunk):
+
+  ID = 'spce'
+  __slots__ = ('nutmeg', 'paprika', 'cumin')
+  _FORMAT = '<IHQ'
+
+
+class EditorTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self._filename = tempfile.mkstemp()
+    os.write(fd, MmapTest._PACKED)
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self._filename)
+
+  def _Read(self):
+    f = open(self._filename, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+  def _Chunks(self):
+    """Returns the chunks of the file as (path, data), checking the sizes."""
+    data = self._Read()
+    index = riff.ChunkIndex(stream=StringIO(data))
+    self.assertEqual(len(data), 8 + index.entries[0][3])
+    chunks = []
+    for entry, (header, _, offset, size, _) in enumerate(index.entries):
+      if header not in ('RIFF', 'LIST'):
+        chunks.append(('/'.join(index.Path(entry)[1:]),
+                       data[offset + 8:offset + 8 + size]))
+    return chunks
+
+  def testSameSize(self):
+    editor = riff.RIFFEditor(self._filename)
+    editor.Replace('tlst/herb', MockHerbChunk(chervil=5, sage=6))
+    editor.Close()
+    the_riff = MockDataRiff(filename=self._filename)
+    self.assertEqual(6, the_riff.tlst.herb.sage)
+    self.assertEqual(len(MmapTest._PACKED), len(self._Read()))
+
+  def testMoveChunk(self):
+    editor = riff.RIFFEditor(self._filename)
+    editor.Replace('data', riff.DataStruct(data='a' * 20))
+    editor.Close()
+    chunks = self._Chunks()
+    # The old chunk and its pad byte become a JUNK chunk.
+    self.assertEqual(('JUNK', 'abcde\0'), chunks[-2])
+    self.assertEqual(('data', 'a' * 20), chunks[-1])
+
+  def testShrinkLeavesJunk(self):
+    editor = riff.RIFFEditor(self._filename)
+    editor.Replace('data', riff.DataStruct(data='a' * 20))
+    size = len(self._Read())
+    editor.Replace(('data',), riff.DataStruct(data='bcd'))
+    editor.Close()
+    self.assertEqual(size, len(self._Read()))
+    chunks = self._Chunks()
+    self.assertEqual(('data', 'bcd'), chunks[-2])
+    self.assertEqual('JUNK', chunks[-1][0])
+
+  def testMoveList(self):
+    editor = riff.RIFFEditor(self._filename)
+    editor.Replace('tlst/spce', MockBigSpceChunk(nutmeg=1, paprika=2,
+                                                 cumin=3))
+    editor.Close()
+    # The elements after the list are moved with it, keeping their order.
+    self.assertEqual(['JUNK', 'tlst/herb', 'tlst/spce', 'data'],
+                     [path for path, _ in self._Chunks()])
+    data = self._Read()
+    index = riff.ChunkIndex(stream=StringIO(data))
+    entry = index.Find(('tlst', 'spce'))
+    offset = index.entries[entry][2]
+    self.assertEqual((1, 2, 3), struct.unpack('<IHQ',
+                                              data[offset + 8:offset + 22]))
+
+  def _Dwarves(self):
+    """Writes the dwarves form without and then with pad bytes to the file.
+
+    Yields:
+      tuple, (str, bool), the form and True if it has pad bytes.
+    """
+    padded = struct.pack('<4sI4s4sI4s4sIB3sB4sx4sIB6sB6s4sIB5sB6sx4sI20s12s',
+                         'RIFF', 118, 'modo',
+                         'LIST', 66, 'dwrf',
+                         'doc_', 9, 3, 'red', 4, 'cake',
+                         'dopy', 14, 6, 'yellow', 6, 'apples',
+                         'snzy', 13, 5, 'black', 6, 'haggis',
+                         'addr', 32, '1, Fairy Tale Lane\0\0\0',
+                         'Dwarfton\0\0\0\0')
+    for packed in (SelectTest._PACKED, padded):
+      f = open(self._filename, 'wb')
+      f.write(packed)
+      f.close()
+      yield packed, packed is padded
+
+  def _Check(self, padded):
+    """Checks the structure of the file, and its pad bytes if it has any."""
+    data = self._Read()
+    index = riff.ChunkIndex(stream=StringIO(data))
+    self.assertEqual(len(data), 8 + index.entries[0][3])
+    if padded:
+      self.assertEqual(None, riff.verify.VerifyFile(self._filename))
+
+  def testShrinkKeepsSlots(self):
+    for packed, padded in self._Dwarves():
+      editor = riff.RIFFEditor(self._filename)
+      editor.Replace('dwrf/dopy', riff.DataStruct(data='\x01a\x01b'))
+      editor.Close()
+      self.assertEqual(len(packed), len(self._Read()))
+      self._Check(padded)
+      the_riff = MockDwarfRiff(filename=self._filename)
+      self.assertEqual(['doc_', 'dopy', 'snzy'],
+                       [item.ID for item in the_riff.dwrf])
+      self.assertEqual('a', the_riff.dwrf.dopy.colour)
+      self.assertEqual('haggis', the_riff.dwrf.snzy.food)
+      self.assertEqual('Dwarfton\0\0\0\0', the_riff.addr.city)
+
+  def testGrowKeepsSlots(self):
+    for _, padded in self._Dwarves():
+      editor = riff.RIFFEditor(self._filename)
+      editor.Replace('dwrf/doc_',
+                     riff.DataStruct(data='\x05green\x07custard'))
+      editor.Close()
+      self._Check(padded)
+      the_riff = MockDwarfRiff(filename=self._filename)
+      self.assertEqual(['dwrf', 'addr'], [item.ID for item in the_riff])
+      self.assertEqual('custard', the_riff.dwrf.doc_.food)
+      self.assertEqual('apples', the_riff.dwrf.dopy.food)
+      self.assertEqual('haggis', the_riff.dwrf.snzy.food)
+      self.assertEqual('Dwarfton\0\0\0\0', the_riff.addr.city)
+      for lazy in (False, True):
+        the_riff = MockDwarfRiff(filename=self._filename, lazy=lazy)
+        self.assertEqual('black', the_riff.dwrf.snzy.colour)
+        the_riff.Close()
+      index = riff.ChunkIndex.Build(self._filename)
+      the_riff = MockDwarfRiff(filename=self._filename, index=index)
+      self.assertEqual('Dwarfton\0\0\0\0', the_riff.addr.city)
+      the_riff.Close()
+
+  def testMissingChunk(self):
+    editor = riff.RIFFEditor(self._filename)
+    self.assertRaises(ValueError, editor.Replace, 'tlst/data',
+                      riff.DataStruct(data=''))
+    editor.Close()
+
+
+class AppenderTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self._filename = tempfile.mkstemp()
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self._filename)
+
+  def _Write(self, data):
+    f = open(self._filename, 'wb')
+    f.write(data)
+    f.close()
+
+  def _Read(self):
+    f = open(self._filename, 'rb')
+    data = f.read()
+    f.close()
+    self.assertEqual(None, riff.verify.VerifyStream(StringIO(data), len(data)))
+    return data
+
+  def testAppendToList(self):
+    self._Write(LazyTest._PACKED)
+    appender = riff.RIFFAppender(self._filename, 'tlst', sync_bytes=0)
+    appender.Append(MockHerbChunk(chervil=5, sage=6))
+    appender.Flush()
+    self.assertEqual(3, len(MockRiffWithList(stream=StringIO(
+        self._Read())).tlst))
+    appender.Append(MockHerbChunk(chervil=7, sage=8))
+    appender.Close()
+    the_list = MockRiffWithList(stream=StringIO(self._Read())).tlst
+    self.assertEqual([42, 65535, 6, 8],
+                     [the_list[0].sage, the_list[1].paprika,
+                      the_list[2].sage, the_list[3].sage])
+
+  def testAppendToForm(self):
+    self._Write(LazyTest._PACKED)
+    appender = riff.RIFFAppender(self._filename)
+    appender.Append(MockListForRiffWithList(stream=StringIO(
+        LazyTest._PACKED[12:])))
+    appender.Close()
+    self.assertEqual(2, len(MockRiffWithList(stream=StringIO(self._Read()))))
+
+  def testAppendRecords(self):
+    class MockCueRiff(riff.RIFF):
+      ID = 'cuer'
+      _CLASSES = {'cues': MockCueTable}
+
+    packed = struct.pack('<4sI4s4sI', 'RIFF', 42, 'cuer', 'cues', 30)
+    self._Write(packed + RecordTableTest._RECORDS)
+    appender = riff.RIFFAppender(self._filename, ['cues'])
+    appender.AppendRecords([MockCueRecord(position=4, flags=40, name='mnop')])
+    appender.AppendData('x')
+    appender.Close()
+    data = self._Read()
+    self.assertEqual(struct.pack('<4sI4s4sI', 'RIFF', 54, 'cuer', 'cues', 41),
+                     data[:20])
+    self.assertEqual('x\0', data[-2:])
+    appender = riff.RIFFAppender(self._filename, 'cues')
+    appender.AppendData('yz' + RecordTableTest._RECORDS[:7])
+    appender.Close()
+    the_riff = MockCueRiff(stream=StringIO(self._Read()))
+    self.assertEqual([1, 2, 3, 4, 0x017A7978],
+                     list(the_riff[0].Column('position')))
+
+  def testRF64(self):
+    self._Write(RF64Test('testRead')._Write(True, 100))
+    appender = riff.RIFFAppender(self._filename, 'data')
+    appender.AppendData('y' * 5)
+    appender.Close()
+    the_riff = MockDataRiff(stream=StringIO(self._Read()))
+    self.assertEqual('x' * 100 + 'y' * 5, the_riff[0].data)
+
+  def testErrors(self):
+    self._Write(MmapTest._PACKED)
+    self.assertRaises(ValueError, riff.RIFFAppender, self._filename, 'tlst')
+    self.assertRaises(ValueError, riff.RIFFAppender, self._filename,
+                      'data/herb')
+    appender = riff.RIFFAppender(self._filename, 'data')
+    self.assertRaises(ValueError, appender.Append, MockHerbChunk(chervil=1,
+                                                                 sage=2))
+    appender.Close()
+    appender = riff.RIFFAppender(self._filename)
+    self.assertRaises(ValueError, appender.AppendData, 'x')
+    appender.Close()
+    self._Write(MmapTest._PACKED + 'trailing')
+    self.assertRaises(ValueError, riff.RIFFAppender, self._filename)
+
+
+class MockSmallWriter(riff.RIFFWriter):
+
+  _MAX_SIZE = 64
+
+
+class MockIdDataChunk(riff.DataStruct):
+
+  ID = 'data'
+
+
+class MockSlotDataRiff(riff.RIFF):
+
+  ID = 'test'
+  __slots__ = ('data',)
+  _CLASSES = {'data': MockIdDataChunk}
+
+
+class RF64Test(unittest.TestCase):
+
+  def _Write(self, rf64, size):
+    out = StringIO()
+    writer = MockSmallWriter(out, 'test', rf64=rf64)
+    writer.BeginChunk('data')
+    writer.WriteData('x' * size)
+    writer.EndChunk()
+    writer.Close()
+    return out.getvalue()
+
+  def testPromoted(self):
+    data = self._Write(True, 100)
+    self.assertEqual(('RF64', 0xFFFFFFFF, 'test', 'ds64', 28),
+                     struct.unpack('<4sI4s4sI', data[:20]))
+    self.assertEqual((len(data) - 8, 100, 0, 0),
+                     struct.unpack('<QQQI', data[20:48]))
+    self.assertEqual(('data', 0xFFFFFFFF), struct.unpack('<4sI', data[48:56]))
+
+  def testRead(self):
+    data = self._Write(True, 100)
+    the_riff = MockDataRiff(stream=StringIO(data))
+    self.assertEqual(1, len(the_riff))
+    self.assertTrue(isinstance(list.__getitem__(the_riff, 0), riff.ChunkRef))
+    self.assertEqual(100, list.__getitem__(the_riff, 0).size)
+    self.assertEqual('x' * 100, the_riff[0].data)
+
+  def testFromFile(self):
+    fd, filename = tempfile.mkstemp()
+    os.write(fd, self._Write(True, 100))
+    os.close(fd)
+    fd, saved = tempfile.mkstemp()
+    os.close(fd)
+    try:
+      the_riff = MockDataRiff(filename=filename)
+      self.assertEqual('x' * 100, the_riff[0].data)
+      the_riff.Save(saved)
+      the_riff.Close()
+      f = open(saved, 'rb')
+      data = f.read()
+      f.close()
+      # Space for the ds64 chunk is reserved again.
+      self.assertEqual(('RIFF', 'test', 'JUNK'),
+                       struct.unpack('<4s4x4s4s', data[:16]))
+      self.assertEqual('x' * 100, MockDataRiff(raw_data=data)[0].data)
+    finally:
+      os.remove(filename)
+      os.remove(saved)
+
+  def testWriteLargeChunk(self):
+    out = StringIO()
+    data_chunk = riff.AutoClass(MockDataRiff, 'data')(data='x' * 100)
+    writer = MockSmallWriter(out, 'test', rf64=True)
+    writer.WriteChunk(data_chunk)
+    writer.Close()
+    self.assertEqual(self._Write(True, 100), out.getvalue())
+    writer = MockSmallWriter(StringIO(), 'test')
+    self.assertRaises(ValueError, writer.WriteChunk, data_chunk)
+
+  def testWalk(self):
+    events = list(riff.Walk(StringIO(self._Write(True, 100))))
+    self.assertEqual([(riff.ENTER_LIST, 'RF64', 'test', 0, 148),
+                      (riff.CHUNK, 'ds64', 'ds64', 12, 28),
+                      (riff.CHUNK, 'data', 'data', 48, 100),
+                      (riff.EXIT_LIST, 'RF64', 'test', 0, 148)], events)
+
+  def testNotPromoted(self):
+    data = self._Write(True, 10)
+    self.assertEqual(('RIFF', len(data) - 8, 'test', 'JUNK', 28),
+                     struct.unpack('<4sI4s4sI', data[:20]))
+
+  def testNotPromotedRoundTrip(self):
+    # The JUNK chunk reserved for ds64 is skipped, so it takes no slot.
+    data = self._Write(True, 10)
+    the_riff = MockSlotDataRiff(raw_data=data)
+    self.assertEqual(1, len(the_riff))
+    self.assertEqual('x' * 10, the_riff.data.data)
+    out = StringIO()
+    writer = riff.RIFFWriter(out, 'test', rf64=True)
+    for item in the_riff:
+      writer.WriteChunk(item)
+    writer.Close()
+    self.assertEqual(data, out.getvalue())
+
+  def testTooLarge(self):
+    self.assertRaises(ValueError, self._Write, False, 100)
+
+
+class InstrumentTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stats = riff.Stats()
+    riff.SetHook(self.stats)
+
+  def tearDown(self):
+    riff.SetHook(None)
+
+  def testDecode(self):
+    the_riff = MockRiffWithList(stream=StringIO(LazyTest._PACKED))
+    totals = self.stats.totals
+    self.assertEqual(1, totals[('herb', 'MockHerbChunk')]['decoded'])
+    self.assertEqual(16, totals[('herb', 'MockHerbChunk')]['bytes'])
+    self.assertEqual(2, totals[('herb', 'MockHerbChunk')]['reads'])
+    self.assertEqual(14, totals[('spce', 'MockSpceChunk')]['bytes'])
+    self.assertEqual(1, totals[('tlst', 'MockListForRiffWithList')]['decoded'])
+    self.assertEqual(0, totals[('herb', 'MockHerbChunk')]['encoded'])
+    repr(the_riff)
+    self.assertEqual(1, totals[('herb', 'MockHerbChunk')]['encoded'])
+    self.assertTrue(self.stats.Report().splitlines()[1:])
+
+  def testLazy(self):
+    the_riff = MockRiffWithList(stream=StringIO(LazyTest._PACKED), lazy=True)
+    totals = self.stats.totals
+    self.assertEqual(0, totals[('tlst', 'MockListForRiffWithList')]['decoded'])
+    the_riff.tlst.herb
+    self.assertEqual(1, totals[('herb', 'MockHerbChunk')]['decoded'])
+    self.assertFalse(('spce', 'MockSpceChunk') in totals and
+                     totals[('spce', 'MockSpceChunk')]['decoded'])
+
+  def testDisabled(self):
+    riff.SetHook(None)
+    MockRiffWithList(stream=StringIO(LazyTest._PACKED))
+    self.assertEqual({}, self.stats.totals)
+
+
+class CacheTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self._filename = tempfile.mkstemp()
+    os.write(fd, MmapTest._PACKED)
+    os.close(fd)
+    self.cache = riff.ChunkCache()
+    riff.SetCache(self.cache)
+
+  def tearDown(self):
+    riff.SetCache(None)
+    os.remove(self._filename)
+
+  def testHits(self):
+    first = MockDataRiff(filename=self._filename)
+    self.assertEqual(3, self.cache.misses)
+    second = MockDataRiff(filename=self._filename)
+    self.assertEqual(3, self.cache.hits)
+    self.assertEqual(MmapTest._PACKED, repr(second))
+    self.assertFalse(first.data is second.data)
+    second.tlst.herb.sage = 7
+    self.assertEqual(42, MockDataRiff(filename=self._filename).tlst.herb.sage)
+
+  def testLazy(self):
+    MockDataRiff(filename=self._filename)
+    the_riff = MockDataRiff(filename=self._filename, lazy=True)
+    self.assertEqual('abcde', the_riff.data.data)
+    the_riff.Close()
+    self.assertEqual(1, self.cache.hits)
+
+  def testFileChanged(self):
+    MockDataRiff(filename=self._filename)
+    os.utime(self._filename, (0, 0))
+    MockDataRiff(filename=self._filename)
+    self.assertEqual(0, self.cache.hits)
+
+  def testBudget(self):
+    self.cache.max_bytes = 8
+    MockDataRiff(filename=self._filename)
+    self.assertTrue(self.cache.size <= 8)
+    self.assertEqual(2, self.cache.evictions)
+    self.assertEqual(1, self.cache.Stats()['entries'])
+
+
+class SelectTest(unittest.TestCase):
+
+  _PACKED = struct.pack('<4sI4s4sI4s4sIB3sB4s4sIB6sB6s4sIB5sB6s4sI20s12s',
+                        'RIFF', 116, 'modo',
+                        'LIST', 64, 'dwrf',
+                        'doc_', 9, 3, 'red', 4, 'cake',
+                        'dopy', 14, 6, 'yellow', 6, 'apples',
+                        'snzy', 13, 5, 'black', 6, 'haggis',
+                        'addr', 32, '1, Fairy Tale Lane\0\0\0',
+                        'Dwarfton\0\0\0\0')
+
+  def testPartialTree(self):
+    the_riff = MockDwarfRiff(stream=StringIO(self._PACKED),
+                             select=['dwrf/snzy'])
+    self.assertEqual(None, the_riff.addr)
+    self.assertEqual(None, the_riff.dwrf.doc_)
+    self.assertEqual('black', the_riff.dwrf.snzy.colour)
+
+  def testPatterns(self):
+    the_riff = MockDwarfRiff(raw_data=self._PACKED, select=['dwrf/d*'])
+    self.assertEqual('cake', the_riff.dwrf.doc_.food)
+    self.assertEqual('apples', the_riff.dwrf.dopy.food)
+    self.assertEqual(None, the_riff.dwrf.snzy)
+
+  def testSelect(self):
+    chunks = riff.Select(MockDwarfRiff, ['addr', 'dwrf/s*'],
+                         stream=StringIO(self._PACKED))
+    self.assertEqual(['snzy', 'addr'], [chunk.ID for chunk in chunks])
+    chunks = riff.Select(MockDwarfRiff, 'dwrf', stream=StringIO(self._PACKED))
+    self.assertEqual(3, len(chunks[0]))
+
+  def testLazy(self):
+    the_riff = MockDwarfRiff(stream=StringIO(self._PACKED), lazy=True,
+                             select=['addr'])
+    self.assertEqual(None, the_riff.dwrf)
+    self.assertEqual('Dwarfton\0\0\0\0', the_riff.addr.city)
+
+
+class WaveTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self._filename = tempfile.mkstemp()
+    f = os.fdopen(fd, 'wb')
+    writer = riff.RIFFWriter(f, 'WAVE')
+    writer.WriteChunk(riff.wave.FmtChunk(format_tag=1, channels=2,
+                                         sample_rate=8000, byte_rate=32000,
+                                         block_align=4, bits_per_sample=16))
+    writer.BeginList('INFO')
+    info = riff.DataStruct(data='title\0')
+    info.ID = 'INAM'
+    writer.WriteChunk(info)
+    writer.EndList()
+    writer.BeginChunk('data')
+    self._frames = [(i, -i) for i in xrange(100)]
+    for left, right in self._frames:
+      writer.WriteData(struct.pack('<hh', left, right))
+    writer.EndChunk()
+    writer.Close()
+    f.close()
+
+  def tearDown(self):
+    os.remove(self._filename)
+
+  def _Open(self):
+    return [riff.wave.WAVE(filename=self._filename),
+            riff.wave.WAVE(filename=self._filename, lazy=True),
+            riff.wave.WAVE(filename=self._filename, mmap=True),
+            riff.wave.WAVE(filename=self._filename, mmap=True, lazy=True),
+            riff.wave.WAVE(filename=self._filename, shared=True)]
+
+  def testFormat(self):
+    wav = riff.wave.WAVE(filename=self._filename, lazy=True)
+    self.assertEqual(8000, wav.Format().sample_rate)
+    self.assertEqual(100, wav.FrameCount())
+    self.assertTrue(isinstance(list.__getitem__(wav, 2), riff.ChunkRef))
+    wav.Close()
+    packed = open(self._filename, 'rb').read()
+    self.assertEqual(packed, repr(riff.wave.WAVE(raw_data=packed)))
+
+  def testReadFrames(self):
+    expected = ''.join([struct.pack('<hh', *frame)
+                        for frame in self._frames[10:20]])
+    for wav in self._Open():
+      self.assertEqual(expected, str(wav.ReadFrames(10, 20)))
+      blocks = list(wav.Blocks(30))
+      if riff.numpy is None:
+        self.assertEqual(400, len(''.join(map(str, blocks))))
+      else:
+        self.assertEqual(100, sum(map(len, blocks)))
+      del blocks
+      wav.Close()
+
+  def testSamples(self):
+    if riff.numpy is None:
+      wav = riff.wave.WAVE(filename=self._filename)
+      self.assertRaises(ValueError, wav.Samples)
+      return
+    for wav in self._Open():
+      samples = wav.Samples(10, 20)
+      self.assertEqual((10, 2), samples.shape)
+      self.assertEqual([[12, -12], [13, -13]], samples[2:4].tolist())
+      self.assertEqual([30, 30, 30, 10],
+                       [len(block) for block in wav.Blocks(30)])
+      del samples
+      wav.Close()
+
+  def testSamplesCounted(self):
+    if riff.numpy is None:
+      return
+    riff.SetHook(riff.Stats())
+    try:
+      for wav in self._Open():
+        samples = wav.Samples(10, 20)
+        self.assertEqual([[12, -12], [13, -13]], samples[2:4].tolist())
+        del samples
+        wav.Close()
+    finally:
+      riff.SetHook(None)
+
+
+class ReadAheadTest(unittest.TestCase):
+
+  def _Pipe(self, data):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    os.close(write_fd)
+    return os.fdopen(read_fd, 'rb')
+
+  def testPipe(self):
+    for block_size in (3, 7, 4096):
+      pipe = self._Pipe(LazyTest._PACKED)
+      stream = riff.ReadAheadStream(pipe, block_size=block_size)
+      the_riff = MockRiffWithList(stream=stream)
+      pipe.close()
+      self.assertEqual(LazyTest._PACKED, repr(the_riff))
+
+  def testBuffered(self):
+    packed = struct.pack('<4sI4s4sIB3sB4sx4sIII', 'RIFF', 38, 'modo',
+                         'doc_', 9, 3, 'red', 4, 'cake',
+                         'herb', 8, 4, 42)
+    pipe = self._Pipe(packed)
+    the_riff = MockPaddedRiff(stream=pipe, buffered=True)
+    pipe.close()
+    self.assertEqual('cake', the_riff.doc_.food)
+    self.assertEqual(42, the_riff.herb.sage)
+
+  def testSeek(self):
+    pipe = self._Pipe('abcdefghij' * 20)
+    stream = riff.ReadAheadStream(pipe, block_size=4)
+    self.assertEqual('ab', stream.read(2))
+    stream.seek(7)
+    self.assertEqual(7, stream.tell())
+    self.assertEqual('hij', stream.read(3))
+    stream.seek(-3, 1)
+    self.assertEqual('hij' + 'abcdefghij' * 19, stream.read())
+    self.assertRaises(IOError, stream.seek, 0)
+    pipe.close()
+
+  def testFewerReads(self):
+    counted = riff.CountingStream(StringIO(MmapTest._PACKED))
+    MockDataRiff(stream=counted)
+    buffered = riff.CountingStream(StringIO(MmapTest._PACKED))
+    MockDataRiff(stream=riff.ReadAheadStream(buffered))
+    self.assertEqual(2, buffered.reads)
+    self.assertEqual(0, buffered.seeks)
+    self.assertTrue(counted.reads > 5)
+
+
+class MockSharedList(riff.LIST):
+
+  ID = 'tlst'
+  _CHUNKBASE = riff.DataStruct
+
+
+class MockSharedRiff(riff.RIFF):
+
+  ID = 'test'
+  _CLASSES = {'tlst': MockSharedList}
+
+
+class SharedTest(unittest.TestCase):
+
+  def setUp(self):
+    fd, self._filename = tempfile.mkstemp()
+    chunks = ''.join([struct.pack('<4sI%ds' % (i + 1), 'd%03d' % i, i + 1,
+                                  chr(65 + i % 26) * (i + 1)) +
+                      '\0' * ((i + 1) % 2) for i in xrange(100)])
+    os.write(fd, struct.pack('<4sI4s4sI4s', 'RIFF', len(chunks) + 16, 'test',
+                             'LIST', len(chunks) + 4, 'tlst') + chunks)
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self._filename)
+
+  def testCursors(self):
+    for use_mmap in (True, False):
+      shared = riff.PositionalFile(self._filename, use_mmap=use_mmap)
+      first = shared.Cursor(4)
+      second = first.Cursor()
+      self.assertEqual('RIFF', second.read(4))
+      self.assertEqual('test', first.read(8)[4:])
+      self.assertEqual(12, first.tell())
+      first.seek(-1, 2)
+      self.assertEqual(chr(65 + 99 % 26), first.read())
+      self.assertEqual('', first.read(5))
+      shared.Close()
+
+  def testThreads(self):
+    the_riff = MockSharedRiff(filename=self._filename, shared=True)
+    the_list = the_riff[0]
+    refs = [list.__getitem__(the_list, i) for i in xrange(len(the_list))]
+    errors = []
+
+    def Load(start):
+      for repeat in xrange(20):
+        for i in range(start, 100) + range(start):
+          data = refs[i].Load().data
+          if data != chr(65 + i % 26) * (i + 1):
+            errors.append((i, data))
+
+    threads = [threading.Thread(target=Load, args=(i * 12,))
+               for i in xrange(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    the_riff.Close()
+    self.assertEqual([], errors[:1])
+
+  def testCounted(self):
+    riff.SetHook(riff.Stats())
+    try:
+      the_riff = MockSharedRiff(filename=self._filename, shared=True)
+      ref = list.__getitem__(the_riff, 0)
+      self.assertTrue(isinstance(ref.stream, riff.CountingStream))
+      position = ref.stream.tell()
+      own = riff._OwnStream(ref.stream, 0)
+      self.assertFalse(own is ref.stream)
+      self.assertEqual('RIFF', own.read(4))
+      self.assertEqual(position, ref.stream.tell())
+      self.assertEqual('B' * 2, the_riff[0][1].data)
+      the_riff.Close()
+    finally:
+      riff.SetHook(None)
+
+
+class IncrementalTest(unittest.TestCase):
+
+  def _Feed(self, form_class, packed, block_size):
+    reader = riff.incremental.IncrementalReader(form_class)
+    completed = []
+    for i in xrange(0, len(packed), block_size):
+      completed.extend(reader.Feed(packed[i:i + block_size]))
+    return reader.Close(), completed
+
+  def testByteByByte(self):
+    for block_size in (1, 5, 1000):
+      form, completed = self._Feed(MockRiffWithList, LazyTest._PACKED,
+                                   block_size)
+      self.assertEqual(LazyTest._PACKED, repr(form))
+      self.assertEqual(['herb', 'spce', 'tlst', 'Tlst'],
+                       [chunk.ID for chunk in completed])
+
+  def testPadded(self):
+    packed = struct.pack('<4sI4s4sIB3sB4sx4sIII', 'RIFF', 38, 'modo',
+                         'doc_', 9, 3, 'red', 4, 'cake',
+                         'herb', 8, 4, 42)
+    form, _ = self._Feed(MockPaddedRiff, packed, 3)
+    self.assertEqual('cake', form.doc_.food)
+    self.assertEqual(42, form.herb.sage)
+
+  def testJunk(self):
+    form, completed = self._Feed(MockPaddedRiff, LazyTest._JUNK_PACKED, 3)
+    self.assertEqual(3, len(completed))
+    self.assertEqual('cake', form.doc_.food)
+    self.assertEqual(42, form.herb.sage)
+
+  def testErrors(self):
+    reader = riff.incremental.IncrementalReader(MockRiffWithList)
+    reader.Feed(LazyTest._PACKED[:30])
+    self.assertRaises(ValueError, reader.Close)
+    reader = riff.incremental.IncrementalReader(MockDwarfRiff)
+    self.assertRaises(ValueError, reader.Feed, LazyTest._PACKED)
+
+  def testSocket(self):
+    socket_map = {}
+    sender_sock, receiver_sock = socket.socketpair()
+    receiver = riff.incremental.RIFFReceiver(receiver_sock, MockRiffWithList,
+                                             map=socket_map)
+    sender = riff.incremental.RIFFSender(sender_sock, map=socket_map)
+    sender.Send(MockRiffWithList(stream=StringIO(LazyTest._PACKED)))
+    sender.close_when_done()
+    asyncore.loop(timeout=1, map=socket_map, count=100)
+    self.assertEqual(None, receiver.error)
+    self.assertEqual(LazyTest._PACKED, repr(receiver.form))
+
+
+class MockFieldDwarfStruct(riff.Chunk):
+
+  __slots__ = ('colour', 'food')
+  _FIELDS = (riff.PrefixedString(), riff.PrefixedString())
+
+
+class MockPoint(riff.Struct):
+
+  __slots__ = ('x', 'y')
+  _FIELDS = (riff.Fixed('<h'), riff.Fixed('<h'))
+
+
+class MockPathChunk(riff.Chunk):
+
+  ID = 'path'
+  __slots__ = ('flags', 'name', 'label', 'weights', 'origin', 'points')
+  _FIELDS = (riff.Fixed('<H'), riff.ZeroString(), riff.ZeroString(6),
+             riff.Array(riff.Fixed('<i')), riff.Nested(MockPoint),
+             riff.Array(riff.Nested(MockPoint), count='B'))
+
+
+class FieldsTest(unittest.TestCase):
+
+  def testDwarf(self):
+    data = struct.pack('B3sB4s', 3, 'red', 4, 'cake')
+    dwarf = MockFieldDwarfStruct(raw_data=data)
+    self.assertEqual(('red', 'cake'), (dwarf.colour, dwarf.food))
+    self.assertEqual(data, dwarf._Pack())
+    self.assertEqual(18, dwarf.length)
+
+  def testRoundTrip(self):
+    path = MockPathChunk(flags=3, name='home', label='ab',
+                         weights=[1, -2, 3], origin=MockPoint(x=-1, y=7),
+                         points=[MockPoint(x=1, y=2), MockPoint(x=3, y=4)])
+    packed = repr(path)
+    self.assertEqual(struct.pack('<4sIH5s6sI3ihhBhhhh', 'path', 42, 3,
+                                 'home', 'ab', 3, 1, -2, 3, -1, 7,
+                                 2, 1, 2, 3, 4), packed)
+    for data in (packed[8:], buffer(packed, 8)):
+      read = MockPathChunk(raw_data=data)
+      self.assertEqual('home', read.name)
+      self.assertEqual('ab', read.label)
+      self.assertEqual([1, -2, 3], read.weights)
+      self.assertEqual((-1, 7), (read.origin.x, read.origin.y))
+      self.assertEqual([(1, 2), (3, 4)], [(p.x, p.y) for p in read.points])
+      self.assertEqual(packed, repr(read))
+
+  def testUnterminated(self):
+    class MockName(riff.Chunk):
+      __slots__ = ('name',)
+      _FIELDS = (riff.ZeroString(),)
+    self.assertEqual('bare', MockName(raw_data='bare').name)
+
+  def testKeywordSlots(self):
+    class MockRange(riff.Chunk):
+      __slots__ = ('from', 'to', 'in')
+      _FIELDS = (riff.Fixed('<H'), riff.Fixed('<H'), riff.ZeroString())
+    data = struct.pack('<HH3s', 1, 2, 'ab\0')
+    the_range = MockRange(raw_data=data)
+    self.assertEqual((1, 2, 'ab'), the_range._Values())
+    self.assertEqual(data, the_range._Pack())
+
+  def testStringArrays(self):
+    class MockTags(riff.Chunk):
+      __slots__ = ('tags', 'codes', 'gaps')
+      _FIELDS = (riff.Array(riff.Fixed('<4s')), riff.Array(riff.Fixed('<c')),
+                 riff.Array(riff.Fixed('<2xH'), count='B'))
+    data = struct.pack('<I4s4sIccB2xH2xH', 2, 'abcd', 'efgh', 2, 'x', 'y',
+                       2, 7, 9)
+    tags = MockTags(raw_data=data)
+    self.assertEqual(['abcd', 'efgh'], tags.tags)
+    self.assertEqual(['x', 'y'], tags.codes)
+    self.assertEqual([7, 9], tags.gaps)
+    self.assertEqual(data, tags._Pack())
+    tags = MockTags(tags=[], codes=['z'], gaps=[])
+    self.assertEqual(struct.pack('<IIcB', 0, 1, 'z', 0), tags._Pack())
+
+  def testErrors(self):
+    data = struct.pack('B3sB4s', 3, 'red', 9, 'cake')
+    self.assertRaises(struct.error, MockFieldDwarfStruct, raw_data=data)
+    self.assertRaises(struct.error, MockPathChunk, raw_data='\x03\x00a')
+    def Define():
+      class MockShort(riff.Chunk):
+        __slots__ = ('a', 'b')
+        _FIELDS = (riff.Fixed('<I'),)
+    self.assertRaises(TypeError, Define)
+    # An item of two values has no single decoded value.
+    self.assertRaises(ValueError, riff.Fixed, '<2H')
+    self.assertRaises(ValueError, riff.Fixed, '<HH')
+
+
+class BatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._filenames = []
+    contents = (LazyTest._PACKED, 'RIFF\0\0', LazyTest._PACKED)
+    for i, packed in enumerate(contents):
+      filename = os.path.join(self._dir, '%d.riff' % i)
+      f = open(filename, 'wb')
+      f.write(packed)
+      f.close()
+      self._filenames.append(filename)
+
+  def tearDown(self):
+    for filename in self._filenames:
+      os.remove(filename)
+    os.rmdir(self._dir)
+
+  def testParseFiles(self):
+    for processes in (1, 2):
+      results = riff.batch.ParseFiles(self._filenames, MockRiffWithList,
+                                      select=['tlst.herb.sage', 'tlst.1'],
+                                      processes=processes)
+      self.assertEqual(self._filenames, [r[0] for r in results])
+      self.assertEqual({'tlst.herb.sage': 42,
+                        'tlst.1': {'ID': 'spce', 'nutmeg': 2,
+                                   'paprika': 65535}}, results[0][1])
+      self.assertEqual(None, results[1][1])
+      self.assertTrue(results[1][2].startswith('error: '))
+      self.assertEqual(None, results[2][2])
+
+  def testPlainForm(self):
+    result = riff.batch.ParseFile(self._filenames[0], MockRiffWithList)
+    self.assertEqual([[{'ID': 'herb', 'chervil': 4, 'sage': 42},
+                       {'ID': 'spce', 'nutmeg': 2, 'paprika': 65535}]],
+                     result)
+
+  def testPlainTable(self):
+    table = MockCueTable(raw_data=RecordTableTest._RECORDS)
+    plain = riff.batch.Plain(table)
+    self.assertEqual({'position': [1, 2, 3], 'flags': [10, 20, 30],
+                      'name': ['abcd', 'efgh', 'ijkl']}, plain)
+    self.assertEqual(plain, json.loads(json.dumps(plain)))
+
+  def testExpandPatterns(self):
+    self.assertEqual(self._filenames,
+                     riff.batch.ExpandPatterns([os.path.join(self._dir,
+                                                             '*.riff')]))
+
+
+class VerifyTest(unittest.TestCase):
+
+  def _Verify(self, data):
+    return riff.verify.VerifyStream(StringIO(data), len(data))
+
+  def testSound(self):
+    self.assertEqual(None, self._Verify(MmapTest._PACKED))
+    self.assertEqual(None, self._Verify(MmapTest._PACKED * 2))
+    self.assertEqual(None, self._Verify(RF64Test('testRead')._Write(True, 99)))
+
+  def testProblems(self):
+    packed = MmapTest._PACKED
+    self.assertEqual(54, self._Verify(packed[:-8])[0])
+    self.assertEqual(0, self._Verify(packed[:-1])[0])
+    # The pad byte after the odd-sized data chunk.
+    self.assertEqual(67, self._Verify(packed[:-1] + 'y')[0])
+    # herb claims more than the rest of its list.
+    self.assertEqual(24, self._Verify(packed[:28] + '\x30' + packed[29:])[0])
+    self.assertEqual(0, self._Verify('JUNK' + packed[4:])[0])
+    self.assertEqual(68, self._Verify(packed + 'RIFF')[0])
+
+  def testNestedForm(self):
+    inner = struct.pack('<4sI4s4sI4s', 'RIFF', 16, 'innr', 'doc_', 4, 'abcd')
+    outer = struct.pack('<4sI4s', 'RIFF', 4 + len(inner), 'outr')
+    self.assertEqual(None, self._Verify(outer + inner))
+    # doc_ claims more than the rest of the nested form.
+    damaged = inner[:16] + '\x06' + inner[17:] + 'xy'
+    outer = struct.pack('<4sI4s', 'RIFF', 4 + len(damaged), 'outr')
+    self.assertEqual(24, self._Verify(outer + damaged)[0])
+
+  def testVerifyFiles(self):
+    directory = tempfile.mkdtemp()
+    filenames = [os.path.join(directory, name) for name in ('a', 'b')]
+    for filename, data in zip(filenames, (MmapTest._PACKED, 'RIFF\0\0')):
+      f = open(filename, 'wb')
+      f.write(data)
+      f.close()
+    try:
+      for processes in (1, 2):
+        results = riff.verify.VerifyFiles(filenames + [directory + '/c'],
+                                          processes=processes)
+        self.assertEqual([(filenames[0], None)], results[:1])
+        self.assertEqual(0, results[1][1][0])
+        self.assertEqual(None, results[2][1][0])
+    finally:
+      for filename in filenames:
+        os.remove(filename)
+      os.rmdir(directory)
+
+
 if __name__ == '__main__':
   unittest.main()